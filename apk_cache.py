@@ -0,0 +1,117 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from config import *
+
+APK_CACHE_FILE_NAME = "apk_metadata_cache.db"
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def sha256_of_file(filename):
+    """Returns the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ApkMetadataCache:
+    """Persistent cache of parsed APK metadata, keyed by the SHA-256 of the APK bytes.
+
+    The number of cached APKs is bounded by 'max_entries', the least recently used
+    entries are evicted first. Known files (path, size, mtime) are mapped to their
+    digest too, so an APK that is already in place is looked up without reading it."""
+
+    def __init__(self, cache_file, max_entries=APK_CACHE_MAX_ENTRIES):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS apk_metadata (
+                sha256 TEXT PRIMARY KEY,
+                packageName TEXT NOT NULL,
+                versionName TEXT NOT NULL,
+                versionCode TEXT NOT NULL,
+                application TEXT NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_apk_metadata_last_used ON apk_metadata (last_used);
+            CREATE TABLE IF NOT EXISTS apk_files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL
+            );
+        ''')
+        self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get(self, sha256):
+        """Returns (package, version_name, version_code, application) or None."""
+        with self.lock:
+            row = self.conn.execute('SELECT packageName, versionName, versionCode, application FROM apk_metadata WHERE sha256 = ?',
+                                    (sha256,)).fetchone()
+            if row is not None:
+                self.conn.execute('UPDATE apk_metadata SET last_used = ? WHERE sha256 = ?', (time.time(), sha256))
+                self.conn.commit()
+        return row
+
+    def put(self, sha256, info):
+        """Stores the parsed metadata of an APK and evicts the least recently used entries."""
+        package, version_name, version_code, application = info
+        with self.lock:
+            self.conn.execute('''
+                INSERT OR REPLACE INTO apk_metadata (sha256, packageName, versionName, versionCode, application, last_used)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (sha256, package, str(version_name), str(version_code), application or '', time.time()))
+            self.conn.execute('''
+                DELETE FROM apk_metadata WHERE sha256 IN
+                    (SELECT sha256 FROM apk_metadata ORDER BY last_used DESC LIMIT -1 OFFSET ?)
+            ''', (self.max_entries,))
+            self.conn.execute('DELETE FROM apk_files WHERE sha256 NOT IN (SELECT sha256 FROM apk_metadata)')
+            self.conn.commit()
+
+    def file_digest(self, path):
+        """Returns the SHA-256 of the file, from the cache if the file has not changed since it was hashed."""
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime_ns, sha256 FROM apk_files WHERE path = ?', (key,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        sha256 = sha256_of_file(path)
+        self.remember_file(path, sha256)
+        return sha256
+
+    def remember_file(self, path, sha256):
+        """Records the digest of a file, e.g. when it has been moved to its final place."""
+        stat = os.stat(path)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO apk_files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)',
+                              (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, sha256))
+            self.conn.commit()
+
+
+_apk_cache = None
+
+def initialize_apk_cache(data_dir, max_entries=APK_CACHE_MAX_ENTRIES):
+    """Opens the APK metadata cache stored next to the installed versions database."""
+    global _apk_cache
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    cache_file = os.path.join(data_dir, APK_CACHE_FILE_NAME)
+    _apk_cache = ApkMetadataCache(cache_file, max_entries)
+    return cache_file
+
+def get_apk_cache():
+    return _apk_cache
@@ -1,10 +1,14 @@
+import io
 import re
 import subprocess
+import zipfile
 
 # pip install pyaxmlparser - https://pypi.org/project/pyaxmlparser/
 from pyaxmlparser import APK
 
 from config import *
+from apk_cache import get_apk_cache
+from tracing import traced
 
 
 """
@@ -35,25 +39,62 @@ def get_apk_info(filename):
 
 """    
 
+# The only APK entries needed for package name, version and application label
+APK_METADATA_ENTRIES = ("AndroidManifest.xml", "resources.arsc")
+
+def read_apk_metadata_entries(filename):
+    """Returns a small in-memory zip with only the metadata entries of the APK.
+    The APK is accessed as a seekable file: only its central directory and the
+    metadata entries are read, not the (possibly 100+ MB) rest of the file."""
+    slim_apk = io.BytesIO()
+    with zipfile.ZipFile(filename) as apk_zip:
+        with zipfile.ZipFile(slim_apk, 'w', zipfile.ZIP_STORED) as slim_zip:
+            for name in APK_METADATA_ENTRIES:
+                try:
+                    slim_zip.writestr(name, apk_zip.read(name))
+                except KeyError:
+                    if name == "AndroidManifest.xml":
+                        raise Exception(f"{filename} has no AndroidManifest.xml")
+    return slim_apk.getvalue()
+
+@traced()
 def get_apk_info(filename):
-    """Extracts package name, version name, and version code from an APK file using aapt."""
+    """Extracts package name, version name, version code and application name from an APK file."""
     
     # Problem: leaves the file open and does not close it
     # apk = APK(filename)
 
-    with open(filename, 'rb') as f:   # Open the file in binary mode  
-        apk = APK(f.read(), raw=True)
-        apk_package       = apk.package
-        apk_version_name  = apk.version_name
-        apk_version_code  = apk.version_code
-        apk_application   = apk.application
+    # pyaxmlparser needs the APK as a zip in memory - give it only the entries it reads
+    apk = APK(read_apk_metadata_entries(filename), raw=True)
+    apk_package       = apk.package
+    apk_version_name  = apk.version_name
+    apk_version_code  = apk.version_code
+    apk_application   = apk.application
   
     logger.debug(f"Package name: {apk_package}, version name: {apk_version_name}, version code: {apk_version_code}, application: {apk_application}")
 
     return apk_package, apk_version_name, apk_version_code, apk_application
 
-
-
-
-
-
+def get_apk_info_cached(filename, sha256=None):
+    """get_apk_info() through the persistent cache keyed by the SHA-256 of the APK.
+    'sha256' is the digest of the file if it is already known, e.g. computed while downloading."""
+    cache = get_apk_cache()
+    if cache is None:
+        return get_apk_info(filename)
+
+    if sha256 is None:
+        sha256 = cache.file_digest(filename)
+    info = cache.get(sha256)
+    if info is not None:
+        logger.debug(f"APK info of {filename} found in cache (sha256 {sha256})")
+        return tuple(info)
+
+    info = get_apk_info(filename)
+    cache.put(sha256, info)
+    return info
+
+def remember_apk_file(filename, sha256):
+    """Records the digest of an APK in its final place, so that it is not hashed again when verified."""
+    cache = get_apk_cache()
+    if cache is not None:
+        cache.remember_file(filename, sha256)
@@ -1,9 +1,80 @@
+import atexit
+import datetime
+import json
 import logging
 import logging.handlers
+import queue
 
-def setup_logging(logger, log_file):
+# Exported to config (and from there to all the modules) - not the standard modules imported here
+__all__ = ["logging", "JsonLinesFormatter", "ModuleLevelFilter", "parse_level", "setup_logging", "shutdown_logging"]
 
-    logger.setLevel(logging.DEBUG)
+# Background writer of the asynchronous (queue) logging, see setup_logging()
+_queue_listener = None
+
+def parse_level(level):
+    """Returns the numeric value of a level given as a number or a name, e.g. "info".
+    Raises ValueError for an unknown level name."""
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(str(level).strip().upper())
+    if not isinstance(value, int):
+        raise ValueError(f"Unknown log level '{level}'")
+    return value
+
+class ModuleLevelFilter(logging.Filter):
+    """Drops the records of a module below the level set for it, e.g. {"http_client": logging.INFO}.
+    All the modules log through the same logger - the module is the source file of the call.
+    Raises ValueError for an unknown level name."""
+
+    def __init__(self, module_levels):
+        super().__init__()
+        self.module_levels = {module: parse_level(level) for module, level in module_levels.items()}
+
+    def filter(self, record):
+        return record.levelno >= self.module_levels.get(record.module, logging.NOTSET)
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line - with the fields of a tracing span, if any."""
+
+    SPAN_FIELDS = ("span", "duration", "labels", "failed")
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for field in self.SPAN_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class _RecordQueueHandler(logging.handlers.QueueHandler):
+    """Queues the records as they are, for the listener to format. The stock prepare() formats
+    the record on the calling thread and drops its exc_info, which the JSON lines log needs."""
+
+    def prepare(self, record):
+        # Only the message is merged now - its arguments may change before the listener gets to it
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging(logger, log_file, json_log_file=None, use_queue=False, module_levels=None, file_level=logging.DEBUG):
+    """Logs to the console (INFO) and to a rotating 'log_file' (file_level), optionally also as JSON lines.
+    With 'use_queue' the log calls only put the records to a queue, and a background thread
+    formats and writes them - call shutdown_logging() (done also at exit) to flush it.
+    'module_levels' maps module names to the lowest level logged from them - raises
+    ValueError for an unknown level, before anything is set up."""
+    global _queue_listener
+
+    module_filter = ModuleLevelFilter(module_levels) if module_levels else None
+
+    # The logger level is the lowest level any handler wants, so disabled debug calls return right away
+    logger.setLevel(min(logging.INFO, file_level))
 
     # Create handlers
     console_handler = logging.StreamHandler()
@@ -13,20 +84,50 @@ def setup_logging(logger, log_file):
     
     # Create a rotating file handler with a maximum size of 512 KB and 10 backup files
     file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=512*1024, backupCount=10)
-    file_handler.setLevel(logging.DEBUG)
+    file_handler.setLevel(file_level)
 
     # Create a formatter with the levelname limited to 3 characters and add them to handlers
     formatter = logging.Formatter('%(asctime)s %(name)s %(levelname).3s - %(message)s')
     console_handler.setFormatter(formatter)
     file_handler.setFormatter(formatter)
 
-    # Add handlers to the logger
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    handlers = [console_handler, file_handler]
+
+    # Optional machine readable log - the same records as JSON lines, rotated like the text log
+    if json_log_file:
+        json_handler = logging.handlers.RotatingFileHandler(json_log_file, maxBytes=512*1024, backupCount=10)
+        json_handler.setLevel(file_level)
+        json_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(json_handler)
+
+    # Per-module levels - filtered before the records are queued or formatted
+    if module_filter is not None:
+        logger.addFilter(module_filter)
+
+    # Add handlers to the logger - directly, or behind a queue served by a background thread
+    if use_queue:
+        log_queue = queue.SimpleQueue()
+        _queue_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _queue_listener.start()
+        atexit.register(shutdown_logging)
+        logger.addHandler(_RecordQueueHandler(log_queue))
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
 
     # # Examples
     # logger.debug("This is a debug message")
     # logger.info("This is an info message")
     # logger.warning("This is a warning message")
     # logger.error("This is an error message")
-    # logger.critical("This is a critical message")
\ No newline at end of file
+    # logger.critical("This is a critical message")
+
+def shutdown_logging():
+    """Writes out the records still in the queue and stops the background writer (if any)."""
+    global _queue_listener
+    if _queue_listener is not None:
+        listener, _queue_listener = _queue_listener, None
+        listener.stop()
+        for handler in listener.handlers:
+            handler.flush()
+            handler.close()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import threading
+
+from config import *
+from apk_cache import sha256_of_file
+
+# Shared assets seeded into the F-Droid metadata of new packages - the sample screenshots
+# in DATA_DIR. DATA_DIR is scanned once per process. A package gets the screenshots as
+# hardlinks to the files in DATA_DIR when possible, so the same bytes are stored once;
+# otherwise as reflinks (copy_file_range, which shares the blocks on file systems that
+# support it) and as plain copies as the last resort.
+#
+# 'fdroid update' writes copies of the screenshots to the repository, so those are not
+# links to anything - the deploy finds them by content, see sample_screenshot_digests().
+
+SCREENSHOT_EXTENSIONS = ('.jpg', '.png')
+
+_sample_screenshots = None
+_sample_digests = None
+_scan_lock = threading.Lock()
+
+
+def sample_screenshots(data_dir=DATA_DIR):
+    """Returns the paths of the sample screenshots. DATA_DIR is listed on the first call only."""
+    global _sample_screenshots
+    with _scan_lock:
+        if _sample_screenshots is None:
+            _sample_screenshots = [os.path.join(data_dir, name) for name in sorted(os.listdir(data_dir))
+                                   if name.lower().endswith(SCREENSHOT_EXTENSIONS)]
+            logger.debug(f"Found {len(_sample_screenshots)} sample screenshots in {data_dir}")
+        return list(_sample_screenshots)
+
+def sample_screenshot_digests(data_dir=DATA_DIR):
+    """Returns the SHA-256 digests of the sample screenshots by size: dict size -> set of digests.
+    Hashed on the first call only."""
+    global _sample_digests
+    screenshots = sample_screenshots(data_dir)
+    with _scan_lock:
+        if _sample_digests is None:
+            _sample_digests = {}
+            for path in screenshots:
+                _sample_digests.setdefault(os.path.getsize(path), set()).add(sha256_of_file(path))
+        return _sample_digests
+
+def _reflink(src, dst):
+    """Copies 'src' to 'dst' with copy_file_range - a reflink where the file system supports it."""
+    if not hasattr(os, "copy_file_range"):
+        raise OSError("copy_file_range not available")
+    size = os.path.getsize(src)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        copied = 0
+        while copied < size:
+            count = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+            if count == 0:
+                break
+            copied += count
+    if copied != size:
+        os.remove(dst)
+        raise OSError(f"copy_file_range copied {copied} of {size} bytes")
+    shutil.copystat(src, dst)
+
+def clone_file(src, dst):
+    """Makes 'dst' a hardlink to 'src', a reflink or a copy of it - the first that works.
+    'dst' must not exist. Returns the method used: "hardlink", "reflink" or "copy"."""
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        _reflink(src, dst)
+        return "reflink"
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+    shutil.copy2(src, dst)
+    return "copy"
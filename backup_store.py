@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+
+import datetime
+import json
+import os
+import shutil
+import sys
+
+from config import *
+from apk_cache import sha256_of_file
+
+# Content-addressed backup store of the run environment.
+#
+#   RUN_BACKUP_DIR/objects/<2 first hex chars>/<sha256>   - every distinct file once
+#   RUN_BACKUP_DIR/snapshots/<name>.json                  - manifest: path -> sha256, size, mtime
+#
+# A snapshot of an unchanged tree costs only a new manifest. Objects are hardlinked from
+# the backed up tree when possible (deployed trees are never modified in place) and copied
+# otherwise. Objects that no snapshot refers to are removed by garbage_collect().
+
+OBJECTS_DIR   = "objects"
+SNAPSHOTS_DIR = "snapshots"
+SNAPSHOT_NAME_FORMAT = "%Y%m%d_%H%M%S_%f"
+
+
+def _object_path(store_dir, sha256):
+    return os.path.join(store_dir, OBJECTS_DIR, sha256[:2], sha256)
+
+def _snapshot_path(store_dir, name):
+    return os.path.join(store_dir, SNAPSHOTS_DIR, name + ".json")
+
+def list_snapshots(store_dir=RUN_BACKUP_DIR):
+    """Returns the names of the snapshots, oldest first."""
+    snapshots_dir = os.path.join(store_dir, SNAPSHOTS_DIR)
+    if not os.path.exists(snapshots_dir):
+        return []
+    return sorted(name[:-len(".json")] for name in os.listdir(snapshots_dir) if name.endswith(".json"))
+
+def read_manifest(name, store_dir=RUN_BACKUP_DIR):
+    with open(_snapshot_path(store_dir, name), 'r') as f:
+        return json.load(f)
+
+def _store_object(store_dir, src, sha256, link):
+    """Adds a file to the objects, unless it is there already. Returns True if it was added."""
+    dst = _object_path(store_dir, sha256)
+    if os.path.exists(dst):
+        return False
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    temp = dst + ".tmp"
+    if os.path.exists(temp):
+        os.remove(temp)
+    try:
+        if not link:
+            raise OSError("linking disabled")
+        os.link(src, temp)
+    except OSError:
+        shutil.copy2(src, temp)
+    os.replace(temp, dst)
+    return True
+
+def create_snapshot(source_dir, store_dir=RUN_BACKUP_DIR, name=None, link=True):
+    """Backs up 'source_dir' as a new snapshot. Returns (name, number of new objects).
+    Files with the same size and mtime as in the previous snapshot are not hashed again."""
+    if name is None:
+        name = datetime.datetime.now().strftime(SNAPSHOT_NAME_FORMAT)
+    snapshots = list_snapshots(store_dir)
+    if name in snapshots:
+        raise Exception(f"Backup snapshot {name} already exists")
+    previous = read_manifest(snapshots[-1], store_dir)["files"] if snapshots else {}
+
+    files = {}
+    new_objects = 0
+    for root, dirs, filenames in os.walk(source_dir):
+        dirs.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            relpath = os.path.relpath(path, source_dir).replace(os.sep, "/")
+            stat = os.stat(path)
+            known = previous.get(relpath)
+            if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns \
+                    and os.path.exists(_object_path(store_dir, known["sha256"])):
+                sha256 = known["sha256"]
+            else:
+                sha256 = sha256_of_file(path)
+                if _store_object(store_dir, path, sha256, link):
+                    new_objects += 1
+            files[relpath] = {"sha256": sha256, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    manifest_file = _snapshot_path(store_dir, name)
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    with open(manifest_file + ".tmp", 'w') as f:
+        json.dump({"name": name, "created": datetime.datetime.now().isoformat(timespec="seconds"), "files": files}, f, indent=1)
+    os.replace(manifest_file + ".tmp", manifest_file)
+    return name, new_objects
+
+def restore_snapshot(name, target_dir, store_dir=RUN_BACKUP_DIR):
+    """Restores the snapshot into 'target_dir', which must not exist."""
+    if os.path.exists(target_dir):
+        raise Exception(f"Restore target {target_dir} already exists")
+    manifest = read_manifest(name, store_dir)
+    for relpath, entry in manifest["files"].items():
+        dst = os.path.join(target_dir, *relpath.split("/"))
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copy2(_object_path(store_dir, entry["sha256"]), dst)
+        os.utime(dst, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+    return len(manifest["files"])
+
+def select_retained(names, keep_last=RUN_BACKUP_KEEP_LAST, keep_daily=RUN_BACKUP_KEEP_DAILY, keep_weekly=RUN_BACKUP_KEEP_WEEKLY):
+    """Returns the set of snapshot names to keep: the 'keep_last' newest ones, plus the newest
+    snapshot of each of the 'keep_daily' latest days and 'keep_weekly' latest weeks."""
+    newest_first = sorted(names, reverse=True)
+    keep = set(newest_first[:keep_last])
+
+    def newest_per_period(period_of, count):
+        periods = []
+        for name in newest_first:
+            try:
+                period = period_of(datetime.datetime.strptime(name, SNAPSHOT_NAME_FORMAT))
+            except ValueError:
+                continue    # Not named by the default format - only kept by 'keep_last'
+            if period not in periods:
+                if len(periods) == count:
+                    break
+                periods.append(period)
+                keep.add(name)
+
+    newest_per_period(lambda time: time.date(), keep_daily)
+    newest_per_period(lambda time: time.isocalendar()[:2], keep_weekly)
+    return keep
+
+def apply_retention(store_dir=RUN_BACKUP_DIR, keep_last=RUN_BACKUP_KEEP_LAST, keep_daily=RUN_BACKUP_KEEP_DAILY, keep_weekly=RUN_BACKUP_KEEP_WEEKLY):
+    """Removes the snapshots not selected by the retention policy and garbage collects the objects.
+    Returns (removed snapshots, removed objects)."""
+    names = list_snapshots(store_dir)
+    keep = select_retained(names, keep_last, keep_daily, keep_weekly)
+    removed = [name for name in names if name not in keep]
+    for name in removed:
+        logger.debug(f"Removing backup snapshot {name}")
+        os.remove(_snapshot_path(store_dir, name))
+    return removed, garbage_collect(store_dir)
+
+def garbage_collect(store_dir=RUN_BACKUP_DIR):
+    """Removes the objects that no snapshot refers to. Returns the number of removed objects."""
+    referenced = set()
+    for name in list_snapshots(store_dir):
+        referenced.update(entry["sha256"] for entry in read_manifest(name, store_dir)["files"].values())
+
+    removed = 0
+    objects_dir = os.path.join(store_dir, OBJECTS_DIR)
+    if not os.path.exists(objects_dir):
+        return removed
+    for prefix in os.listdir(objects_dir):
+        prefix_dir = os.path.join(objects_dir, prefix)
+        for sha256 in os.listdir(prefix_dir):
+            if sha256 not in referenced:
+                os.remove(os.path.join(prefix_dir, sha256))
+                removed += 1
+        if not os.listdir(prefix_dir):
+            os.rmdir(prefix_dir)
+    return removed
+
+
+# Command line (in ROOT_DIR, the paths are relative to it):
+#   python3 backup_store.py list
+#   python3 backup_store.py restore <snapshot> <target directory>
+#   python3 backup_store.py prune
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "list":
+        for name in list_snapshots():
+            print(f"{name}  ({len(read_manifest(name)['files'])} files)")
+    elif len(sys.argv) == 4 and sys.argv[1] == "restore":
+        count = restore_snapshot(sys.argv[2], sys.argv[3])
+        print(f"Restored {count} files of snapshot {sys.argv[2]} to {sys.argv[3]}")
+    elif len(sys.argv) == 2 and sys.argv[1] == "prune":
+        removed, objects = apply_retention()
+        print(f"Removed {len(removed)} snapshots and {objects} objects")
+    else:
+        print("Usage: backup_store.py list | restore <snapshot> <target directory> | prune")
+        sys.exit(1)
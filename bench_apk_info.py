@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+# Benchmark of APK metadata extraction: the original in-memory path (the whole APK
+# read into memory for pyaxmlparser) against get_apk_info(), which reads only the
+# zip central directory and the metadata entries.
+#
+# Usage:
+#   python3 bench_apk_info.py [--runs N] [APK ...]
+# Without APK arguments, synthetic APKs of 10, 50 and 150 MB are generated.
+#
+# Every method/APK combination is measured in a fresh process, so that the peak RSS
+# of one measurement is not inflated by the previous ones.
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+def get_apk_info_in_memory(filename):
+    """The original implementation of get_apk_info() - reads the whole APK into memory."""
+    from pyaxmlparser import APK
+    with open(filename, 'rb') as f:
+        apk = APK(f.read(), raw=True)
+        return apk.package, apk.version_name, apk.version_code, apk.application
+
+def get_apk_info_streaming(filename):
+    from apk_checker import get_apk_info
+    return get_apk_info(filename)
+
+METHODS = {
+    "in-memory": get_apk_info_in_memory,
+    "streaming": get_apk_info_streaming,
+}
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes in Linux, bytes in macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_child(method, filename, runs):
+    """Measures one method with one APK in this process and prints the result as JSON."""
+    import apk_checker     # Imports are not part of the measurement
+    import pyaxmlparser
+    baseline_rss = peak_rss_mb()
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        info = METHODS[method](filename)
+        latencies.append(time.perf_counter() - start)
+    print(json.dumps({
+        "info": list(info),
+        "latency_min": min(latencies),
+        "latency_avg": sum(latencies) / len(latencies),
+        "peak_rss_mb": peak_rss_mb(),
+        "baseline_rss_mb": baseline_rss,
+    }))
+
+def measure(method, filename, runs):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", method, "--runs", str(runs), filename],
+                            check=True, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def generate_apks(directory, sizes_mb):
+    from synthetic_apk import write_synthetic_apk
+    apks = []
+    for size_mb in sizes_mb:
+        filename = os.path.join(directory, f"synthetic-{size_mb}MB.apk")
+        write_synthetic_apk(filename, f"com.example.bench{size_mb}", "1.0.0", size_mb, f"Bench {size_mb}", size=size_mb * 1024 * 1024)
+        apks.append(filename)
+    return apks
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark APK metadata extraction")
+    parser.add_argument("apks", nargs="*", help="APK files (default: generated synthetic APKs)")
+    parser.add_argument("--runs", type=int, default=5, help="runs per method and APK")
+    parser.add_argument("--child", choices=METHODS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.apks[0], args.runs)
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        apks = args.apks or generate_apks(temp_dir, [10, 50, 150])
+
+        print(f"{'APK':<40} {'size MB':>8} {'method':<10} {'min ms':>9} {'avg ms':>9} {'peak RSS MB':>12} {'+RSS MB':>9}")
+        for filename in apks:
+            size_mb = os.path.getsize(filename) / (1024 * 1024)
+            results = {method: measure(method, filename, args.runs) for method in METHODS}
+            if len({tuple(result["info"]) for result in results.values()}) != 1:
+                print(f"WARNING: methods disagree for {filename}: {results}")
+            for method, result in results.items():
+                print(f"{os.path.basename(filename)[:40]:<40} {size_mb:>8.1f} {method:<10} "
+                      f"{result['latency_min'] * 1000:>9.1f} {result['latency_avg'] * 1000:>9.1f} "
+                      f"{result['peak_rss_mb']:>12.1f} {result['peak_rss_mb'] - result['baseline_rss_mb']:>9.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+# Benchmark of the run environment backup: a full ZIP_DEFLATED zip per publish (the
+# original approach) against snapshots in the content-addressed backup store.
+#
+# Usage:
+#   python3 bench_backup_store.py [--apks N] [--apk-size MB] [--publishes P]
+#
+# A run tree with N APKs (random, i.e. incompressible content like real APKs) and a
+# few index files is generated. Every publish adds one APK, rewrites the index files
+# and backs up the tree with both methods.
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+import backup_store
+
+def write_random_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+
+def publish(tree, number, apk_size):
+    write_random_file(os.path.join(tree, f"com.example.app{number}.apk"), apk_size)
+    for index in ("index-v1.json", "index-v2.json", "entry.json"):
+        with open(os.path.join(tree, index), 'w') as f:
+            f.write(f"{{\"timestamp\": {time.time()}, \"apps\": {number}}}\n" * 200)
+
+def zip_backup(tree, backup_dir, number):
+    zip_filepath = os.path.join(backup_dir, f"repo_{number:04}.zip")
+    with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for root, dirs, files in os.walk(tree):
+            for file in files:
+                file_path = os.path.join(root, file)
+                zipf.write(file_path, os.path.relpath(file_path, tree))
+
+def directory_size(directory, count_links_once=True):
+    """Bytes used by the files of a directory. Files hardlinked from elsewhere are not counted."""
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            stat = os.stat(os.path.join(root, file))
+            if count_links_once and stat.st_nlink > 1:
+                continue
+            total += stat.st_size
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark run environment backups")
+    parser.add_argument("--apks", type=int, default=50, help="APKs in the run tree at start")
+    parser.add_argument("--apk-size", type=float, default=5, help="size of an APK in MB")
+    parser.add_argument("--publishes", type=int, default=10, help="publishes (backups) to simulate")
+    args = parser.parse_args()
+    apk_size = int(args.apk_size * 1024 * 1024)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tree = os.path.join(temp_dir, "repo")
+        zip_dir = os.path.join(temp_dir, "zip_backups")
+        store_copy_dir = os.path.join(temp_dir, "store_copy")
+        store_link_dir = os.path.join(temp_dir, "store_link")
+        for directory in (tree, zip_dir, store_copy_dir, store_link_dir):
+            os.makedirs(directory)
+        for number in range(args.apks):
+            publish(tree, number, apk_size)
+
+        times = {"zip": 0.0, "store (copy)": 0.0, "store (link)": 0.0}
+        for number in range(args.apks, args.apks + args.publishes):
+            publish(tree, number, apk_size)
+
+            start = time.perf_counter()
+            zip_backup(tree, zip_dir, number)
+            times["zip"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            backup_store.create_snapshot(tree, store_copy_dir, name=f"{number:04}", link=False)
+            times["store (copy)"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            backup_store.create_snapshot(tree, store_link_dir, name=f"{number:04}", link=True)
+            times["store (link)"] += time.perf_counter() - start
+
+        tree_size = directory_size(tree, count_links_once=False)
+        disk = {
+            "zip": directory_size(zip_dir),
+            "store (copy)": directory_size(store_copy_dir),
+            "store (link)": directory_size(store_link_dir),
+        }
+
+        print(f"Run tree: {args.apks + args.publishes} APKs, {tree_size / 2**20:.1f} MB; {args.publishes} publishes")
+        print(f"{'method':<14} {'total s':>9} {'per backup s':>13} {'disk MB':>9}")
+        for method in times:
+            print(f"{method:<14} {times[method]:>9.2f} {times[method] / args.publishes:>13.3f} {disk[method] / 2**20:>9.1f}")
+        print("(disk of 'store (link)' excludes objects shared with the run tree through hardlinks)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+# Offline benchmark of the whole check and publish pipeline: polling, release checking,
+# download, metadata, staging, 'fdroid update', database and deploy - against a local
+# fake GitHub (fake_github.py) with synthetic APKs and a stub 'fdroid' command.
+#
+# Usage:
+#   python3 bench_pipeline.py [--repos N] [--releases M] [--apk-size MB] [--api-latency MS]
+#                             [--fdroid-delay S] [--backend rest|graphql] [--results-dir DIR]
+#                             [--compare FILE|latest]
+#
+# Every repository gets M development releases, one per cycle, so every cycle publishes
+# N releases as one batch. Reported: throughput (releases/s), cycle durations, latency
+# percentiles per stage (the tracing spans) and peak RSS. The results are saved as JSON
+# in the results directory, named by time and git commit, and can be compared with an
+# earlier result file.
+
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# A stand-in for 'fdroid update': writes an index of the APKs in repo/ and optionally
+# sleeps, to stand for the time the real command takes
+FDROID_STUB = """#!{python}
+import json, os, sys, time
+if sys.argv[1:2] != ["update"]:
+    sys.exit("fdroid stub: only 'update' is supported")
+time.sleep(float(os.environ.get("FDROID_STUB_DELAY", "0")))
+apks = sorted(name for name in os.listdir("repo") if name.endswith(".apk"))
+with open(os.path.join("repo", "index-v1.json"), "w") as f:
+    json.dump({{"apks": [{{"name": name, "size": os.path.getsize(os.path.join("repo", name))}} for name in apks]}}, f)
+print(f"fdroid stub: indexed {{len(apks)}} APKs")
+"""
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes in Linux, bytes in macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of values."""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SOURCE_DIR,
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def make_tree(root):
+    """The directory layout of ROOT_DIR, and the stub fdroid in root/bin."""
+    for directory in ("data", "logs", "build_environment/NidTestAppCenter/repo", "build_environment/NidTestAppCenter/metadata",
+                      "run_environment/backup", "run_environment/repo", "bin", "assets"):
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    stub = os.path.join(root, "bin", "fdroid")
+    with open(stub, "w") as f:
+        f.write(FDROID_STUB.format(python=sys.executable))
+    os.chmod(stub, 0o755)
+
+def run(args, root):
+    from fake_github import FakeGitHub
+    github = FakeGitHub(os.path.join(root, "assets"), latency=args.api_latency / 1000)
+    github_url = github.start()
+
+    # The application modules read these when imported
+    os.environ["APUB_GITHUB_API_URL"] = github_url
+    os.environ["GITHUB_TOKEN"] = "bench"
+    os.environ["PATH"] = os.path.join(root, "bin") + os.pathsep + os.environ["PATH"]
+    os.environ["FDROID_STUB_DELAY"] = str(args.fdroid_delay)
+    os.chdir(root)
+    sys.path.insert(0, SOURCE_DIR)
+
+    from config import logger, BUILD_METADATA_DIR
+    from repo_config import default_settings
+    import testappc_autopublish as app
+    import tracing
+
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler(os.path.join(root, "logs", "bench.log"))
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname).3s - %(message)s'))
+    logger.addHandler(handler)
+
+    db_file = app.initialize_db("data")
+    app.initialize_etag_cache("data")
+    app.initialize_apk_cache("data")
+    app.initialize_repo_index("data")
+    app.initialize_metadata_index(BUILD_METADATA_DIR)
+    app.initialize_githubber()
+    repos = [f"bench/app{number}" for number in range(args.repos)]
+    scheduler = app.PollScheduler({})
+    scheduler.set_repos({repo: default_settings(repo) for repo in repos})
+    pipeline = app.PublishPipeline(db_file)
+
+    apk_size = int(args.apk_size * 1024 * 1024)
+    spans = []
+    cycles = []
+    published = 0
+    baseline_rss = peak_rss_mb()
+    start = time.perf_counter()
+    for release_number in range(args.releases):
+        # New releases are generated outside of the measured time
+        generate_start = time.perf_counter()
+        for number, repo in enumerate(repos):
+            github.add_release(repo, f"v1.{release_number}-dev", f"com.bench.app{number}",
+                               f"1.{release_number}-dev", release_number + 1, apk_size=apk_size)
+        start += time.perf_counter() - generate_start
+
+        cycle_start = time.perf_counter()
+        tracing.reset_cycle()
+        with tracing.span("poll"):
+            poll_results = app.poll_latest_releases(repos, backend=args.backend)
+        app.queue_new_releases(poll_results, pipeline, db_file)
+        published += len(app.publish_queued_releases(pipeline, scheduler))
+        app.save_etag_cache()
+        cycles.append(time.perf_counter() - cycle_start)
+        spans.extend(tracing.finished_spans())
+        print(f"cycle {release_number + 1}/{args.releases}: {cycles[-1]:.2f}s", file=sys.stderr)
+    total = time.perf_counter() - start
+    github.stop()
+
+    stages = {}
+    for name, duration, labels, failed in spans:
+        stages.setdefault(name, []).append(duration)
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parameters": {"repos": args.repos, "releases": args.releases, "apk_size_mb": args.apk_size,
+                       "api_latency_ms": args.api_latency, "fdroid_delay_s": args.fdroid_delay, "backend": args.backend},
+        "published": published,
+        "expected": args.repos * args.releases,
+        "total_s": total,
+        "throughput_releases_per_s": published / total if total else 0.0,
+        "cycle_s": {"p50": percentile(cycles, 50), "p90": percentile(cycles, 90), "max": max(cycles)},
+        "stages": {name: {"count": len(durations), "p50": percentile(durations, 50), "p90": percentile(durations, 90),
+                          "p99": percentile(durations, 99), "max": max(durations), "total": sum(durations)}
+                   for name, durations in stages.items()},
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_growth_mb": peak_rss_mb() - baseline_rss,
+        "github_requests": dict(github.request_counts),
+    }
+
+def print_result(result, previous=None):
+    def change(path, value):
+        old = previous
+        for key in path:
+            old = old.get(key) if isinstance(old, dict) else None
+        if not isinstance(old, (int, float)) or not old:
+            return ""
+        return f" ({(value - old) / old * 100:+.0f}%)"
+
+    parameters = result["parameters"]
+    print(f"{parameters['repos']} repos x {parameters['releases']} releases, {parameters['apk_size_mb']} MB APKs, "
+          f"API latency {parameters['api_latency_ms']} ms, fdroid {parameters['fdroid_delay_s']} s, "
+          f"{parameters.get('backend', 'rest')} polling - commit {result['commit']}")
+    print(f"Published {result['published']}/{result['expected']} releases in {result['total_s']:.2f}s: "
+          f"{result['throughput_releases_per_s']:.2f} releases/s{change(['throughput_releases_per_s'], result['throughput_releases_per_s'])}")
+    print(f"Cycle p50 {result['cycle_s']['p50']:.3f}s, p90 {result['cycle_s']['p90']:.3f}s; "
+          f"peak RSS {result['peak_rss_mb']:.1f} MB (+{result['rss_growth_mb']:.1f} MB during the run)")
+    print(f"GitHub requests: {', '.join(f'{kind} {count}' for kind, count in sorted(result['github_requests'].items()))}")
+    print(f"{'stage':<26} {'count':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'total s':>8}")
+    for name, stage in sorted(result["stages"].items(), key=lambda item: item[1]["total"], reverse=True):
+        print(f"{name:<26} {stage['count']:>6} {stage['p50'] * 1000:>9.1f} {stage['p90'] * 1000:>9.1f} "
+              f"{stage['p99'] * 1000:>9.1f} {stage['max'] * 1000:>9.1f} {stage['total']:>8.2f}"
+              f"{change(['stages', name, 'p50'], stage['p50'])}")
+    if previous:
+        print(f"(changes in parentheses: throughput and stage p50 against commit {previous.get('commit')} at {previous.get('time')})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the publishing pipeline against a fake GitHub and a stub fdroid")
+    parser.add_argument("--repos", type=int, default=10, help="repositories")
+    parser.add_argument("--releases", type=int, default=3, help="releases per repository (one per cycle)")
+    parser.add_argument("--apk-size", type=float, default=2, help="size of an APK in MB")
+    parser.add_argument("--api-latency", type=float, default=20, help="latency of a GitHub API response in ms")
+    parser.add_argument("--fdroid-delay", type=float, default=0.5, help="duration of the stub 'fdroid update' in seconds")
+    parser.add_argument("--backend", choices=["rest", "graphql"], default="rest", help="polling backend")
+    parser.add_argument("--results-dir", default=os.path.join(SOURCE_DIR, "bench_results"), help="where the results are saved")
+    parser.add_argument("--compare", help="earlier result file to compare with, or 'latest'")
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        compare = args.compare
+        if compare == "latest":
+            earlier = sorted(name for name in os.listdir(args.results_dir) if name.startswith("pipeline_")) if os.path.isdir(args.results_dir) else []
+            compare = os.path.join(args.results_dir, earlier[-1]) if earlier else None
+        if compare:
+            with open(compare) as f:
+                previous = json.load(f)
+
+    results_dir = os.path.abspath(args.results_dir)
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root)
+        cwd = os.getcwd()
+        try:
+            result = run(args, root)
+        finally:
+            os.chdir(cwd)
+
+    os.makedirs(results_dir, exist_ok=True)
+    result_file = os.path.join(results_dir, f"pipeline_{time.strftime('%Y%m%d_%H%M%S')}_{result['commit']}.json")
+    with open(result_file, "w") as f:
+        json.dump(result, f, indent=1)
+
+    print_result(result, previous)
+    print(f"Saved to {result_file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+# Benchmark of the build repository inventory (repo_index.py), which retention.py selects
+# the old versions to retire from before every build, against a repository of hundreds of
+# synthetic APKs:
+#
+#   read every APK - every APK hashed and parsed, as selecting the old versions would take
+#                    without the inventory
+#   first scan     - the inventory built from scratch: every APK hashed and parsed
+#   one new APK    - a publish batch: the scan after one APK has been added, only it is
+#                    hashed and parsed, and the selection of the old versions
+#   unchanged      - a scan of an unchanged repository and the selection
+#
+# 'fdroid update' itself is not measured - it hashes every APK on every run, the inventory
+# does not change that.
+#
+# Usage:
+#   python3 bench_repo_index.py [--apks N] [--apk-size MB] [--packages P] [--runs R]
+#
+# The APKs are freshly written, so they are likely in the page cache: reading a repository
+# from disk is slower than measured here.
+
+import argparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SOURCE_DIR)
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes in Linux, bytes in macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def generate_repo(repo_dir, apks, packages, size):
+    from synthetic_apk import write_synthetic_apk
+    for number in range(apks):
+        package = f"com.example.bench{number % packages}"
+        version_code = number // packages + 1
+        write_synthetic_apk(os.path.join(repo_dir, f"{package}-1.{version_code}.apk"), package, f"1.{version_code}",
+                            version_code, f"Bench {number % packages}", size=size)
+
+def timed(function, runs):
+    """Returns (result of the last run, the fastest time) of 'function'."""
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the incremental build repository inventory")
+    parser.add_argument("--apks", type=int, default=300, help="APKs in the repository")
+    parser.add_argument("--apk-size", type=float, default=2, help="size of an APK in MB")
+    parser.add_argument("--packages", type=int, default=30, help="packages the APKs are versions of")
+    parser.add_argument("--keep", type=int, default=3, help="version codes of a package kept by retention")
+    parser.add_argument("--runs", type=int, default=3, help="runs of the repeatable measurements (the fastest is reported)")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="bench_repo_index_")
+    try:
+        data_dir = os.path.join(root, "data")
+        repo_dir = os.path.join(root, "repo")
+        for directory in (data_dir, repo_dir):
+            os.makedirs(directory)
+
+        print(f"Generating {args.apks} APKs of {args.apk_size} MB...", file=sys.stderr)
+        size = int(args.apk_size * 1024 * 1024)
+        generate_repo(repo_dir, args.apks, args.packages, size)
+
+        from apk_cache import initialize_apk_cache, sha256_of_file
+        from apk_checker import get_apk_info
+        from repo_index import ApkEntry, initialize_repo_index, get_repo_index
+        from retention import select_retired
+        initialize_apk_cache(data_dir, max_entries=args.apks * 2)
+        initialize_repo_index(data_dir)
+        repo_index = get_repo_index()
+        version_codes = {f"com.example.bench{number}": set(range(1, args.apks // args.packages + 1))
+                         for number in range(args.packages)}
+        baseline_rss = peak_rss_mb()
+
+        def read_every_apk():
+            entries = {}
+            for name in sorted(os.listdir(repo_dir)):
+                if name.endswith(".apk"):
+                    path = os.path.join(repo_dir, name)
+                    stat = os.stat(path)
+                    packageName, versionName, versionCode, application = get_apk_info(path)
+                    entries[name] = ApkEntry(name, stat.st_size, stat.st_mtime_ns, sha256_of_file(path),
+                                             packageName, str(versionName), str(versionCode), application or '')
+            return select_retired(entries, version_codes, args.keep, {})
+
+        def scan_and_select():
+            scan = repo_index.scan(repo_dir)
+            return scan, select_retired(scan.entries, version_codes, args.keep, {})
+
+        results = []
+        retired, elapsed = timed(read_every_apk, args.runs)
+        results.append(("read every APK", elapsed, f"{args.apks} hashed and parsed, {len(retired)} to retire"))
+
+        (scan, retired), elapsed = timed(scan_and_select, 1)
+        results.append(("first scan", elapsed, f"{scan.new} new, {len(retired)} to retire"))
+
+        new_apks = []
+        def add_one_and_scan():
+            from synthetic_apk import write_synthetic_apk
+            version_code = 1000 + len(new_apks)
+            path = os.path.join(repo_dir, f"com.example.bench0-9.{version_code}.apk")
+            write_synthetic_apk(path, "com.example.bench0", f"9.{version_code}", version_code, "Bench 0", size=size)
+            version_codes["com.example.bench0"].add(version_code)
+            new_apks.append(path)
+            start = time.perf_counter()
+            result = scan_and_select()
+            return result, time.perf_counter() - start
+        measurements = [add_one_and_scan() for _ in range(args.runs)]
+        (scan, retired), elapsed = min(measurements, key=lambda measurement: measurement[1])
+        results.append(("one new APK", elapsed, f"{scan.new} new, {scan.unchanged} unchanged, {len(retired)} to retire"))
+
+        (scan, retired), elapsed = timed(scan_and_select, args.runs)
+        results.append(("unchanged", elapsed, f"{scan.unchanged} unchanged, {len(retired)} to retire"))
+
+        print(f"{args.apks} APKs of {args.apk_size} MB ({args.packages} packages), fastest of {args.runs} runs")
+        print(f"{'':<15} {'seconds':>9} {'vs read':>8}")
+        full = results[0][1]
+        for name, elapsed, note in results:
+            print(f"{name:<15} {elapsed:>9.3f} {elapsed / full:>7.1%}  {note}")
+        print(f"Peak RSS {peak_rss_mb():.1f} MB (+{peak_rss_mb() - baseline_rss:.1f} MB during the measurements)")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import os
+
 from apub_logging import *
 
 # Define the subdirectories - todo: check ROOT_DIR_POSIX when taking to production
@@ -6,14 +8,97 @@ ROOT_DIR_NT         = r"C:\Users\janne.saarikettu\source\repos\misc\AppcAutoPubl
 ROOT_DIR            = "" # Set to empty string to be set later based on OS
 
 DATA_DIR            = "data"
+DOWNLOAD_DIR        = "downloads"                     # APKs being downloaded, a directory per release asset
 BUILD_DIR           = "build_environment/NidTestAppCenter"
 BUILD_REPO_DIR      = "build_environment/NidTestAppCenter/repo"
 BUILD_METADATA_DIR  = "build_environment/NidTestAppCenter/metadata" 
+BUILD_STAGING_DIR   = "build_environment/staging"     # Backups of the build files replaced by a batch until it is built
+BUILD_ARCHIVE_DIR   = "build_environment/archive"     # Old versions retired from the build repo, outside of F-Droid's view
+
+# Retention of the build repo - of every package in the database only the newest versions are kept,
+# the APKs and changelogs of the older ones are moved to BUILD_ARCHIVE_DIR ("archive") or deleted ("delete")
+RETENTION_KEEP_VERSIONS  = 10       # version codes kept per package, 0 = all
+RETENTION_KEEP_OVERRIDES = {}       # per package, e.g. {"com.nordicid.yarfid": 20}
+RETENTION_MODE           = "archive"
 
 RUN_BACKUP_DIR      = "run_environment/backup"
-RUN_REPO_DIR        = "run_environment/repo"
+RUN_REPO_DIR        = "run_environment/repo"          # Symlink to the current tree in RUN_RELEASES_DIR
+RUN_RELEASES_DIR    = "run_environment/releases"
+RUN_RELEASES_KEEP   = 3                               # Deployed trees kept, including the current one
+
+# Backup snapshots of the run environment kept: the latest ones, and the latest of each day and week
+RUN_BACKUP_KEEP_LAST   = 10
+RUN_BACKUP_KEEP_DAILY  = 7
+RUN_BACKUP_KEEP_WEEKLY = 4
 
 # Logger
 logger   = logging.getLogger("apub")
 LOG_DIR  = "logs"
 LOG_FILE = "autopublish.log"
+LOG_JSON_FILE = "autopublish.jsonl"     # JSON lines log, written with --json-log
+LOG_FILE_LEVEL = logging.DEBUG          # Level of the log files - INFO makes the debug messages cost (almost) nothing
+LOG_MODULE_LEVELS = {}                  # Lowest level logged per module, e.g. {"http_client": "INFO"} - see also --log-level
+LOG_MAX_PAYLOAD = 4000                  # characters of a response body or command output written to the debug log
+
+# Release polling - number of repositories fetched from GitHub in parallel
+POLL_WORKERS = 8
+POLL_INTERVAL = 5 * 60     # seconds, polling interval of a repository without release history
+POLL_INTERVAL_MIN = 60     # seconds, polling intervals adapt between these limits -
+POLL_INTERVAL_MAX = 60 * 60  # can be overridden per repository in the supported repos file
+
+# How the latest releases are polled - "rest": one conditional request per repository (a 304 Not Modified
+# does not count against the rate limit), "graphql": one GraphQL query per GRAPHQL_BATCH_SIZE repositories.
+# The GraphQL backend fetches a release that has changed once more from the REST API, for its assets.
+POLL_BACKEND = "rest"
+GRAPHQL_BATCH_SIZE = 50
+GRAPHQL_MAX_ASSETS = 100    # assets of a release fetched by the GraphQL backend
+
+# GitHub API and the HTTP client used to access it
+GITHUB_API_URL       = os.environ.get("APUB_GITHUB_API_URL", "https://api.github.com")   # e.g. a fake_github.py server
+HTTP_CONNECT_TIMEOUT = 10       # seconds
+HTTP_READ_TIMEOUT    = 60       # seconds
+HTTP_RETRIES         = 3        # attempts per request
+HTTP_BACKOFF_BASE    = 2.0      # seconds, doubled on every retry
+HTTP_BACKOFF_MAX     = 30.0     # seconds, upper limit of a single backoff
+RATE_LIMIT_MAX_WAITS = 3        # times a request waits for a rate limit reset before giving up
+
+# Parsed APK metadata cache - maximum number of APKs kept, least recently used are evicted
+APK_CACHE_MAX_ENTRIES = 1000
+
+# Downloads - assets of at least DOWNLOAD_SEGMENT_MIN_SIZE bytes are downloaded in parallel segments
+DOWNLOAD_SEGMENTS        = 4
+DOWNLOAD_SEGMENT_MIN_SIZE = 32 * 1024 * 1024
+DOWNLOAD_WORKERS         = 4    # APKs of a publish batch downloaded and read in parallel
+
+# Release assets published - every asset whose name matches the pattern (re.search), e.g. r"-arm64-v8a\.apk$"
+ASSET_PATTERN = r"\.apk"
+# Development releases - the ones published - have one of these in the release name
+DEV_RELEASE_MARKERS = ("-dev", "_dev")
+# Both can be set per repository in the supported repositories file, see repo_config.py
+
+# Catch-up - when the latest release of a repository has changed, all the releases published since the
+# newest one in the database are fetched (newest first, pages of CATCHUP_PAGE_SIZE), so that releases
+# published between polls or during a downtime are not missed. 0 pages: only the latest release is checked.
+CATCHUP_PAGE_SIZE = 30
+CATCHUP_MAX_PAGES = 5
+
+# Several workers sharing the data directory (--worker), see work_leases.py
+LEASE_TTL = 120                 # seconds, a lease of a worker that has not renewed it is taken over after this
+LEASE_REBALANCE_INTERVAL = 60   # seconds, the repositories are shared again among the live workers at least this often
+
+# Daemon mode - health and metrics endpoint, only reachable locally by default
+HEALTH_HOST = "127.0.0.1"
+HEALTH_PORT = 8321
+HEALTH_MAX_CYCLE_AGE = 2 * POLL_INTERVAL_MAX    # seconds without a completed cycle before /health reports unhealthy
+
+# Webhook mode (--webhook) - GitHub 'release' events published right away, see webhook.py. The webhook
+# secret is read from the environment variable GITHUB_WEBHOOK_SECRET. GitHub must reach the listener:
+# e.g. 0.0.0.0, or 127.0.0.1 behind a reverse proxy.
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = 8322
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_MAX_BODY = 5 * 1024 * 1024          # bytes of an event payload
+WEBHOOK_SETTLE_DELAY = 10                   # seconds without new events before the received releases are published..
+WEBHOOK_MAX_DELAY = 60                      # ..but at most this long after the first one
+WEBHOOK_ASSET_POLL_DELAY = 60               # seconds, a release published without its APK yet is polled again this soon
+WEBHOOK_POLL_INTERVAL_MIN = 30 * 60         # seconds, polling is only a safety net for missed events
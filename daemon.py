@@ -0,0 +1,122 @@
+import json
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import *
+import metrics
+
+# Daemon mode of the application:
+#   SIGTERM / SIGINT - the current stage is finished and the application exits
+#   SIGHUP           - the supported repositories file is re-read without waiting for the next cycle
+#   http://HEALTH_HOST:HEALTH_PORT/health  - JSON status, HTTP 503 if unhealthy
+#   http://HEALTH_HOST:HEALTH_PORT/metrics - Prometheus metrics
+
+
+class DaemonState:
+    """State shared by the main loop, the signal handlers and the health server."""
+
+    def __init__(self, max_cycle_age=HEALTH_MAX_CYCLE_AGE):
+        self.stop_requested = threading.Event()
+        self.reload_requested = threading.Event()
+        self.wakeup = threading.Event()     # Ends the wait between cycles early
+        self.max_cycle_age = max_cycle_age
+        self.started = time.time()
+        self.last_cycle_end = None
+        self.stage = "starting"
+
+    def request_stop(self):
+        self.stop_requested.set()
+        self.wakeup.set()
+
+    def request_reload(self):
+        self.reload_requested.set()
+        self.wakeup.set()
+
+    def should_stop(self):
+        return self.stop_requested.is_set()
+
+    def set_stage(self, stage):
+        self.stage = stage
+
+    def cycle_done(self):
+        self.last_cycle_end = time.time()
+        metrics.LAST_CYCLE_END.set(self.last_cycle_end)
+
+    def wait(self, seconds):
+        """Sleeps until the next cycle, a stop or a reload request."""
+        self.stage = "waiting"
+        self.wakeup.wait(seconds)
+        self.wakeup.clear()
+
+    def health(self):
+        """Returns (healthy, status dict). The application is unhealthy when it is stopping,
+        or when no cycle has been completed for 'max_cycle_age' seconds."""
+        now = time.time()
+        since = self.last_cycle_end if self.last_cycle_end is not None else self.started
+        if self.stop_requested.is_set():
+            status = "stopping"
+        elif now - since > self.max_cycle_age:
+            status = "stale"
+        else:
+            status = "ok"
+        return status == "ok", {
+            "status": status,
+            "stage": self.stage,
+            "uptime_seconds": round(now - self.started, 1),
+            "last_cycle_end": self.last_cycle_end,
+            "seconds_since_last_cycle": round(now - self.last_cycle_end, 1) if self.last_cycle_end else None,
+        }
+
+
+def install_signal_handlers(state):
+    """SIGTERM and SIGINT request a graceful stop, SIGHUP a reload. Must be called in the main thread."""
+
+    def on_stop(signum, frame):
+        logger.info(f"Received {signal.Signals(signum).name} - stopping after the current stage...")
+        state.request_stop()
+
+    def on_reload(signum, frame):
+        logger.info("Received SIGHUP - reloading the supported repositories...")
+        state.request_reload()
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    if hasattr(signal, "SIGHUP"):   # Not in Windows
+        signal.signal(signal.SIGHUP, on_reload)
+
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def do_GET(self):
+        if self.path == "/health":
+            healthy, status = self.state.health()
+            self._send(200 if healthy else 503, "application/json", json.dumps(status) + "\n")
+        elif self.path == "/metrics":
+            self._send(200, "text/plain; version=0.0.4", metrics.render())
+        else:
+            self._send(404, "text/plain", "Not found\n")
+
+    def _send(self, code, content_type, body):
+        data = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass    # Scraped every few seconds - not worth logging
+
+
+def start_health_server(state, host=HEALTH_HOST, port=HEALTH_PORT):
+    """Serves /health and /metrics in a background thread. Returns the server."""
+    handler = type("HealthHandler", (_HealthHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="health-server", daemon=True)
+    thread.start()
+    logger.info(f"Health and metrics served at http://{host}:{server.server_address[1]}/health and /metrics")
+    return server
@@ -0,0 +1,220 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from config import *
+import http_client
+import metrics
+
+# Downloads go to '<filename>.part' (and '<filename>.part.<n>' for the segments of a
+# parallel download). A broken transfer is resumed from where it stopped with an HTTP
+# Range request - also by the next cycle or after a restart. The file gets its final
+# name only after its size and SHA-256 have been verified.
+#
+# A partial download is resumed only from the same source: the URL and the ETag of the
+# file are kept in '<filename>.part.source', and a resume is sent with If-Range, so a
+# server with a changed file sends it whole. Partial files of another URL, or without
+# a source file, are thrown away.
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+class RangeNotSupported(Exception):
+    pass
+
+
+def _sha256_of_file(filename, digest=None):
+    digest = digest or hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+class _PartSource:
+    """The source of the partial files of a download: the URL and the ETag, kept in '<part file>.source'."""
+
+    def __init__(self, part_file, url):
+        self.path = part_file + ".source"
+        self.url = url
+        self.etag = None
+        self.lock = threading.Lock()
+
+    def claim(self, leftovers):
+        """Removes the partial files ('leftovers') if they are not from this URL, and records the URL."""
+        try:
+            with open(self.path, 'r') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            stored = {}
+        if stored.get('url') == self.url:
+            self.etag = stored.get('etag')
+        else:
+            for leftover in leftovers:
+                if os.path.exists(leftover):
+                    logger.debug(f"Removing partial download {leftover} of another source")
+                    os.remove(leftover)
+        self._save()
+
+    def update(self, response):
+        """Records the ETag of the file from a response."""
+        etag = response.headers.get('ETag')
+        with self.lock:
+            if etag and etag != self.etag:
+                self.etag = etag
+                self._save()
+
+    def _save(self):
+        with open(self.path, 'w') as f:
+            json.dump({'url': self.url, 'etag': self.etag}, f)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _content_range_start(response):
+    match = re.match(r'bytes (\d+)-', response.headers.get('Content-Range', ''))
+    return int(match.group(1)) if match else None
+
+def _download_range(url, target, headers, start=0, end=None, digest=None, source=None):
+    """Downloads bytes start..end (inclusive, None = to the end of the file) of 'url' into
+    'target', resuming from the bytes already in 'target'. 'digest' (if given) covers the
+    bytes already in 'target' and is updated with the new ones. 'source' (_PartSource) gives
+    the ETag for If-Range, and gets the ETag of the response.
+    Returns the digest, which is a new one if the download had to start from scratch."""
+    for attempt in range(HTTP_RETRIES):
+        have = os.path.getsize(target) if os.path.exists(target) else 0
+        if end is not None and start + have > end:
+            if start + have == end + 1:
+                return digest         # The range is already complete
+            have = 0                  # More than the range - start over
+
+        request_headers = dict(headers or {})
+        if start + have > 0 or end is not None:
+            request_headers['Range'] = f"bytes={start + have}-{'' if end is None else end}"
+            if have > 0 and source is not None and source.etag:
+                # The rest of the same file, or the whole file if it has changed
+                request_headers['If-Range'] = source.etag
+
+        response = http_client.get(url, headers=request_headers, stream=True)
+        with response:
+            if source is not None and response.status_code in (200, 206):
+                source.update(response)
+            if response.status_code == 206 and _content_range_start(response) == start + have:
+                mode = 'ab'
+            elif response.status_code == 200 and start == 0 and end is None:
+                # The server sends the whole file - no resume
+                mode = 'wb'
+                if digest is not None and have > 0:
+                    digest = hashlib.sha256()
+            elif response.status_code == 200:
+                raise RangeNotSupported(f"Server does not support range requests for {url}")
+            elif response.status_code == 416 and have > 0:
+                # Leftovers that do not fit the file - start over
+                os.remove(target)
+                if digest is not None:
+                    digest = hashlib.sha256()
+                continue
+            else:
+                raise Exception(f"Failed to download {target}. Status code: {response.status_code}")
+
+            try:
+                with open(target, mode) as f:
+                    for chunk in response.iter_content(chunk_size=http_client.DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        metrics.DOWNLOADED_BYTES.inc(len(chunk))
+                        if digest is not None:
+                            digest.update(chunk)
+                return digest
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == HTTP_RETRIES - 1:
+                    raise
+                logger.debug(f"Downloading {target} interrupted at {os.path.getsize(target)} bytes: {e}")
+                if digest is not None:
+                    # Resume with a digest of exactly the bytes that made it to the disk
+                    digest = _sha256_of_file(target)
+
+        delay = http_client.backoff_delay(attempt)
+        logger.debug(f"Resuming in {delay:.1f}s...")
+        time.sleep(delay)
+
+    raise Exception(f"Failed to download {target}.")
+
+def _download_segments(url, part_file, headers, size, segments, source=None):
+    """Downloads 'size' bytes of 'url' in parallel range segments and joins them into 'part_file'.
+    Returns the SHA-256 digest of the joined file."""
+    segment_size = -(-size // segments)
+    ranges = [(i, i * segment_size, min(size, (i + 1) * segment_size) - 1) for i in range(segments)]
+    segment_files = [f"{part_file}.{i}" for i, _, _ in ranges]
+
+    with ThreadPoolExecutor(max_workers=segments, thread_name_prefix="download") as executor:
+        futures = [executor.submit(_download_range, url, segment_files[i], headers, start, end, None, source)
+                   for i, start, end in ranges]
+        for future in futures:
+            future.result()
+
+    digest = hashlib.sha256()
+    with open(part_file, 'wb') as out:
+        for segment_file in segment_files:
+            with open(segment_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    out.write(chunk)
+                    digest.update(chunk)
+    for segment_file in segment_files:
+        os.remove(segment_file)
+    return digest
+
+def download_file(url, filename, headers=None, expected_size=None, expected_sha256=None,
+                  segments=DOWNLOAD_SEGMENTS, segment_min_size=DOWNLOAD_SEGMENT_MIN_SIZE):
+    """Downloads 'url' into 'filename' through a resumable '.part' file. Files of at least
+    'segment_min_size' bytes (when the size is known) are downloaded in parallel segments.
+    The size and the SHA-256 are verified before the file is renamed into place.
+    A file already under 'filename' (e.g. put back by a rolled back build) is kept if the
+    SHA-256 is given and the file matches it.
+    Returns the SHA-256 hex digest of the file."""
+    if expected_sha256 and os.path.exists(filename):
+        sha256 = _sha256_of_file(filename).hexdigest()
+        if (expected_size is None or os.path.getsize(filename) == expected_size) and sha256 == expected_sha256.lower():
+            logger.debug(f"{filename} already downloaded")
+            return sha256
+        os.remove(filename)
+
+    part_file = filename + ".part"
+    source = _PartSource(part_file, url)
+    source.claim([part_file] + [f"{part_file}.{i}" for i in range(max(segments, DOWNLOAD_SEGMENTS))])
+    segment_files_exist = os.path.exists(part_file + ".0")
+
+    digest = None
+    if expected_size and segments > 1 and (expected_size >= segment_min_size or segment_files_exist):
+        # The redirect to the download host is resolved once, not separately by every segment
+        download_url = http_client.resolve_redirect(url, headers=headers)
+        try:
+            digest = _download_segments(download_url, part_file, headers, expected_size, segments, source)
+        except RangeNotSupported as e:
+            logger.debug(f"{e} - downloading in one piece")
+            for i in range(segments):
+                if os.path.exists(f"{part_file}.{i}"):
+                    os.remove(f"{part_file}.{i}")
+
+    if digest is None:
+        digest = _sha256_of_file(part_file) if os.path.exists(part_file) else hashlib.sha256()
+        if os.path.exists(part_file) and os.path.getsize(part_file) > 0:
+            logger.debug(f"Resuming download of {filename} from {os.path.getsize(part_file)} bytes")
+        digest = _download_range(url, part_file, headers, digest=digest, source=source)
+
+    sha256 = digest.hexdigest()
+    size = os.path.getsize(part_file)
+    if (expected_size is not None and size != expected_size) or (expected_sha256 and sha256 != expected_sha256.lower()):
+        os.remove(part_file)
+        source.remove()
+        raise Exception(f"Verification of {filename} failed: size {size} (expected {expected_size}), "
+                        f"sha256 {sha256} (expected {expected_sha256 or 'unknown'})")
+
+    os.replace(part_file, filename)
+    source.remove()
+    return sha256
@@ -0,0 +1,95 @@
+import json
+import os
+import threading
+
+from config import *
+
+ETAG_CACHE_FILE_NAME = "etag_cache.json"
+
+# Cached validators: URL -> {"etag": ..., "last_modified": ...}
+_cache = {}
+_cache_file = None
+_cache_dirty = False
+_lock = threading.Lock()
+
+# Conditional request statistics of the current cycle
+_hits = 0
+_misses = 0
+
+
+def initialize_etag_cache(data_dir, file_name=ETAG_CACHE_FILE_NAME):
+    """Loads the ETag/Last-Modified cache stored next to the installed versions database.
+    Every worker sharing the data directory has its own cache file."""
+    global _cache, _cache_file, _cache_dirty
+
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    _cache_file = os.path.join(data_dir, file_name)
+    _cache = {}
+    _cache_dirty = False
+    if os.path.exists(_cache_file):
+        try:
+            with open(_cache_file, 'r') as f:
+                _cache = json.load(f)
+        except (OSError, ValueError):
+            # A broken cache only costs one full request per URL - start from scratch
+            logger.warning(f"Could not read {_cache_file} - starting with an empty ETag cache")
+            _cache = {}
+    return _cache_file
+
+def conditional_headers(url):
+    """Returns the If-None-Match/If-Modified-Since headers for 'url', if it has been fetched before."""
+    with _lock:
+        validators = _cache.get(url)
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+def store_validators(url, etag, last_modified):
+    """Stores the validators of 'url'. Call only once the response has been fully handled,
+    otherwise a failed release would be skipped as 'not modified' on the next cycle."""
+    global _cache_dirty
+    if not etag and not last_modified:
+        return
+    with _lock:
+        _cache[url] = {'etag': etag, 'last_modified': last_modified}
+        _cache_dirty = True
+
+def save_etag_cache():
+    """Writes the cache to disk if it has changed."""
+    global _cache_dirty
+    if _cache_file is None:
+        return
+    with _lock:
+        if not _cache_dirty:
+            return
+        temp_file = _cache_file + ".tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(_cache, f, indent=1, sort_keys=True)
+        os.replace(temp_file, _cache_file)
+        _cache_dirty = False
+
+def count_etag_response(not_modified):
+    """Counts a conditional request as a hit (304 Not Modified) or a miss."""
+    global _hits, _misses
+    with _lock:
+        if not_modified:
+            _hits += 1
+        else:
+            _misses += 1
+
+def reset_etag_stats():
+    global _hits, _misses
+    with _lock:
+        _hits = 0
+        _misses = 0
+
+def get_etag_stats():
+    """Returns (hits, misses) of the current cycle."""
+    with _lock:
+        return _hits, _misses
@@ -0,0 +1,278 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from synthetic_apk import write_synthetic_apk
+
+# Local stand-in of the parts of the GitHub REST API the application uses, for the
+# benchmarks (bench_pipeline.py) and for trying things out without a token:
+#
+#   GET /repos/<owner>/<repo>/releases/latest       - with ETag / If-None-Match (304)
+#   GET /repos/<owner>/<repo>/releases?per_page=&page= - newest first, with a Link header
+#   GET /repos/<owner>/<repo>/releases/<id>         - a release by its id
+#   GET /repos/<owner>/<repo>/releases/assets/<id>  - redirects to the download URL
+#   GET /downloads/<id>/<name>                      - the APK, with Range and If-Range support
+#   POST /graphql                                   - the latest releases of the repositories
+#                                                     queried as in githubber.latest_releases_graphql()
+#
+# Releases are added with add_release(), which generates a synthetic APK for the asset.
+# Point the application to the server with APUB_GITHUB_API_URL=<FakeGitHub.url>.
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class FakeGitHub:
+    """The releases of fake repositories served over HTTP on localhost."""
+
+    def __init__(self, asset_dir, latency=0.0, download_latency=0.0):
+        self.asset_dir = asset_dir
+        self.latency = latency      # seconds added to every API response, like a round trip to GitHub
+        self.download_latency = download_latency    # seconds before a download starts
+        self.lock = threading.Lock()
+        self.releases = {}          # repo -> list of release dicts, newest first
+        self.assets = {}            # asset id -> (path, name)
+        self.request_counts = {}    # kind of request -> count
+        self.next_id = 1
+        self.server = None
+        self.url = None
+
+    def start(self, host="127.0.0.1", port=0):
+        handler = type("FakeGitHubHandler", (_FakeGitHubHandler,), {"github": self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, name="fake-github", daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def _new_id(self):
+        with self.lock:
+            new_id = self.next_id
+            self.next_id += 1
+        return new_id
+
+    def add_release(self, repo, tag, package, version_name, version_code, apk_size=1024 * 1024,
+                    name=None, body="- Bug fixes\n- Improvements", published_at=None, asset_name=None, prerelease=False):
+        """Adds a release with a generated APK as its asset (named '<package>-<version name>.apk'
+        by default). A prerelease is listed, but not the latest release. Returns the release dict."""
+        asset_id = self._new_id()
+        apk_name = asset_name or f"{package}-{version_name}.apk"
+        path = os.path.join(self.asset_dir, f"{asset_id}-{apk_name}")
+        write_synthetic_apk(path, package, version_name, version_code, package.split(".")[-1].capitalize(), size=apk_size)
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+        release_id = self._new_id()
+        release = {
+            "id": release_id,
+            "name": name or tag,
+            "tag_name": tag,
+            "published_at": published_at or time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "body": body,
+            "draft": False,
+            "prerelease": prerelease,
+            "html_url": f"https://github.com/{repo}/releases/tag/{tag}",
+            "assets": [{
+                "id": asset_id,
+                "url": f"{self.url}/repos/{repo}/releases/assets/{asset_id}",
+                "browser_download_url": f"{self.url}/downloads/{asset_id}/{apk_name}",
+                "name": apk_name,
+                "size": os.path.getsize(path),
+                "digest": f"sha256:{digest.hexdigest()}",
+            }],
+        }
+        with self.lock:
+            self.assets[asset_id] = (path, apk_name)
+            self.releases.setdefault(repo, []).insert(0, release)
+        return release
+
+    def count(self, kind):
+        with self.lock:
+            self.request_counts[kind] = self.request_counts.get(kind, 0) + 1
+
+
+class _FakeGitHubHandler(BaseHTTPRequestHandler):
+    github = None
+    protocol_version = "HTTP/1.1"   # Keep-alive, like api.github.com
+
+    ROUTES = [
+        (re.compile(r"^/repos/([^/]+/[^/]+)/releases/latest$"), "latest"),
+        (re.compile(r"^/repos/([^/]+/[^/]+)/releases$"), "releases"),
+        (re.compile(r"^/repos/([^/]+/[^/]+)/releases/(\d+)$"), "release"),
+        (re.compile(r"^/repos/([^/]+/[^/]+)/releases/assets/(\d+)$"), "asset"),
+        (re.compile(r"^/downloads/(\d+)/[^/]+$"), "download"),
+    ]
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        for pattern, kind in self.ROUTES:
+            match = pattern.match(url.path)
+            if match:
+                self.github.count(kind)
+                delay = self.github.download_latency if kind == "download" else self.github.latency
+                if delay:
+                    time.sleep(delay)
+                return getattr(self, f"_{kind}")(*match.groups(), query=parse_qs(url.query))
+        self.github.count("not_found")
+        self._send_json(404, {"message": "Not Found"})
+
+    # The repositories of a GraphQL query: "<alias>: repository(owner: $<variable>, name: $<variable>)"
+    GRAPHQL_REPOSITORY = re.compile(r"(\w+): repository\(owner: \$(\w+), name: \$(\w+)\)")
+    GRAPHQL_ASSETS = re.compile(r"releaseAssets\(first: (\d+)\)")
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/graphql":
+            self.github.count("not_found")
+            return self._send_json(404, {"message": "Not Found"})
+        self.github.count("graphql")
+        if self.github.latency:
+            time.sleep(self.github.latency)
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", "0"))))
+            query, variables = request["query"], request.get("variables") or {}
+        except (ValueError, KeyError, TypeError):
+            return self._send_json(400, {"message": "Problems parsing JSON"})
+
+        match = self.GRAPHQL_ASSETS.search(query)
+        max_assets = int(match.group(1)) if match else 100
+        data = {}
+        errors = []
+        for alias, owner, name in self.GRAPHQL_REPOSITORY.findall(query):
+            repo = f"{variables.get(owner)}/{variables.get(name)}"
+            with self.github.lock:
+                known = repo in self.github.releases
+            if not known:
+                data[alias] = None
+                errors.append({"type": "NOT_FOUND", "path": [alias],
+                               "message": f"Could not resolve to a Repository with the name '{repo}'."})
+                continue
+            releases = [release for release in self._releases_of(repo) if not release["prerelease"]]
+            data[alias] = {"latestRelease": self._graphql_release(releases[0], max_assets) if releases else None}
+        self._send_json(200, {"data": data, "errors": errors} if errors else {"data": data},
+                        {"X-RateLimit-Resource": "graphql"})
+
+    @staticmethod
+    def _graphql_release(release, max_assets):
+        return {
+            "databaseId": release["id"],
+            "name": release["name"],
+            "tagName": release["tag_name"],
+            "publishedAt": release["published_at"],
+            "description": release["body"],
+            "url": release["html_url"],
+            "releaseAssets": {"nodes": [{"name": asset["name"], "size": asset["size"], "downloadUrl": asset["browser_download_url"]}
+                                        for asset in release["assets"][:max_assets]]},
+        }
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-RateLimit-Limit", "5000")
+        self.send_header("X-RateLimit-Remaining", "4999")
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        if "X-RateLimit-Resource" not in (headers or {}):
+            self.send_header("X-RateLimit-Resource", "core")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _releases_of(self, repo):
+        with self.github.lock:
+            return list(self.github.releases.get(repo, []))
+
+    def _latest(self, repo, query):
+        releases = [release for release in self._releases_of(repo) if not release["prerelease"]]
+        if not releases:
+            return self._send_json(404, {"message": "Not Found"})
+        etag = f'"{releases[0]["id"]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self._send_json(200, releases[0], {"ETag": etag})
+
+    def _release(self, repo, release_id, query):
+        for release in self._releases_of(repo):
+            if release["id"] == int(release_id):
+                return self._send_json(200, release)
+        self._send_json(404, {"message": "Not Found"})
+
+    def _releases(self, repo, query):
+        releases = self._releases_of(repo)
+        per_page = int(query.get("per_page", ["30"])[0])
+        page = int(query.get("page", ["1"])[0])
+        headers = {}
+        if page * per_page < len(releases):
+            headers["Link"] = f'<{self.github.url}/repos/{repo}/releases?per_page={per_page}&page={page + 1}>; rel="next"'
+        self._send_json(200, releases[(page - 1) * per_page:page * per_page], headers)
+
+    def _asset(self, repo, asset_id, query):
+        with self.github.lock:
+            asset = self.github.assets.get(int(asset_id))
+        if asset is None:
+            return self._send_json(404, {"message": "Not Found"})
+        self.send_response(302)
+        self.send_header("Location", f"{self.github.url}/downloads/{asset_id}/{asset[1]}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _download(self, asset_id, query):
+        with self.github.lock:
+            asset = self.github.assets.get(int(asset_id))
+        if asset is None:
+            return self._send_json(404, {"message": "Not Found"})
+        path = asset[0]
+        size = os.path.getsize(path)
+        stat = os.stat(path)
+        etag = f'"{asset_id}-{stat.st_size}-{stat.st_mtime_ns}"'
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range") not in (None, etag):
+            match = None    # The file has changed - sent whole
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.android.package-archive")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(remaining, HASH_CHUNK_SIZE))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def log_message(self, format, *args):
+        pass
@@ -1,95 +1,105 @@
 import datetime
 import os
+import re
 import shutil
 import subprocess
-import zipfile
+import tempfile
 
 from config import *
+from apk_cache import sha256_of_file
+from backup_store import create_snapshot, apply_retention
+from metadata_index import get_metadata_index
+from asset_store import SCREENSHOT_EXTENSIONS, sample_screenshots, sample_screenshot_digests
+from tracing import traced
 
-def add_apk_to_fdroid(filename, apk_versionName, apk_versionCode, apk_packageName, apk_application, html_url, relnotes):
-    """Adds the APK file to F-Droid build directory and updates the metadata."""
-    
-    # Check if packageName subdirectory exits in the fdroid metadata directory
-    packageName_subdirectory = os.path.join(BUILD_METADATA_DIR, apk_packageName)
-    if not os.path.exists(packageName_subdirectory):
-        logger.debug(f"Creating directory {packageName_subdirectory} and subdirectories")
-        os.makedirs(packageName_subdirectory)
-    else:
-        logger.debug(f"Directory {packageName_subdirectory} exists")
-
-    # Check (& create if needed) the rest of the packageName subdirectories
-    enUS_subdirectory = os.path.join(packageName_subdirectory, "en-US")
-    if not os.path.exists(enUS_subdirectory):
-        os.makedirs(enUS_subdirectory)
-    changelog_subdirectory = os.path.join(enUS_subdirectory, "changelog")
-    if not os.path.exists(changelog_subdirectory):
-        os.makedirs(changelog_subdirectory)
-    screenshots_subdirectory = os.path.join(enUS_subdirectory, "phoneScreenshots")
-    if not os.path.exists(screenshots_subdirectory):
-        os.makedirs(screenshots_subdirectory)
-        # Copy sample screenshots the created directory
-        for sample_screenshot in os.listdir(DATA_DIR):
-            if sample_screenshot.lower().endswith(('.jpg', '.png')):
-                src = os.path.join(DATA_DIR, sample_screenshot)
-                dst = os.path.join(screenshots_subdirectory, sample_screenshot)
-                if not os.path.exists(dst):
-                    logger.debug(f"Copying {src} to {dst}")
-                    shutil.copy(src, dst)
-
-    # Add release notes to the changelog file, if it does not exist
-    changelog_file = os.path.join(changelog_subdirectory, f"{apk_versionCode}.txt")
-    if not os.path.exists(changelog_file):
-        with open(changelog_file, 'w') as f:
-            f.write(f"{relnotes}\n")
-
-    # Check if packageName.yml file exits in the fdroid metadata directory
-    packageName_yml_file = os.path.join(BUILD_METADATA_DIR, apk_packageName+".yml")
-
-    if not os.path.exists(packageName_yml_file):
-        logger.debug(f"Creating draft {packageName_yml_file} file")
-        with open(packageName_yml_file, 'w') as f:
-            f.write(f"AuthorName: 'Brady'\n")
-            f.write(f"Categories:\n- TestAppCenter\n")
-            f.write(f"CurrentVersionCode: {apk_versionCode}\n")
-            f.write(f"Name: {apk_application}\n")
-            f.write(f"SourceCode: '{html_url}'\n")
-            f.write(f"Summary: '{apk_application} ({apk_packageName}).'\n")
-            f.write(f"Description: 'Development release of {apk_application}.'\n")
-            f.write(f"License: proprietary\n")
-            
-    else:
-        # Update the yml file with the new version code
-        logger.debug(f"File {packageName_yml_file} exists. Updating it with the new version code.")
-        temp_yml_file = packageName_yml_file + ".tmp"
-
-        with open(packageName_yml_file, "r") as infile:
-            with open(temp_yml_file, "w") as outfile:
-                for line in infile:
-                    # Check if the line contains the version code
-                    if "CurrentVersionCode:" in line:
-                        new_line = f'CurrentVersionCode: {str(apk_versionCode)}\n'
-                        outfile.write(new_line)
-                    else:
-                        outfile.write(line)
-
-        ## Sanity check - not used for now
-        # org_size = os.path.getsize(packageName_yml_file)
-        # new_size = os.path.getsize(temp_yml_file)
-        # margin = 5 # just in case if original file had some extra whitespace
-        # if (new_size + margin < org_size):
-        #     raise Exception(f"Something bad happened in converting {packageName_yml_file} to {temp_yml_file}")
-
-        # Replace the original yml file with the updated temp file
-        os.replace(temp_yml_file, packageName_yml_file)
-        logger.debug(f"Successfully updated {packageName_yml_file} with the new version code {apk_versionCode}")
+class StagingJournal:
+    """Records the changes staging a release makes to the build directory, so that they can
+    be undone if the build fails. A file about to be replaced is first hardlinked (or copied)
+    to BUILD_STAGING_DIR - files are always replaced as a whole, never modified in place."""
+
+    def __init__(self):
+        self.entries = []       # (path, backup): backup None = the file did not exist, "" = a created directory
+        self.backup_dir = None
+
+    def will_create_dir(self, path):
+        """Call before creating the directory 'path'."""
+        if not os.path.exists(path):
+            self.entries.append((path, ""))
+
+    def will_write(self, path):
+        """Call before creating or replacing the file 'path'."""
+        if not os.path.exists(path):
+            self.entries.append((path, None))
+            return
+        if self.backup_dir is None:
+            os.makedirs(BUILD_STAGING_DIR, exist_ok=True)
+            self.backup_dir = tempfile.mkdtemp(prefix="journal_", dir=BUILD_STAGING_DIR)
+        backup = os.path.join(self.backup_dir, str(len(self.entries)))
+        _link_or_copy(path, backup)
+        self.entries.append((path, backup))
+
+    def rollback(self):
+        """Restores the replaced files and removes the created files and (empty) directories."""
+        for path, backup in reversed(self.entries):
+            if backup == "":
+                if os.path.isdir(path) and not os.listdir(path):
+                    os.rmdir(path)
+            elif backup is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                os.replace(backup, path)
+            logger.debug(f"Rolled back {path}")
+        self.commit()
+
+    def commit(self):
+        """Keeps the changes and discards the backups."""
+        if self.backup_dir is not None:
+            shutil.rmtree(self.backup_dir, ignore_errors=True)
+        self.entries = []
+        self.backup_dir = None
+
+@traced()
+def add_apk_to_fdroid(filename, apk_versionName, apk_versionCode, apk_packageName, apk_application, html_url, relnotes, journal=None, index=None,
+                      keep_source=False):
+    """Adds the APK file to F-Droid build directory and updates the metadata.
+    The changes are recorded in 'journal' (StagingJournal), if given, to be rolled back on failure.
+    The metadata changes are only queued to 'index' (MetadataIndex) - they are written by
+    index.flush(), which is done here if no journal is given. With 'keep_source' the APK
+    file is linked (or copied), not moved, so that a rollback leaves it where it was."""
+
+    own_journal = journal is None
+    if own_journal:
+        journal = StagingJournal()
+    if index is None:
+        index = get_metadata_index()
 
+    # Sample screenshots for a package without screenshots - DATA_DIR is scanned only once
+    entry = index.get(apk_packageName)
+    screenshots = sample_screenshots() if entry is None or not entry.has_screenshots else []
 
     # Move the APK file to the fdroid repo directory
     destination_apk_path = os.path.join(BUILD_REPO_DIR, os.path.basename(filename))
     # 'rename' raises exception if the file already exists, 'replace' does not
-    os.replace(filename, destination_apk_path)
-    logger.debug(f"Moved APK file to {destination_apk_path}")
+    journal.will_write(destination_apk_path)
+    if keep_source:
+        if os.path.exists(destination_apk_path):
+            os.remove(destination_apk_path)
+        _link_or_copy(filename, destination_apk_path)
+        logger.debug(f"Linked APK file to {destination_apk_path}")
+    else:
+        os.replace(filename, destination_apk_path)
+        logger.debug(f"Moved APK file to {destination_apk_path}")
+
+    # Changelog and version code in the packageName.yml file
+    index.add_release(apk_packageName, apk_versionCode, apk_application, html_url, relnotes, journal, screenshots)
+    logger.debug(f"Metadata of {apk_packageName} updated with the new version code {apk_versionCode}")
 
+    if own_journal:
+        index.flush()
+        journal.commit()
+
+@traced("update_fdroid")
 def update_fdroid_Linux():
     """Runs the 'fdroid update' command. NOTE: This works only in Linux."""
 
@@ -103,26 +113,22 @@ def update_fdroid_Linux():
         logger.debug(f"F-Droid build directory {BUILD_DIR} does not exist.")
         raise Exception(f"BUILD_DIR {BUILD_DIR} does not exist - cannot proceed.")
 
-    # Change to the F-Droid build directory
-    os.chdir(BUILD_DIR)
-
-    # Run the fdroid build command
+    # Run the fdroid build command in the F-Droid build directory
+    # (not with os.chdir - the working directory is shared by all the threads of the process)
     # os.system("fdroid update")  # Update the repository
     try:
-        result = subprocess.run(["fdroid", "update"], check=True, text=True, capture_output=True)
-        logger.debug("Command output:", result.stdout)
+        result = subprocess.run(["fdroid", "update"], cwd=BUILD_DIR, check=True, text=True, capture_output=True)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Command output: {result.stdout[-LOG_MAX_PAYLOAD:]}")
     except subprocess.CalledProcessError as e:
         logger.debug("Error occurred while running 'fdroid update'")
-        os.chdir(ROOT_DIR)
-        raise Exception(f"Error occurred while running 'fdroid update':", e.stderr)
-
-    # Change back to the original directory
-    os.chdir(ROOT_DIR)
+        raise Exception(f"Error occurred while running 'fdroid update': {e.stderr}")
 
     logger.debug("F-Droid repository built successfully.")
 
-def backup_and_copy_build_to_run_environment():
-    """Backs up the current run environment and copies build repo directory it to the run environment."""
+@traced()
+def backup_run_environment():
+    """Backs up the current run environment as a snapshot in the content-addressed backup store."""
 
     # Check if the run directores exists
     if not os.path.exists(RUN_REPO_DIR):
@@ -132,26 +138,145 @@ def backup_and_copy_build_to_run_environment():
         logger.debug(f"Run backup directory {RUN_BACKUP_DIR} does not exist - creating it.")
         os.makedirs(RUN_BACKUP_DIR)
 
-    # Zip the contents of current RUN_REPO_DIR
-    datetime_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    zip_filename = f"repo_{datetime_str}.zip"
-    zip_filepath = os.path.join(RUN_BACKUP_DIR, zip_filename)
+    # Snapshot of the current RUN_REPO_DIR - only files not in the store yet are added
+    snapshot, new_objects = create_snapshot(RUN_REPO_DIR, RUN_BACKUP_DIR)
+    logger.debug(f"Created backup snapshot {snapshot} of the run environment ({new_objects} new files)")
 
-    logger.debug(f"Creating backup zip of the run environment: {zip_filepath}")
+    removed, removed_objects = apply_retention(RUN_BACKUP_DIR)
+    if removed:
+        logger.debug(f"Removed {len(removed)} old backup snapshots and {removed_objects} unreferenced files")
 
-    with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(RUN_REPO_DIR):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, RUN_REPO_DIR)
-                zipf.write(file_path, arcname)
-   
-    # Empty the run repo directory
-    shutil.rmtree(RUN_REPO_DIR)
+def _same_file_content(path_a, path_b, stat_a, stat_b):
+    """Compares two files by size and mtime - by content if only the mtime differs."""
+    if stat_a.st_size != stat_b.st_size:
+        return False
+    if stat_a.st_mtime_ns == stat_b.st_mtime_ns:
+        return True
+    return sha256_of_file(path_a) == sha256_of_file(path_b)
 
-    # Copy the build repo directory to the run environment
-    logger.debug(f"Copying build repo to the run environment: {RUN_REPO_DIR}")
-    shutil.copytree(BUILD_REPO_DIR, RUN_REPO_DIR)
+def _link_or_copy(src, dst):
+    """Hardlinks 'src' to 'dst', or copies it if hardlinks are not possible (e.g. another file system)."""
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        shutil.copy2(src, dst)
+        return False
 
-    logger.debug(f"Backup and copy of build to run environment completed successfully.")
+def build_run_tree(build_dir, current_dir, new_dir):
+    """Populates 'new_dir' with the contents of 'build_dir'. Files that have not changed since
+    'current_dir' was deployed, and all the APKs (they are never modified in place), are
+    hardlinked - only new and changed files are copied. Files hardlinked to each other in
+    'build_dir' stay linked to each other in 'new_dir', and so do the copies of the sample
+    screenshots (found by content - 'fdroid update' writes copies of its own).
+    Returns (linked, copied) counts."""
+    linked = copied = 0
+    deployed_inodes = {}    # (device, inode) of a multiply linked build file -> its path in new_dir
+    deployed_samples = {}   # digest of a sample screenshot -> its first copy in new_dir
+    try:
+        sample_digests = sample_screenshot_digests()
+    except OSError:
+        sample_digests = {}
+    for root, dirs, files in os.walk(build_dir):
+        relative_root = os.path.relpath(root, build_dir)
+        os.makedirs(os.path.join(new_dir, relative_root), exist_ok=True)
+        for file in files:
+            src = os.path.join(root, file)
+            dst = os.path.join(new_dir, relative_root, file)
+            current = os.path.join(current_dir, relative_root, file) if current_dir else None
+            src_stat = os.stat(src)
+            inode = (src_stat.st_dev, src_stat.st_ino)
+            if src_stat.st_nlink > 1 and inode in deployed_inodes and _link_or_copy(deployed_inodes[inode], dst):
+                linked += 1
+                continue
+            if src_stat.st_nlink > 1:
+                deployed_inodes[inode] = dst
+            if src_stat.st_size in sample_digests and file.lower().endswith(SCREENSHOT_EXTENSIONS):
+                digest = sha256_of_file(src)
+                if digest in sample_digests[src_stat.st_size]:
+                    if digest in deployed_samples and _link_or_copy(deployed_samples[digest], dst):
+                        linked += 1
+                        continue
+                    deployed_samples.setdefault(digest, dst)
+            if current and os.path.isfile(current) and _same_file_content(src, current, src_stat, os.stat(current)):
+                if _link_or_copy(current, dst):
+                    linked += 1
+                else:
+                    copied += 1
+            elif file.lower().endswith(".apk") and _link_or_copy(src, dst):
+                linked += 1
+            else:
+                shutil.copy2(src, dst)
+                copied += 1
+    return linked, copied
+
+def _switch_run_repo(new_dir):
+    """Points the RUN_REPO_DIR symlink to 'new_dir'. The switch is atomic: the served
+    repo is always either the old or the new tree, never a partially populated one."""
+    temp_link = RUN_REPO_DIR + ".new"
+    if os.path.lexists(temp_link):
+        os.remove(temp_link)
+    os.symlink(os.path.relpath(new_dir, os.path.dirname(RUN_REPO_DIR)), temp_link, target_is_directory=True)
+    os.replace(temp_link, RUN_REPO_DIR)
+
+# A completed tree in RUN_RELEASES_DIR - 'repo_<timestamp>.tmp' is a tree still being built
+RUN_RELEASE_NAME = re.compile(r"^repo_\d{8}_\d{6}(_\d{6})?$")
+
+def _prune_run_releases(current_dir):
+    """Removes the oldest deployed trees, keeping RUN_RELEASES_KEEP of them (and always the current one),
+    and the trees left over by deployments that did not complete."""
+    entries = os.listdir(RUN_RELEASES_DIR)
+    for leftover in entries:
+        if leftover.startswith("repo_") and leftover.endswith(".tmp"):
+            logger.debug(f"Removing incomplete run environment tree {leftover}")
+            shutil.rmtree(os.path.join(RUN_RELEASES_DIR, leftover), ignore_errors=True)
+    releases = sorted(entry for entry in entries if RUN_RELEASE_NAME.match(entry))
+    current = os.path.basename(current_dir)
+    for release in releases[:-RUN_RELEASES_KEEP] if RUN_RELEASES_KEEP > 0 else releases:
+        if release != current:
+            logger.debug(f"Removing old run environment tree {release}")
+            shutil.rmtree(os.path.join(RUN_RELEASES_DIR, release))
+
+@traced()
+def deploy_build_to_run_environment():
+    """Deploys the build repo as a new run environment tree and switches RUN_REPO_DIR to it."""
+
+    # Testing in Windows - symlinks need special privileges, copy the whole build repo instead
+    if (os.name == 'nt'):
+        if os.path.exists(RUN_REPO_DIR):
+            shutil.rmtree(RUN_REPO_DIR)
+        shutil.copytree(BUILD_REPO_DIR, RUN_REPO_DIR)
+        return
+
+    os.makedirs(RUN_RELEASES_DIR, exist_ok=True)
+
+    # First deployment with the symlink layout - the existing run repo directory becomes the first tree
+    if os.path.isdir(RUN_REPO_DIR) and not os.path.islink(RUN_REPO_DIR):
+        initial_dir = os.path.join(RUN_RELEASES_DIR, "repo_00000000_000000")
+        logger.info(f"Moving run repo directory {RUN_REPO_DIR} to {initial_dir} and replacing it with a symlink")
+        os.rename(RUN_REPO_DIR, initial_dir)
+        _switch_run_repo(initial_dir)
 
+    current_dir = os.path.realpath(RUN_REPO_DIR) if os.path.islink(RUN_REPO_DIR) else None
+
+    datetime_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    new_dir = os.path.join(RUN_RELEASES_DIR, f"repo_{datetime_str}")
+    temp_dir = new_dir + ".tmp"
+    if os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
+
+    logger.debug(f"Deploying build repo to {new_dir}")
+    linked, copied = build_run_tree(BUILD_REPO_DIR, current_dir, temp_dir)
+    os.rename(temp_dir, new_dir)
+    _switch_run_repo(new_dir)
+    logger.debug(f"Run environment switched to {new_dir} ({linked} files linked, {copied} copied)")
+
+    _prune_run_releases(new_dir)
+
+def backup_and_copy_build_to_run_environment():
+    """Backs up the current run environment and deploys the build repo directory as the new run environment."""
+
+    backup_run_environment()
+    deploy_build_to_run_environment()
+
+    logger.debug(f"Backup and copy of build to run environment completed successfully.")
@@ -1,55 +1,239 @@
+import hashlib
 import json
 import os
 import re
-import subprocess
-import time
-import requests
+import threading
 
 from config import *
+import downloader
+import etag_cache
+import http_client
+from poll_scheduler import release_timestamp
+from rate_limiter import RateLimiter
+from tracing import traced
 
 def initialize_githubber():
     global token
     token = os.environ['GITHUB_TOKEN']
+    http_client.initialize_http_client(token, rate_limiter=RateLimiter(POLL_INTERVAL))
 
-def communicate(url):
-    """Communicates with the GitHub API to fetch release data."""
-    for retry in range(3):
-        if (os.name == 'nt'):   # Testing in Windows
-            proc = subprocess.Popen(['curl', '-H' 'Authorization: token {}'.format(token), url], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        else:                   # Running in Linux
-            proc = subprocess.Popen(['/usr/bin/curl', '-H' 'Authorization: token {}'.format(token), url], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        stdout, stderr = proc.communicate()
-        if proc.returncode == 0:
-            try:
-                return json.loads(stdout.decode('utf-8'))
-            except:
-                pass
-        if retry < 2:
-            logger.debug('curl: ' + stderr.decode('utf-8'))
-            time.sleep(10)
-            logger.debug('Retrying...')
-    logger.debug('curl: ' + stderr.decode('utf-8'))
+# Returned by getRelease when the release has not changed since it was last checked
+RELEASE_NOT_MODIFIED = "not modified"
 
+# Validators of responses that are not yet fully handled: URL -> (ETag, Last-Modified)
+_pending_validators = {}
+_pending_lock = threading.Lock()
 
+def communicate(url, conditional=False):
+    """Communicates with the GitHub API to fetch release data.
+    With 'conditional' the cached ETag/Last-Modified of the URL is sent and
+    RELEASE_NOT_MODIFIED is returned if GitHub answers 304 Not Modified."""
+    headers = etag_cache.conditional_headers(url) if conditional else None
+    response = http_client.get(url, headers=headers)
+    if conditional:
+        etag_cache.count_etag_response(response.status_code == 304)
+        if response.status_code == 304:
+            return RELEASE_NOT_MODIFIED
+    if response.status_code == 200:
+        try:
+            data = response.json()
+        except ValueError:
+            logger.debug(f"Invalid JSON in response from {url}")
+            return None
+        if conditional:
+            with _pending_lock:
+                _pending_validators[url] = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return data
+    if logger.isEnabledFor(logging.DEBUG):     # The body of an error response can be long
+        logger.debug(f"{url}: HTTP {response.status_code} {response.text[:LOG_MAX_PAYLOAD]}")
+
+def latest_release_url(repo):
+    return '{}/repos/{}/releases/latest'.format(GITHUB_API_URL, repo)
+
+def release_url(repo, release_id):
+    return '{}/repos/{}/releases/{}'.format(GITHUB_API_URL, repo, release_id)
+
+@traced("get_release")
 def getRelease(repo, version):
-    """Fetches the release data from the GitHub API."""
+    """Fetches the release data from the GitHub API.
+    The latest release is requested conditionally - see communicate()."""
     if version != 'latest':
-        rels = communicate('https://api.github.com/repos/{}/releases'.format(repo))
+        rels = communicate('{}/repos/{}/releases'.format(GITHUB_API_URL, repo))
         try:
             for rel in rels:
                 if rel['tag_name'] == version:
                     release = rel
                     break
         except:
-            logger.debug(json.dumps(rels))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(json.dumps(rels)[:LOG_MAX_PAYLOAD])
     else:
-        release = communicate('https://api.github.com/repos/{}/releases/latest'.format(repo))
+        release = communicate(latest_release_url(repo), conditional=True)
 
     return release
 
-def parse_release_data(release):
+@traced()
+def releases_since(repo, since, per_page=CATCHUP_PAGE_SIZE, max_pages=CATCHUP_MAX_PAGES):
+    """Fetches the releases of 'repo' published after 'since' (epoch seconds), newest first.
+    The release list is paged until a release published at or before 'since' is reached.
+    Drafts and prereleases are skipped, as they are by the latest release and the webhook."""
+    releases = []
+    for page in range(1, max_pages + 1):
+        rels = communicate('{}/repos/{}/releases?per_page={}&page={}'.format(GITHUB_API_URL, repo, per_page, page))
+        if not isinstance(rels, list):
+            raise Exception(f"Error in fetching page {page} of the releases of {repo}")
+        for rel in rels:
+            if rel.get('draft') or not rel.get('published_at'):
+                continue
+            if release_timestamp(rel['published_at']) <= since:
+                return releases
+            if rel.get('prerelease'):
+                continue
+            releases.append(rel)
+        if len(rels) < per_page:
+            return releases
+    logger.warning(f"{repo}: more than {max_pages * per_page} releases since the last one published - "
+                   f"catching up only the newest {len(releases)}")
+    return releases
+
+# The GraphQL backend (POLL_BACKEND = "graphql"): the latest releases of many repositories in one
+# query, converted to the structure of the REST API. GraphQL has no conditional requests - a hash
+# of the release stands for its ETag, so that an unchanged release is skipped just the same.
+# GraphQL has only the browser download URLs of the assets (public repositories only) and no
+# digests: a release that has changed is fetched once more from the REST API, for the API URLs
+# of its assets and their digests, so that private repositories and verification work as with
+# the REST backend.
+
+GRAPHQL_RELEASE_FIELDS = '''latestRelease {
+    databaseId
+    name
+    tagName
+    publishedAt
+    description
+    url
+    releaseAssets(first: %d) { nodes { name size downloadUrl } }
+  }'''
+
+def graphql_url():
+    return '{}/graphql'.format(GITHUB_API_URL)
+
+def _graphql_release_query(repos, max_assets):
+    """Returns the GraphQL query of the latest releases of 'repos' (aliases r0, r1, ...) and its variables."""
+    parameters = []
+    fields = []
+    variables = {}
+    for number, repo in enumerate(repos):
+        owner, name = repo.split('/', 1)
+        variables[f'owner{number}'] = owner
+        variables[f'name{number}'] = name
+        parameters.append(f'$owner{number}: String!, $name{number}: String!')
+        fields.append(f'  r{number}: repository(owner: $owner{number}, name: $name{number}) {{\n'
+                      f'  {GRAPHQL_RELEASE_FIELDS % max_assets}\n  }}')
+    query = 'query({}) {{\n{}\n}}'.format(', '.join(parameters), '\n'.join(fields))
+    return query, variables
+
+def _rest_release(node):
+    """Converts a release of the GraphQL API to the structure of the REST API, see parse_release_data()."""
+    return {
+        'name': node['name'],
+        'tag_name': node['tagName'],
+        'published_at': node['publishedAt'],
+        'body': node['description'] or '',
+        'html_url': node['url'],
+        'assets': [{'url': asset['downloadUrl'], 'browser_download_url': asset['downloadUrl'],
+                    'name': asset['name'], 'size': asset['size']} for asset in node['releaseAssets']['nodes']],
+    }
+
+def _release_validator(release):
+    digest = hashlib.sha256(json.dumps(release, sort_keys=True).encode('utf-8')).hexdigest()
+    return f'W/"graphql-{digest[:32]}"'
+
+@traced()
+def latest_releases_graphql(repos, max_assets=GRAPHQL_MAX_ASSETS):
+    """Fetches the latest releases of 'repos' with one GraphQL query.
+    Returns dict repo -> (release, error), the release as getRelease(repo, 'latest') returns
+    it: None if the repository has no releases, RELEASE_NOT_MODIFIED if it has not changed
+    since confirm_release_checked(). Raises an exception if the whole query fails."""
+    query, variables = _graphql_release_query(repos, max_assets)
+    response = http_client.post_json(graphql_url(), {'query': query, 'variables': variables})
+    try:
+        result = response.json() if response.status_code == 200 else None
+    except ValueError:
+        result = None
+    if not isinstance(result, dict):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{graphql_url()}: HTTP {response.status_code} {response.text[:LOG_MAX_PAYLOAD]}")
+        raise Exception(f"GraphQL query of {len(repos)} repositories failed: HTTP {response.status_code}")
+
+    # Errors of single repositories (e.g. not found) come with the data of the others
+    errors = {}
+    for error in result.get('errors') or []:
+        path = error.get('path') or [None]
+        errors.setdefault(path[0], error.get('message', 'unknown error'))
+    data = result.get('data')
+    if not data:
+        message = next(iter(errors.values()), 'no data')
+        raise Exception(f"GraphQL query of {len(repos)} repositories failed: {message}")
+
+    releases = {}
+    for number, repo in enumerate(repos):
+        alias = f'r{number}'
+        repository = data.get(alias)
+        if repository is None:
+            releases[repo] = (None, Exception(f"{repo}: {errors.get(alias, 'repository not found')}"))
+            continue
+        if repository.get('latestRelease') is None:
+            logger.debug(f"{repo}: no releases")
+            releases[repo] = (None, None)
+            continue
+
+        node = repository['latestRelease']
+        url = latest_release_url(repo)
+        validator = _release_validator(_rest_release(node))
+        not_modified = etag_cache.conditional_headers(url).get('If-None-Match') == validator
+        etag_cache.count_etag_response(not_modified)
+        if not_modified:
+            releases[repo] = (RELEASE_NOT_MODIFIED, None)
+            continue
+        release = communicate(release_url(repo, node['databaseId']))
+        if not isinstance(release, dict):
+            releases[repo] = (None, Exception(f"{repo}: error in fetching release {node['tagName']}"))
+            continue
+        with _pending_lock:
+            _pending_validators[url] = (validator, None)
+        releases[repo] = (release, None)
+    return releases
+
+def confirm_release_checked(repo):
+    """Marks the latest release of 'repo' as handled, so that it is requested
+    conditionally (and skipped if unchanged) from now on."""
+    url = latest_release_url(repo)
+    with _pending_lock:
+        validators = _pending_validators.pop(url, None)
+    if validators:
+        etag_cache.store_validators(url, *validators)
+
+def get_apk_assets(release, pattern=ASSET_PATTERN):
+    """Returns the APK assets of the release (dicts with e.g. 'url', 'name', 'size' and 'digest'):
+    the assets whose name matches 'pattern', see ASSET_PATTERN."""
+    return [asset for asset in release['assets'] if re.search(pattern, asset['name'])]
+
+def get_apk_asset(release, pattern=ASSET_PATTERN):
+    """Returns the first APK asset of the release, or None."""
+    assets = get_apk_assets(release, pattern)
+    return assets[0] if assets else None
+
+def asset_sha256(asset):
+    """Returns the SHA-256 of the asset reported by GitHub ('digest': 'sha256:<hex>'), or None."""
+    digest = asset.get('digest') or ''
+    if digest.startswith('sha256:'):
+        return digest[len('sha256:'):]
+    return None
+
+@traced()
+def parse_release_data(release, asset=None):
     """Parses the release data and returns relevant information.
+    'asset' is the APK asset to publish, by default the first one - see get_apk_assets().
     Returns:
         URL: The URL of the release asset.
         relname: The name of the release.
@@ -59,90 +243,48 @@ def parse_release_data(release):
         relnotes: The release notes.
         html_url """""
 
-    for asset in release['assets']:
-        if '.apk' in asset['name']:
+    if asset is None:
+        asset = get_apk_asset(release)
+    if asset is not None:
+        URL = asset['url'].strip()
+        relname = release['name'].strip()
+        filename = asset['name'].strip()
+        version = release['tag_name'].strip()
+        date = release['published_at'].strip()
 
-            # Pick the first asset with .apk in its name
-            # Some special handling will needed if the correct 
-            # asset is to be picked from among multiple assets
-            URL = asset['url'].strip()
-            relname = release['name'].strip()
-            filename = asset['name'].strip()
-            version = release['tag_name'].strip()
-            date = release['published_at'].strip()
+        html_url = release['html_url'].strip()
+        # Remove "releases" and everything after it
+        if "releases" in html_url:
+            html_url = html_url[:html_url.index("releases")]
 
-            html_url = release['html_url'].strip()
-            # Remove "releases" and everything after it
-            if "releases" in html_url:
-                html_url = html_url[:html_url.index("releases")]
+        relnotes = ''
+        relnote_text_to_parse = (release['body'] or '').strip()    # null for a release without notes
 
-            relnotes = ''
-            relnote_text_to_parse = release['body'].strip()
+        # Testing in Windows - convert line endings to Linux style
+        if os.name == 'nt':   
+            relnote_text_to_parse = relnote_text_to_parse.replace('\r\n', '\n')
 
-            # Testing in Windows - convert line endings to Linux style
-            if os.name == 'nt':   
-                relnote_text_to_parse = relnote_text_to_parse.replace('\r\n', '\n')
+        # Change potential asteriskes (*) into dashes (-) in the beginnings of the lines
+        # relnote_text_to_parse = relnote_text_to_parse.replace('\n*', '\n')
+        relnote_text_to_parse = re.sub('\n *\\* ', '\n- ', relnote_text_to_parse)
 
-            # Change potential asteriskes (*) into dashes (-) in the beginnings of the lines
-            # relnote_text_to_parse = relnote_text_to_parse.replace('\n*', '\n')
-            relnote_text_to_parse = re.sub('\n *\\* ', '\n- ', relnote_text_to_parse)
+        # Multiline matching lines starting with dash
+        data = re.compile(r'^ *\-.*$', re.MULTILINE) 
+        matches = data.finditer(relnote_text_to_parse)
+        for match in matches:
+            # logger.debug(match.group()) # Just printing match does not seem to print the whole match, therefore group()
+            relnotes += match.group() + "\n"
 
-            # Multiline matching lines starting with dash
-            data = re.compile(r'^ *\-.*$', re.MULTILINE) 
-            matches = data.finditer(relnote_text_to_parse)
-            for match in matches:
-                # logger.debug(match.group()) # Just printing match does not seem to print the whole match, therefore group()
-                relnotes += match.group() + "\n"
+        relnotes = relnotes.strip()
 
-            relnotes = relnotes.strip()
-
-            return URL, relname, filename, version, date, relnotes, html_url
+        return URL, relname, filename, version, date, relnotes, html_url
         
     return None, None, None, None, None, None, None
 
-# Running in Linux
-def download_Linux(url, name): 
-    """Downloads a file from a given URL using wget with authentication."""
-    for retry in range(3):
-
-        proc = subprocess.Popen(['sh', '-c', "wget -nv --header='Accept:application/octet-stream' --header='Authorization: token {}' -O {} {}".format(token, name, url)], stderr=subprocess.PIPE)
-        _, stderr = proc.communicate()
-        if proc.returncode == 0:
-            if retry > 0:
-                logger.debug('Success')
-            return
-        if retry < 2:
-            logger.debug(stderr.decode('utf-8'))
-            time.sleep(10)
-            logger.debug('Retrying...')
-    logger.debug(stderr.decode('utf-8'))
-
-# Testing in Windows
-def download_Windows(URL, filename): 
-    """Downloads a file from a given URL using requests with authentication."""
-    headers = {
-        "Accept": "application/octet-stream",
-        "Authorization": f"token {token}"
-    }
-
-    # Send the GET request
-    response = requests.get(URL, headers=headers, stream=True)
-
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Save the file
-        with open(filename, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-        # logger.debug(f"Downloading {filename} completed successfully.")
-    else:
-        error_msg = f"Failed to download {filename}. Status code: {response.status_code}"
-        raise Exception(error_msg)
-
-
-def download_apk_file(URL, filename):
-    if (os.name == 'nt'):   # Testing in Windows
-        download_Windows(URL, filename)
-    else:                   # Running in Linux
-        download_Linux(URL, filename)
-
+@traced()
+def download_apk_file(URL, filename, size=None, sha256=None):
+    """Downloads a release asset from a given URL. The download is resumable, and the
+    file appears under 'filename' only once its size and SHA-256 (if given, e.g. from
+    the asset metadata) have been verified. Returns the SHA-256 hex digest of the file."""
+    return downloader.download_file(URL, filename, headers={"Accept": "application/octet-stream"},
+                                    expected_size=size, expected_sha256=sha256)
@@ -0,0 +1,126 @@
+import random
+import time
+
+# pip install requests - https://pypi.org/project/requests/
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import *
+import metrics
+from rate_limiter import CORE_RESOURCE
+
+# One shared session for the whole process: connections to api.github.com (and to
+# the asset download hosts) are pooled and kept alive between requests.
+_session = None
+
+# Rate limiter applied to the requests sent to GITHUB_API_URL
+_rate_limiter = None
+
+# Statuses that are worth retrying - everything else is returned to the caller as is
+RETRY_STATUSES = (500, 502, 503, 504)
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# Connections kept per host: the polling threads, and the segments of the parallel downloads
+# (which can share the host with the polls, e.g. the API URLs of the assets)
+POOL_SIZE = POLL_WORKERS + DOWNLOAD_WORKERS * DOWNLOAD_SEGMENTS
+
+
+def initialize_http_client(token=None, pool_size=POOL_SIZE, rate_limiter=None):
+    """Creates the shared HTTP session. 'pool_size' should be at least the number
+    of threads making requests in parallel. 'rate_limiter' (a RateLimiter) is
+    shared by all the requests to the GitHub API."""
+    global _session, _rate_limiter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if token:
+        session.headers["Authorization"] = f"token {token}"
+
+    if _session is not None:
+        _session.close()
+    _session = session
+    _rate_limiter = rate_limiter
+
+def get_session():
+    if _session is None:
+        initialize_http_client()
+    return _session
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter for the given (0-based) attempt."""
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+def request(method, url, headers=None, stream=False, retries=HTTP_RETRIES, timeout=None, allow_redirects=True, json_body=None):
+    """Sends a request using the shared session. Connection errors, timeouts and
+    server errors are retried with backoff. A request that hits the GitHub rate
+    limit is sent again once the limit has been reset. Returns the last response,
+    or raises the last exception if no response was received at all.
+    'json_body' is sent as the JSON body - only idempotent requests, e.g. GraphQL queries."""
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    if url.startswith(GITHUB_API_URL):
+        limiter = _rate_limiter
+        target = "github_api"
+        # The GraphQL API has a rate limit budget of its own
+        resource = "graphql" if url.startswith(GITHUB_API_URL + "/graphql") else CORE_RESOURCE
+    else:
+        # The token is only for GitHub - e.g. a pre-signed asset download URL must not get it
+        limiter = None
+        headers = dict(headers or {}, Authorization=None)
+        target = "download"
+
+    attempt = 0
+    rate_limit_waits = 0
+    while True:
+        if limiter:
+            limiter.acquire(resource)
+        try:
+            response = get_session().request(method, url, headers=headers, stream=stream, timeout=timeout,
+                                             allow_redirects=allow_redirects, json=json_body)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.HTTP_REQUESTS.inc(target=target, status="error")
+            if attempt == retries - 1:
+                raise
+            logger.debug(f"{method} {url}: {e}")
+        else:
+            metrics.HTTP_REQUESTS.inc(target=target, status=response.status_code)
+            if limiter and limiter.update(response.status_code, response.headers, resource):
+                if rate_limit_waits == RATE_LIMIT_MAX_WAITS:
+                    return response
+                rate_limit_waits += 1
+                logger.debug(f"{method} {url}: rate limited (HTTP {response.status_code})")
+                response.close()
+                continue    # acquire() pauses until the limit has been reset
+            if response.status_code not in RETRY_STATUSES or attempt == retries - 1:
+                return response
+            logger.debug(f"{method} {url}: HTTP {response.status_code}")
+            response.close()
+
+        delay = backoff_delay(attempt)
+        logger.debug(f"Retrying in {delay:.1f}s...")
+        time.sleep(delay)
+        attempt += 1
+
+def rate_limit_status():
+    """Returns the remaining GitHub API budget as a string."""
+    if _rate_limiter is None:
+        return "GitHub API budget: not tracked"
+    return _rate_limiter.status()
+
+def get(url, headers=None, stream=False):
+    return request("GET", url, headers=headers, stream=stream)
+
+def post_json(url, body, headers=None):
+    return request("POST", url, headers=headers, json_body=body)
+
+def resolve_redirect(url, headers=None):
+    """Returns the URL that 'url' redirects to (e.g. the download host of a GitHub
+    release asset), or 'url' itself if it does not redirect."""
+    response = request("GET", url, headers=headers, stream=True, allow_redirects=False)
+    with response:
+        if response.is_redirect and response.headers.get('Location'):
+            return response.headers['Location']
+    return url
@@ -1,21 +1,20 @@
 import os
 import sqlite3
+import threading
 from datetime import datetime
 
-DATABASE_FILE_NAME = "installed_versions.db"
-
+from config import *
 
-# Initialize the database and create the table if it doesn't exist
-def initialize_db(data_dir):
-    """Initialize the database and create the table if it doesn't exist."""  
-    if not os.path.exists(data_dir):
-        os.makedirs(data_dir)
+DATABASE_FILE_NAME = "installed_versions.db"
 
-    DB_FILE = os.path.join(data_dir, DATABASE_FILE_NAME)
+# The duplicate rows dropped by migration 2, kept for inspection
+DUPLICATES_TABLE = "installed_versions_duplicates"
 
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
+# Schema migrations - the schema version of a database file is stored in 'PRAGMA user_version'
+# and every migration after it is applied once, in order, when the database is opened.
+SCHEMA_MIGRATIONS = [
+    # 1: The original table
+    '''
         CREATE TABLE IF NOT EXISTS installed_versions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             repo TEXT NOT NULL,
@@ -24,46 +23,270 @@ def initialize_db(data_dir):
             version TEXT NOT NULL,
             versionCode INTEGER NOT NULL,
             date TEXT NOT NULL
-        )
-    ''')
-    conn.commit()
-    conn.close()
+        );
+    ''',
+    # 2: A release is recorded only once - move possible duplicates (all but the first one) to
+    #    DUPLICATES_TABLE before indexing
+    f'''
+        CREATE TABLE IF NOT EXISTS {DUPLICATES_TABLE} AS SELECT * FROM installed_versions WHERE 0;
+        INSERT INTO {DUPLICATES_TABLE} SELECT * FROM installed_versions WHERE id NOT IN
+            (SELECT MIN(id) FROM installed_versions GROUP BY repo, release);
+        DELETE FROM installed_versions WHERE id NOT IN
+            (SELECT MIN(id) FROM installed_versions GROUP BY repo, release);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_installed_versions_repo_release ON installed_versions (repo, release);
+        CREATE INDEX IF NOT EXISTS idx_installed_versions_packageName ON installed_versions (packageName);
+    ''',
+    # 3: A release can have several APK assets (flavors, ABIs) - one row per asset.
+    #    The rows from before have an empty asset: they stand for the whole release.
+    '''
+        ALTER TABLE installed_versions ADD COLUMN asset TEXT NOT NULL DEFAULT '';
+        DROP INDEX IF EXISTS idx_installed_versions_repo_release;
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_installed_versions_repo_release_asset ON installed_versions (repo, release, asset);
+    ''',
+    # 4: Coordination of several workers, see work_leases.py - leases of repositories and of the
+    #    build leadership, and the releases downloaded by the workers waiting for the build leader
+    '''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_leases_owner ON leases (owner);
+        CREATE TABLE IF NOT EXISTS handoff (
+            repo TEXT NOT NULL,
+            release TEXT NOT NULL,
+            asset TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            date TEXT NOT NULL,
+            relnotes TEXT NOT NULL,
+            html_url TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            packageName TEXT NOT NULL,
+            version TEXT NOT NULL,
+            versionCode TEXT NOT NULL,
+            application TEXT NOT NULL,
+            worker TEXT NOT NULL,
+            queued REAL NOT NULL,
+            PRIMARY KEY (repo, release, asset)
+        );
+    ''',
+]
+
+# Number of (repo, release) pairs per query - keeps well below the SQLite host parameter limit
+QUERY_BATCH_SIZE = 400
+
+
+class InstalledVersionsDB:
+    """Long-lived connection to the installed versions database.
+    The connection can be shared by threads, the statements are serialized by a lock."""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        # Autocommit mode - transactions are started explicitly where they are needed
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.migrate()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def schema_version(self):
+        with self.lock:
+            return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self):
+        """Brings the schema of the database file up to date."""
+        with self.lock:
+            version = self.schema_version()
+            for number, migration in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+                # executescript() commits any pending transaction first, so BEGIN..COMMIT are part of the script
+                try:
+                    self.conn.executescript(f"BEGIN;\n{migration}\nPRAGMA user_version = {number};\nCOMMIT;")
+                except sqlite3.Error:
+                    # A failed statement leaves the transaction open - it would fail every later BEGIN
+                    if self.conn.in_transaction:
+                        self.conn.execute('ROLLBACK')
+                    raise
+                if number == 2:
+                    duplicates = self.conn.execute(f'SELECT COUNT(*) FROM {DUPLICATES_TABLE}').fetchone()[0]
+                    if duplicates:
+                        logger.warning(f"Database {self.db_file}: {duplicates} duplicate release records moved to table {DUPLICATES_TABLE}")
+
+    def insert_record(self, repo, release, packageName, version, versionCode, date=None):
+        self.insert_records([(repo, release, packageName, version, versionCode, date)])
+
+    def insert_records(self, records):
+        """Inserts (repo, release, packageName, version, versionCode, date[, asset]) tuples in one transaction."""
+        rows = []
+        for record in records:
+            repo, release, packageName, version, versionCode, date = record[:6]
+            asset = record[6] if len(record) > 6 else ''
+            if date is None:
+                date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            rows.append((repo, release, packageName, version, versionCode, date, asset))
+        with self.lock:
+            with self.transaction():
+                self.conn.executemany('''
+                    INSERT INTO installed_versions (repo, release, packageName, version, versionCode, date, asset)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+
+    def transaction(self):
+        return _Transaction(self.conn)
+
+    def release_exist(self, repo, release):
+        with self.lock:
+            cursor = self.conn.execute('SELECT 1 FROM installed_versions WHERE repo = ? AND release = ? LIMIT 1', (repo, release))
+            return cursor.fetchone() is not None
+
+    def existing_releases(self, repo_release_pairs):
+        """Returns the set of the given (repo, release) pairs that are already in the database."""
+        pairs = list(repo_release_pairs)
+        existing = set()
+        with self.lock:
+            for i in range(0, len(pairs), QUERY_BATCH_SIZE):
+                batch = pairs[i:i + QUERY_BATCH_SIZE]
+                values = ', '.join(['(?, ?)'] * len(batch))
+                params = [value for pair in batch for value in pair]
+                cursor = self.conn.execute(f'''
+                    WITH wanted(repo, release) AS (VALUES {values})
+                    SELECT iv.repo, iv.release FROM installed_versions iv
+                    JOIN wanted ON iv.repo = wanted.repo AND iv.release = wanted.release
+                ''', params)
+                existing.update(cursor.fetchall())
+        return existing
+
+    def existing_assets(self, repo_release_asset_triples):
+        """Returns the set of the given (repo, release, asset) triples that are already in the database.
+        A row without an asset (recorded before the assets were) covers every asset of its release."""
+        triples = list(repo_release_asset_triples)
+        existing = set()
+        batch_size = QUERY_BATCH_SIZE * 2 // 3     # As many host parameters as with pairs
+        with self.lock:
+            for i in range(0, len(triples), batch_size):
+                batch = triples[i:i + batch_size]
+                values = ', '.join(['(?, ?, ?)'] * len(batch))
+                params = [value for triple in batch for value in triple]
+                cursor = self.conn.execute(f'''
+                    WITH wanted(repo, release, asset) AS (VALUES {values})
+                    SELECT DISTINCT wanted.repo, wanted.release, wanted.asset FROM installed_versions iv
+                    JOIN wanted ON iv.repo = wanted.repo AND iv.release = wanted.release
+                               AND (iv.asset = wanted.asset OR iv.asset = '')
+                ''', params)
+                existing.update(cursor.fetchall())
+        return existing
+
+    def fetch_newest_release_dates(self):
+        """Returns dict repo -> date of the newest release recorded."""
+        with self.lock:
+            return dict(self.conn.execute('SELECT repo, MAX(date) FROM installed_versions GROUP BY repo'))
+
+    def fetch_all_records(self):
+        with self.lock:
+            return self.conn.execute('SELECT * FROM installed_versions').fetchall()
+
+    def fetch_release_dates(self):
+        """Returns dict repo -> list of release dates (oldest first)."""
+        release_dates = {}
+        with self.lock:
+            for repo, date in self.conn.execute('SELECT repo, date FROM installed_versions ORDER BY date'):
+                release_dates.setdefault(repo, []).append(date)
+        return release_dates
+
+    def fetch_version_codes(self):
+        """Returns dict packageName -> set of the version codes published."""
+        version_codes = {}
+        with self.lock:
+            for packageName, versionCode in self.conn.execute('SELECT DISTINCT packageName, versionCode FROM installed_versions'):
+                try:
+                    version_codes.setdefault(packageName, set()).add(int(versionCode))
+                except (TypeError, ValueError):
+                    pass
+        return version_codes
+
+    def fetch_records_by_package(self, packageName):
+        with self.lock:
+            return self.conn.execute('SELECT * FROM installed_versions WHERE packageName = ?', (packageName,)).fetchall()
+
+    def get_table_columns(self):
+        with self.lock:
+            return ', '.join(column[1] for column in self.conn.execute('PRAGMA table_info(installed_versions)'))
+
+    def delete_record_by_id(self, record_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM installed_versions WHERE id = ?', (record_id,))
+
+
+class _Transaction:
+    """BEGIN..COMMIT, or ROLLBACK if an exception is raised."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+
+# The open databases, one long-lived object per database file
+_databases = {}
+_databases_lock = threading.Lock()
+
+def get_db(DB_FILE):
+    """Returns the shared InstalledVersionsDB object of the database file."""
+    with _databases_lock:
+        db = _databases.get(DB_FILE)
+        if db is None:
+            db = InstalledVersionsDB(DB_FILE)
+            _databases[DB_FILE] = db
+        return db
+
+# The functions below keep the original per-file interface - they all use the shared object
+
+# Initialize the database, create the table and migrate the schema if needed
+def initialize_db(data_dir):
+    """Initialize the database and create the table if it doesn't exist."""  
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    DB_FILE = os.path.join(data_dir, DATABASE_FILE_NAME)
+    get_db(DB_FILE)
     return DB_FILE
 
 # Insert a new record into the table
 def insert_record(DB_FILE, repo, release, packageName, version, versionCode, date=None):
-    if date is None:
-        date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO installed_versions (repo, release, packageName, version, versionCode, date)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (repo, release, packageName, version, versionCode, date))
-    conn.commit()
-    conn.close()
+    get_db(DB_FILE).insert_record(repo, release, packageName, version, versionCode, date)
+
+# Insert several records in one transaction
+def insert_records(DB_FILE, records):
+    get_db(DB_FILE).insert_records(records)
 
 # Check if release exists in DB - based on repo and release values
 def release_exist(DB_FILE, repo, release):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM installed_versions WHERE repo = ? AND release = ?', (repo, release))
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count > 0
+    return get_db(DB_FILE).release_exist(repo, release)
+
+# Check which of the (repo, release) pairs exist in DB - in a single query
+def existing_releases(DB_FILE, repo_release_pairs):
+    return get_db(DB_FILE).existing_releases(repo_release_pairs)
+
+# Check which of the (repo, release, asset) triples exist in DB - in a single query
+def existing_assets(DB_FILE, repo_release_asset_triples):
+    return get_db(DB_FILE).existing_assets(repo_release_asset_triples)
 
 # Fetch all records from the table
 def fetch_all_records(DB_FILE):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM installed_versions')
-    records = cursor.fetchall()
-    conn.close()
-    return records
+    return get_db(DB_FILE).fetch_all_records()
 
 # Get all records in string format
 def get_all_records_string(DB_FILE):
-    records = fetch_all_records()
+    records = fetch_all_records(DB_FILE)
     records_str = []
     for record in records:
         records_str.append(f"id: {record[0]}, repo: {record[1]}, rel: {record[2]}, pkgN: {record[3]}, ver: {record[4]}, verC: {record[5]}, date: {record[6]}")
@@ -71,37 +294,35 @@ def get_all_records_string(DB_FILE):
 
 # Get table information in string format
 def get_table_columns(DB_FILE):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('PRAGMA table_info(installed_versions)')
-    columns = [column[1] for column in cursor.fetchall()]
-    conn.close()
-    return ', '.join(columns)
+    return get_db(DB_FILE).get_table_columns()
+
+# Fetch release dates of all repos - returns dict repo -> list of dates
+def fetch_release_dates(DB_FILE):
+    return get_db(DB_FILE).fetch_release_dates()
+
+# Fetch the date of the newest release of each repo - returns dict repo -> date
+def fetch_newest_release_dates(DB_FILE):
+    return get_db(DB_FILE).fetch_newest_release_dates()
+
+# Fetch the version codes published of each package - returns dict packageName -> set of version codes
+def fetch_version_codes(DB_FILE):
+    return get_db(DB_FILE).fetch_version_codes()
 
 # Fetch records by package name
 def fetch_records_by_package(DB_FILE, packageName):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM installed_versions WHERE packageName = ?', (packageName,))
-    records = cursor.fetchall()
-    conn.close()
-    return records
+    return get_db(DB_FILE).fetch_records_by_package(packageName)
 
 # Delete a record by ID
 def delete_record_by_id(DB_FILE, record_id):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM installed_versions WHERE id = ?', (record_id,))
-    conn.commit()
-    conn.close()
+    get_db(DB_FILE).delete_record_by_id(record_id)
 
 # # Example usage
 # if __name__ == "__main__":
-#     initialize_db()
-#     insert_record("repo1", "release1", "package1", "1.0.0", 100)
-#     insert_record("repo2", "release2", "package2", "2.0.0", 200)
-#     insert_record("repo3", "release3", "package3", "3.0.0", 300)
-#     logger.info(fetch_all_records())
-#     logger.info(fetch_records_by_package("package1"))
-#     # delete_record_by_id(1)
-#     # logger.info(fetch_all_records())
+#     DB_FILE = initialize_db("data")
+#     insert_record(DB_FILE, "repo1", "release1", "package1", "1.0.0", 100)
+#     insert_records(DB_FILE, [("repo2", "release2", "package2", "2.0.0", 200, None),
+#                              ("repo3", "release3", "package3", "3.0.0", 300, None)])
+#     logger.info(fetch_all_records(DB_FILE))
+#     logger.info(existing_releases(DB_FILE, [("repo1", "release1"), ("repo4", "release4")]))
+#     # delete_record_by_id(DB_FILE, 1)
+#     # logger.info(fetch_all_records(DB_FILE))
@@ -0,0 +1,283 @@
+import os
+import threading
+
+from config import *
+from asset_store import clone_file
+
+# In-memory index of the F-Droid metadata directory (BUILD_METADATA_DIR):
+#
+#   <package>.yml                               - the fields of the app
+#   <package>/en-US/changelog/<versionCode>.txt - release notes
+#   <package>/en-US/phoneScreenshots/           - screenshots
+#
+# The directory is scanned once at startup. Staging a release only updates the index and
+# queues the files whose content changes; the queued files are written (atomically) in one
+# go by flush() before the F-Droid build. Files edited outside the application are noticed
+# by check_for_external_changes() through their size and mtime.
+
+CHANGELOG_SUBDIR   = os.path.join("en-US", "changelog")
+SCREENSHOTS_SUBDIR = os.path.join("en-US", "phoneScreenshots")
+
+
+def parse_yml_fields(lines):
+    """Returns the top level 'Key: value' fields of a metadata yml file as a dict of strings."""
+    fields = {}
+    for line in lines:
+        if line[:1] in ("", " ", "\t", "-", "#") or ":" not in line:
+            continue
+        key, value = line.split(":", 1)
+        fields[key.strip()] = value.strip()
+    return fields
+
+def _stat_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class PackageMetadata:
+    """What the metadata directory has for one package."""
+
+    def __init__(self, package):
+        self.package = package
+        self.yml_lines = None       # None = no yml file
+        self.fields = {}
+        self.changelogs = set()     # Version codes (strings) with a changelog file
+        self.has_screenshots = False
+        self.signature = None       # Size and mtime of the files and directories, to notice external edits
+
+
+class MetadataIndex:
+    """Index of a F-Droid metadata directory with the changes waiting to be written."""
+
+    def __init__(self, metadata_dir=BUILD_METADATA_DIR):
+        self.metadata_dir = metadata_dir
+        self.lock = threading.RLock()
+        self.packages = {}
+        self.pending = {}           # path -> (operation, argument, journal), in the order queued - operations: mkdir, write, copy, remove
+        self.dir_signature = None
+        self.load()
+
+    # Paths of a package
+    def yml_file(self, package):
+        return os.path.join(self.metadata_dir, package + ".yml")
+
+    def changelog_dir(self, package):
+        return os.path.join(self.metadata_dir, package, CHANGELOG_SUBDIR)
+
+    def screenshots_dir(self, package):
+        return os.path.join(self.metadata_dir, package, SCREENSHOTS_SUBDIR)
+
+    def _signature(self, package):
+        return (_stat_signature(self.yml_file(package)),
+                _stat_signature(self.changelog_dir(package)),
+                _stat_signature(self.screenshots_dir(package)))
+
+    def _read_package(self, package):
+        entry = PackageMetadata(package)
+        entry.signature = self._signature(package)
+        if entry.signature[0] is not None:
+            with open(self.yml_file(package), 'r') as f:
+                entry.yml_lines = f.readlines()
+            entry.fields = parse_yml_fields(entry.yml_lines)
+        if entry.signature[1] is not None:
+            entry.changelogs = {name[:-len(".txt")] for name in os.listdir(self.changelog_dir(package)) if name.endswith(".txt")}
+        entry.has_screenshots = entry.signature[2] is not None
+        return entry
+
+    def _list_packages(self):
+        packages = set()
+        for name in os.listdir(self.metadata_dir):
+            if name.endswith(".yml"):
+                packages.add(name[:-len(".yml")])
+            elif os.path.isdir(os.path.join(self.metadata_dir, name)):
+                packages.add(name)
+        return packages
+
+    def load(self):
+        """(Re)reads the whole metadata directory. Returns the number of packages."""
+        with self.lock:
+            self.dir_signature = _stat_signature(self.metadata_dir)
+            self.packages = {package: self._read_package(package) for package in self._list_packages()}
+            return len(self.packages)
+
+    def reload_packages(self, packages):
+        """Drops the queued changes of the packages and reads them again from the disk,
+        e.g. after their staged files have been rolled back."""
+        with self.lock:
+            for package in packages:
+                prefix = os.path.join(self.metadata_dir, package)
+                self.pending = {path: change for path, change in self.pending.items()
+                                if not (path == prefix + ".yml" or path.startswith(prefix + os.sep))}
+                entry = self._read_package(package)
+                if entry.yml_lines is None and entry.signature[1:] == (None, None):
+                    self.packages.pop(package, None)
+                else:
+                    self.packages[package] = entry
+
+    def check_for_external_changes(self):
+        """Re-reads the packages whose files have been changed by someone else since they were
+        read (or written by the index). Returns the names of the re-read packages."""
+        with self.lock:
+            changed = [package for package, entry in self.packages.items() if self._signature(package) != entry.signature]
+            dir_signature = _stat_signature(self.metadata_dir)
+            if dir_signature != self.dir_signature:
+                # Packages added or removed
+                self.dir_signature = dir_signature
+                listed = self._list_packages()
+                changed += [package for package in listed if package not in self.packages]
+                changed += [package for package in self.packages if package not in listed]
+            if changed:
+                logger.debug(f"Metadata edited outside the application, re-reading: {', '.join(sorted(set(changed)))}")
+                self.reload_packages(set(changed))
+            return changed
+
+    def get(self, package):
+        with self.lock:
+            return self.packages.get(package)
+
+    def _queue(self, path, operation, argument, journal):
+        self.pending[path] = (operation, argument, journal)
+
+    def add_release(self, package, version_code, application, html_url, relnotes, journal=None, sample_screenshots=()):
+        """Updates the metadata of 'package' for a new release and queues the changed files.
+        'sample_screenshots' are seeded (linked or copied) to a package that has no screenshots yet."""
+        version_code = str(version_code)
+        with self.lock:
+            entry = self.packages.get(package)
+            if entry is None:
+                entry = self.packages[package] = PackageMetadata(package)
+
+            if not entry.has_screenshots:
+                screenshots_dir = self.screenshots_dir(package)
+                self._queue(screenshots_dir, "mkdir", None, journal)
+                for src in sample_screenshots:
+                    self._queue(os.path.join(screenshots_dir, os.path.basename(src)), "copy", src, journal)
+                entry.has_screenshots = True
+
+            # Release notes to the changelog file, if it does not exist
+            if version_code not in entry.changelogs:
+                self._queue(os.path.join(self.changelog_dir(package), f"{version_code}.txt"), "write", f"{relnotes}\n", journal)
+                entry.changelogs.add(version_code)
+
+            if entry.yml_lines is None:
+                logger.debug(f"Creating draft {self.yml_file(package)} file")
+                lines = [
+                    f"AuthorName: 'Brady'\n",
+                    f"Categories:\n", f"- TestAppCenter\n",
+                    f"CurrentVersionCode: {version_code}\n",
+                    f"Name: {application}\n",
+                    f"SourceCode: '{html_url}'\n",
+                    f"Summary: '{application} ({package}).'\n",
+                    f"Description: 'Development release of {application}.'\n",
+                    f"License: proprietary\n",
+                ]
+            else:
+                # Update the version code - the rest of the file is kept as it is
+                lines = [f"CurrentVersionCode: {version_code}\n" if "CurrentVersionCode:" in line else line
+                         for line in entry.yml_lines]
+                if not any("CurrentVersionCode:" in line for line in lines):
+                    lines.append(f"CurrentVersionCode: {version_code}\n")
+            if lines != entry.yml_lines:
+                self._queue(self.yml_file(package), "write", "".join(lines), journal)
+                entry.yml_lines = lines
+                entry.fields = parse_yml_fields(lines)
+            else:
+                logger.debug(f"{self.yml_file(package)} already has version code {version_code}")
+
+    def retire_changelogs(self, package, version_codes, journal=None, archive_dir=None):
+        """Queues the removal of the changelog files of the version codes of 'package'.
+        With 'archive_dir' the files are kept there as <archive_dir>/<package>/<versionCode>.txt.
+        Returns the number of changelogs queued for removal."""
+        with self.lock:
+            entry = self.packages.get(package)
+            if entry is None:
+                return 0
+            retired = entry.changelogs & {str(version_code) for version_code in version_codes}
+            for version_code in retired:
+                archive_path = os.path.join(archive_dir, package, f"{version_code}.txt") if archive_dir else None
+                self._queue(os.path.join(self.changelog_dir(package), f"{version_code}.txt"), "remove", archive_path, journal)
+            entry.changelogs -= retired
+            return len(retired)
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.pending)
+
+    def _create_dirs(self, directory, journal):
+        """Creates 'directory' and its missing parents, recording each created one to the journal."""
+        missing = []
+        while directory and not os.path.exists(directory):
+            missing.append(directory)
+            directory = os.path.dirname(directory)
+        for directory in reversed(missing):
+            if journal is not None:
+                journal.will_create_dir(directory)
+            os.mkdir(directory)
+
+    def flush(self):
+        """Writes the queued changes. Every file is written to a temporary file first and
+        renamed into place. Returns the number of files and directories written."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            written = set()
+            for path, (operation, argument, journal) in pending.items():
+                package = os.path.relpath(path, self.metadata_dir).split(os.sep)[0]
+                written.add(package[:-len(".yml")] if package.endswith(".yml") else package)
+                if operation == "mkdir":
+                    self._create_dirs(path, journal)
+                    continue
+                if operation == "remove":
+                    if not os.path.exists(path):
+                        continue
+                    if argument is not None:
+                        # Archived - kept outside of the metadata directory
+                        os.makedirs(os.path.dirname(argument), exist_ok=True)
+                        if os.path.exists(argument):
+                            os.remove(argument)
+                        clone_file(path, argument)
+                    if journal is not None:
+                        journal.will_write(path)
+                    os.remove(path)
+                    logger.debug(f"Removed {path}" + (f" (archived to {argument})" if argument else ""))
+                    continue
+                self._create_dirs(os.path.dirname(path), journal)
+                temp_file = path + ".tmp"
+                if operation == "write":
+                    with open(temp_file, 'w') as f:
+                        f.write(argument)
+                    method = "write"
+                else:
+                    # Shared asset - linked rather than copied when possible
+                    if os.path.exists(temp_file):
+                        os.remove(temp_file)
+                    method = clone_file(argument, temp_file)
+                if journal is not None:
+                    journal.will_write(path)
+                os.replace(temp_file, path)
+                logger.debug(f"Wrote {path} ({method})")
+
+            # The index wrote these files itself - they are not external changes
+            for package in written:
+                if package in self.packages:
+                    self.packages[package].signature = self._signature(package)
+            self.dir_signature = _stat_signature(self.metadata_dir)
+            return len(pending)
+
+
+_metadata_index = None
+
+def initialize_metadata_index(metadata_dir=BUILD_METADATA_DIR):
+    """Scans the metadata directory. Returns the number of packages found."""
+    global _metadata_index
+    _metadata_index = MetadataIndex(metadata_dir)
+    return len(_metadata_index.packages)
+
+def get_metadata_index():
+    """Returns the metadata index - initialized with BUILD_METADATA_DIR when used the first time."""
+    global _metadata_index
+    if _metadata_index is None:
+        _metadata_index = MetadataIndex(BUILD_METADATA_DIR)
+    return _metadata_index
@@ -0,0 +1,142 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Process metrics in the Prometheus text exposition format, served by the health
+# server of the daemon mode (daemon.py). Only the metric types needed here are
+# implemented - no client library is required.
+
+# Histogram buckets in seconds, from a cached API call to a large download or build
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. the number of requests."""
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(_label_key(labels), 0)
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, e.g. a queue length or a timestamp."""
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_label_key(labels)] = value
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(_label_key(labels), 0)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values (durations) in cumulative buckets."""
+    type_name = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the 'with' block - also when it raises."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def count(self, **labels):
+        with self.lock:
+            counts, _ = self.values.get(_label_key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+def render():
+    """Returns all the metrics in the Prometheus text format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# The metrics of the application
+STAGE_DURATION = Histogram("apub_stage_duration_seconds", "Duration of the publishing stages (poll, download, metadata, stage, build, db_commit, deploy)")
+CYCLE_DURATION = Histogram("apub_cycle_duration_seconds", "Duration of a whole check and publish cycle")
+HTTP_REQUESTS = Counter("apub_http_requests_total", "HTTP requests sent, by target (github_api or download) and status")
+DOWNLOADED_BYTES = Counter("apub_downloaded_bytes_total", "Bytes of APK files downloaded")
+PUBLISHED_RELEASES = Counter("apub_published_releases_total", "Releases published (built and added to the database)")
+FAILED_BUILDS = Counter("apub_failed_builds_total", "Batches rolled back because 'fdroid update' failed")
+QUEUED_RELEASES = Gauge("apub_queued_releases", "Releases waiting for the next publish batch")
+WEBHOOK_EVENTS = Counter("apub_webhook_events_total", "Webhook deliveries received, by result (queued, ignored, unsupported, invalid, bad_signature)")
+LAST_CYCLE_END = Gauge("apub_last_cycle_end_timestamp_seconds", "Unix time when the last cycle ended")
@@ -0,0 +1,117 @@
+import heapq
+import statistics
+import time
+from datetime import datetime
+
+from config import *
+
+# A repository is polled roughly this many times during the time that has passed
+# since its last release (or during its typical time between releases), so active
+# repositories are polled often and quiet ones are backed off.
+POLLS_PER_RELEASE_GAP = 48
+
+
+def release_timestamp(date):
+    """Converts a release date stored in the database to epoch seconds."""
+    return datetime.fromisoformat(date.replace('Z', '+00:00')).timestamp()
+
+
+class PollScheduler:
+    """Priority queue of repositories ordered by the time they are due to be polled next.
+    The polling interval of each repository adapts to its release history.
+    'floor_interval' is a lower limit that also overrides the min/interval settings of the
+    repositories, e.g. WEBHOOK_POLL_INTERVAL_MIN when the releases come by webhook."""
+
+    def __init__(self, release_dates=None, default_interval=POLL_INTERVAL,
+                 min_interval=POLL_INTERVAL_MIN, max_interval=POLL_INTERVAL_MAX, floor_interval=0):
+        self.default_interval = default_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.floor_interval = floor_interval
+        self.queue = []         # (next_due, repo)
+        self.next_due = {}      # repo -> next_due, the valid entry of the queue
+        self.options = {}       # repo -> RepoSettings
+        self.releases = {}      # repo -> sorted list of release timestamps
+        for repo, dates in (release_dates or {}).items():
+            for date in dates:
+                self.record_release(repo, date)
+
+    def set_repos(self, repo_options):
+        """Updates the set of scheduled repositories. New repositories are due immediately.
+        'repo_options' is a mapping: repo -> RepoSettings, see repo_config.py."""
+        now = time.time()
+        for repo in list(self.options):
+            if repo not in repo_options:
+                del self.options[repo]
+                self.next_due.pop(repo, None)   # The queue entry is dropped when popped
+        for repo, options in repo_options.items():
+            self.options[repo] = options
+            if repo not in self.next_due:
+                self._schedule(repo, now)
+
+    def record_release(self, repo, date):
+        """Adds a published release to the history of the repository."""
+        try:
+            timestamp = release_timestamp(date)
+        except (ValueError, AttributeError):
+            return
+        dates = self.releases.setdefault(repo, [])
+        dates.append(timestamp)
+        dates.sort()
+
+    def interval(self, repo, now=None):
+        """Returns the polling interval of the repository in seconds."""
+        if now is None:
+            now = time.time()
+        options = self.options.get(repo)
+        max_interval = self.max_interval if options is None or options.max_interval is None else options.max_interval
+        # A repository's own 'max' below the default minimum is honoured
+        min_interval = min(self.min_interval, max_interval) if options is None or options.min_interval is None else options.min_interval
+
+        dates = self.releases.get(repo)
+        if not dates:
+            interval = self.default_interval
+        else:
+            # Time since the last release - short right after a release, grows while the repo is quiet
+            gap = max(0.0, now - dates[-1])
+            if len(dates) > 1:
+                # ..but a repository that releases regularly is not backed off beyond its usual pace
+                typical_gap = statistics.median(b - a for a, b in zip(dates, dates[1:]))
+                gap = min(gap, max(typical_gap, 0.0))
+            interval = gap / POLLS_PER_RELEASE_GAP
+
+        return max(self.floor_interval, min_interval, min(max_interval, interval))
+
+    def _schedule(self, repo, due):
+        self.next_due[repo] = due
+        heapq.heappush(self.queue, (due, repo))
+
+    def reschedule(self, repo):
+        """Schedules the next poll of a repository that has just been polled."""
+        if repo in self.options:
+            self._schedule(repo, time.time() + self.interval(repo))
+
+    def poll_soon(self, repo, delay):
+        """Brings the next poll of a repository forward to 'delay' seconds from now, if it is due later."""
+        due = time.time() + delay
+        if repo in self.options and self.next_due.get(repo, due) >= due:
+            self._schedule(repo, due)
+
+    def pop_due(self):
+        """Removes and returns the repositories that are due, most overdue first."""
+        now = time.time()
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            next_due, repo = heapq.heappop(self.queue)
+            if self.next_due.get(repo) == next_due:
+                del self.next_due[repo]
+                due.append(repo)
+        return due
+
+    def seconds_until_next(self):
+        """Returns the time until the next repository is due (0 if some already is)."""
+        while self.queue and self.next_due.get(self.queue[0][1]) != self.queue[0][0]:
+            heapq.heappop(self.queue)   # Stale entry of a removed or rescheduled repository
+        if not self.queue:
+            return self.default_interval
+        return max(0.0, self.queue[0][0] - time.time())
@@ -0,0 +1,448 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import *
+from githubber import download_apk_file
+from apk_checker import get_apk_info_cached, remember_apk_file
+from fdroid_builder import StagingJournal, add_apk_to_fdroid, update_fdroid_Linux, backup_and_copy_build_to_run_environment
+from installed_versions_db import existing_assets, insert_records
+from metadata_index import get_metadata_index
+from retention import apply_retention
+from tracing import labels, span
+from work_leases import hand_over, handed_over_count, fetch_handed_over, remove_handed_over
+import metrics
+
+# Releases are published in batches through the stages
+#
+#   download -> verify -> metadata -> stage -> retention -> fdroid update -> commit DB rows -> deploy
+#
+# Everything up to 'stage' is done release by release: a release failing there is left
+# out of the batch. Download and metadata of the releases of a batch run in parallel
+# (DOWNLOAD_WORKERS), staging one release at a time in the order they were queued.
+# Staging updates the in-memory metadata index, the changed metadata files of the
+# whole batch are written at the end of the stage. The staged changes to
+# the build directory are journaled, and if the one 'fdroid update' of the batch fails,
+# only they are rolled back - the DB rows are written only after a successful build.
+# Releases queued while a batch is being built wait for the next batch.
+#
+# A stop request (daemon mode) is honoured between releases and before the build: the
+# stage in progress is finished, and releases staged but not built are rolled back.
+# Once the build has started, the batch is taken through the database and the deploy.
+#
+# With several workers (work_leases.py) only the build leader stages, builds and deploys.
+# The other workers hand their prepared releases over to it, and the leader adds them to
+# its next batch.
+
+
+class PendingRelease:
+    """An APK asset of a release waiting to be published, and what the stages have found out about it."""
+
+    def __init__(self, repo, url, relname, filename, date, relnotes, html_url, size=None, sha256=None):
+        self.repo = repo
+        self.url = url
+        self.relname = relname
+        self.filename = filename
+        self.asset = filename       # Name of the asset in GitHub - 'filename' may be changed by prepare_release()
+        self.date = date
+        self.relnotes = relnotes
+        self.html_url = html_url
+        self.size = size            # Size and digest of the asset, as told by GitHub
+        self.sha256 = sha256
+        self.apk_sha256 = None      # Filled in by prepare_release()
+        self.packageName = None
+        self.versionName = None
+        self.versionCode = None
+        self.application = None
+        self.journal = None         # Filled in by stage_release()
+        self.handed_over = False    # Prepared and handed over to the build leader (another worker)
+        self.handed_over_by = None  # The worker that prepared the release, if not this one
+
+    @classmethod
+    def from_handoff(cls, row):
+        """A release prepared and handed over by another worker, see work_leases.fetch_handed_over()."""
+        release = cls(row['repo'], None, row['release'], row['filename'], row['date'], row['relnotes'], row['html_url'])
+        release.asset = row['asset']
+        release.apk_sha256 = row['sha256']
+        release.packageName = row['packageName']
+        release.versionName = row['version']
+        release.versionCode = row['versionCode']
+        release.application = row['application']
+        release.handed_over_by = row['worker']
+        return release
+
+    @property
+    def key(self):
+        return (self.repo, self.relname, self.asset)
+
+    def db_record(self):
+        return (self.repo, self.relname, self.packageName, self.versionName, self.versionCode, self.date, self.asset)
+
+
+def download_path(release):
+    """The path the APK of a release is downloaded to - a directory of its own for every release
+    asset, so that same-named assets of different repositories or releases, downloaded in
+    parallel, do not meet. The name of the file is the name of the asset."""
+    source = hashlib.sha256(f"{release.repo}\n{release.relname}\n{release.url}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(DOWNLOAD_DIR, source, release.asset)
+
+def prepare_release(release):
+    """Downloads, verifies and reads the metadata of the APK of a release.
+    Returns False (the failure logged) if the release cannot be published."""
+
+    # Download the APK file of the release
+    # The file is verified against the size and digest of the asset before it gets its name
+    try:
+        release.filename = download_path(release)
+        os.makedirs(os.path.dirname(release.filename), exist_ok=True)
+        logger.debug(f"Start downloading APK file of release {release.relname}...")
+        with span("download"):
+            release.apk_sha256 = download_apk_file(release.url, release.filename, release.size, release.sha256)
+    except Exception as e:
+        error_msg = f"Error in downloading APK file {release.filename}. Skipping this release {release.relname}."
+        logger.exception(error_msg)
+        return False
+    else:
+        logger.debug(f"APK file {release.filename} of release {release.relname} downloaded and verified successfully.")
+
+    # Get metadata from the APK file
+    try:
+        with span("metadata"):
+            release.packageName, release.versionName, release.versionCode, release.application = \
+                get_apk_info_cached(release.filename, release.apk_sha256)
+    except Exception as e:
+        error_msg = f"Error in extracting APK info from {release.filename}. Skipping this release {release.relname}."
+        logger.exception(error_msg)
+        return False
+    else:
+        logger.debug(f"APK info from {release.filename} extracted successfully.")
+
+    # Make sure the apk file name contain the version name in it
+    orgfilename = release.filename
+    new_filename = orgfilename
+    try:
+        if False == (release.versionName in orgfilename):
+            # Fix the filename to contain the version name and version code
+            new_filename = orgfilename.replace(".apk", "")
+            new_filename = new_filename + "-v" + release.versionName + "." + release.versionCode + ".apk"
+            os.rename(orgfilename, new_filename)
+            release.filename = new_filename
+            logger.debug(f"Renamed {orgfilename} to {new_filename}")
+    except Exception as e:
+        error_msg = f"Error in renaming file {orgfilename} to {new_filename}. Skipping this release {release.relname}."
+        logger.exception(error_msg)
+        return False
+
+    return True
+
+def stage_release(release):
+    """Adds the APK and the metadata of a release to the F-Droid build directory.
+    Returns False (the failure logged and the partial changes rolled back) on failure."""
+    release.journal = StagingJournal()
+    try:
+        with span("stage"):
+            # The APK of a release handed over by another worker stays in place until the release is
+            # in the database - if the batch is rolled back, it is still there for the next batch
+            add_apk_to_fdroid(release.filename, release.versionName, release.versionCode, release.packageName,
+                              release.application, release.html_url, release.relnotes, release.journal,
+                              keep_source=release.handed_over_by is not None)
+    except Exception as e:
+        error_msg = f"Error in adding APK file {release.filename} to fdroid. Skipping this release {release.relname}."
+        logger.exception(error_msg)
+        put_back_download(release)
+        try:
+            release.journal.rollback()
+        except Exception:
+            logger.exception(f"Error in rolling back the staged files of release {release.relname}.")
+        return False
+    else:
+        logger.debug(f"APK file {release.filename} staged to fdroid successfully.")
+        if release.handed_over_by is None:
+            try:
+                os.rmdir(os.path.dirname(release.filename))     # The download directory of the asset, if empty
+            except OSError:
+                pass
+        return True
+
+
+def put_back_download(release):
+    """Moves the staged APK of a release prepared by this worker back to its download directory,
+    so that the release is not downloaded again when it is retried. Called before the staged
+    files are rolled back."""
+    if release.handed_over_by is not None:
+        return      # The APK was linked, the handed over file is still in place
+    staged_path = os.path.join(BUILD_REPO_DIR, os.path.basename(release.filename))
+    if not os.path.exists(staged_path):
+        return
+    try:
+        path = download_path(release)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(staged_path, path)
+        logger.debug(f"Moved the APK file of release {release.relname} back to {path}")
+    except OSError:
+        logger.exception(f"Error in moving the APK file of release {release.relname} back to the download directory.")
+
+
+def remove_handed_over_releases(db_file, releases):
+    """Removes the handoff rows of releases handed over by other workers, and their APK files."""
+    releases = [release for release in releases if release.handed_over_by is not None]
+    if not releases:
+        return
+    remove_handed_over(db_file, [release.key for release in releases])
+    for release in releases:
+        try:
+            os.remove(release.filename)
+            os.rmdir(os.path.dirname(release.filename))
+        except OSError:
+            pass
+
+
+class PublishPipeline:
+    """Queue of releases to publish, published in batches by run_batch()."""
+
+    def __init__(self, db_file, should_stop=None, leases=None):
+        self.db_file = db_file
+        self.should_stop = should_stop or (lambda: False)
+        self.leases = leases        # LeaseManager of this worker when running as one of several workers
+        self.queue = []             # PendingRelease objects in the order they were found
+        self.queue_lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.deploy_pending = False  # The build has changes that are not deployed yet
+        self.failed_repos = set()   # Repositories with releases that failed in the last batch
+
+    def enqueue(self, release):
+        """Queues a release for the next batch. Returns False if it is queued already."""
+        with self.queue_lock:
+            if any(queued.key == release.key for queued in self.queue):
+                return False
+            self.queue.append(release)
+            metrics.QUEUED_RELEASES.set(len(self.queue))
+            return True
+
+    def pending(self):
+        with self.queue_lock:
+            return len(self.queue)
+
+    def has_work(self):
+        """True if there are releases to publish or a build to deploy - also ones handed over by other workers."""
+        if self.pending() or self.deploy_pending:
+            return True
+        if self.leases is None:
+            return False
+        try:
+            return self.leases.try_lead() and handed_over_count(self.db_file) > 0
+        except Exception as e:
+            logger.exception("Error in checking for releases handed over by the other workers.")
+            return False
+
+    def take_batch(self):
+        """Takes all the queued releases - the ones queued from now on go to the next batch."""
+        with self.queue_lock:
+            batch, self.queue = self.queue, []
+            metrics.QUEUED_RELEASES.set(0)
+        return batch
+
+    def requeue(self, releases):
+        """Puts releases back to the front of the queue, e.g. when a batch could not be started."""
+        with self.queue_lock:
+            keys = {release.key for release in releases}
+            self.queue = list(releases) + [release for release in self.queue if release.key not in keys]
+            metrics.QUEUED_RELEASES.set(len(self.queue))
+
+    def _prepare(self, release):
+        """Worker: prepare_release() of a release of the batch. None if a stop was requested."""
+        if self.should_stop():
+            return None
+        if release.handed_over_by is not None:
+            # Downloaded and verified by another worker
+            if not os.path.exists(release.filename):
+                logger.error(f"APK file {release.filename} of release {release.relname} handed over by worker "
+                             f"{release.handed_over_by} does not exist. Dropping the release.")
+                remove_handed_over(self.db_file, [release.key])
+                return False
+            return True
+        with labels(repo=release.repo, release=release.relname):
+            return prepare_release(release)
+
+    def prepare_all(self, batch):
+        """Downloads and reads the releases of the batch in parallel. Returns the prepare_release()
+        results in the order of the batch."""
+        if not batch:
+            return []
+        workers = max(1, min(DOWNLOAD_WORKERS, len(batch)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download") as executor:
+            return list(executor.map(self._prepare, batch))
+
+    def rollback(self, staged, retention_journal=None, retired_packages=()):
+        """Rolls back the staged files of the releases (and the files retired for the batch)
+        and re-reads their metadata."""
+        if retention_journal is not None:
+            try:
+                retention_journal.rollback()
+            except Exception:
+                logger.exception("Error in rolling back the retired files.")
+        for release in reversed(staged):
+            put_back_download(release)
+            try:
+                release.journal.rollback()
+            except Exception:
+                logger.exception(f"Error in rolling back the staged files of release {release.relname}.")
+        get_metadata_index().reload_packages({release.packageName for release in staged} | set(retired_packages))
+
+    def hand_over(self, batch):
+        """Prepares the releases of the batch and hands them over to the build leader.
+        Returns the releases handed over."""
+        prepared = self.prepare_all(batch)
+        ready = []
+        stopped = [release for number, release in enumerate(batch) if prepared[number] is None]
+        if stopped:
+            logger.info(f"Stop requested - {len(stopped)} releases left for the next run.")
+            self.requeue(stopped)
+        for number, release in enumerate(batch):
+            if prepared[number] is None:
+                continue
+            elif prepared[number]:
+                ready.append(release)
+            else:
+                self.failed_repos.add(release.repo)
+        try:
+            hand_over(self.db_file, self.leases.worker_id, ready)
+        except Exception as e:
+            logger.exception("Error in handing the releases over to the build leader. Retrying the batch later.")
+            self.requeue(ready)
+            return []
+        for release in ready:
+            release.handed_over = True
+        logger.info(f"Handed {len(ready)} of {len(batch)} releases over to the build leader")
+        return ready
+
+    def run_batch(self):
+        """Publishes the queued releases with one F-Droid build and one deploy.
+        Returns the releases that were published (added to the database), or handed over
+        to the build leader if this worker is not the leader."""
+        with self.build_lock:
+            batch = self.take_batch()
+            start = time.monotonic()
+            self.failed_repos = set()
+
+            leader = True
+            if self.leases is not None:
+                try:
+                    leader = self.leases.try_lead()
+                    if leader:
+                        queued = {release.key for release in batch}
+                        batch += [release for release in map(PendingRelease.from_handoff, fetch_handed_over(self.db_file))
+                                  if release.key not in queued]
+                except Exception as e:
+                    logger.exception("Error in reading the build leadership or the handed over releases. Retrying the batch later.")
+                    self.requeue(batch)
+                    return []
+
+            # A release may have been queued again while its previous batch was being built
+            if batch:
+                try:
+                    published = existing_assets(self.db_file, [release.key for release in batch])
+                except Exception as e:
+                    logger.exception("Error in checking if releases exist in the database. Retrying the batch later.")
+                    self.requeue(batch)
+                    return []
+                for release in batch:
+                    if release.key in published:
+                        logger.debug(f"{release.repo} release {release.relname} already published. Skip.")
+                if self.leases is not None and leader:
+                    remove_handed_over_releases(self.db_file, [release for release in batch if release.key in published])
+                batch = [release for release in batch if release.key not in published]
+
+            if not leader:
+                return self.hand_over(batch)
+
+            index = get_metadata_index()
+            if batch:
+                index.check_for_external_changes()
+
+            prepared = self.prepare_all(batch)
+            staged = []
+            for number, release in enumerate(batch):
+                if self.should_stop():
+                    logger.info(f"Stop requested - {len(batch) - number} releases left for the next run.")
+                    self.requeue(batch[number:])
+                    break
+                with labels(repo=release.repo, release=release.relname):
+                    if prepared[number] and stage_release(release):
+                        staged.append(release)
+                    else:
+                        self.failed_repos.add(release.repo)
+
+            if staged and self.should_stop():
+                logger.info(f"Stop requested before the build - rolling back the {len(staged)} staged releases.")
+                self.rollback(staged)
+                self.requeue([release for release in staged if release.handed_over_by is None])
+                return []
+            if staged and self.leases is not None and not self.leases.try_lead():
+                logger.warning(f"Build leadership lost - rolling back the {len(staged)} staged releases.")
+                self.rollback(staged)
+                self.requeue([release for release in staged if release.handed_over_by is None])
+                return []
+            if not staged and not self.deploy_pending:
+                return []
+
+            if staged:
+                # Old versions out of the repository before it is indexed - put back if the build fails
+                retention_journal = StagingJournal()
+                try:
+                    retired_packages = apply_retention(self.db_file, retention_journal,
+                                                       [(release.packageName, release.versionCode) for release in staged], index=index)
+                except Exception as e:
+                    logger.exception("Error in retiring old versions from the build repository. Keeping them for now.")
+                    retention_journal.rollback()
+                    retired_packages = set()
+
+                logger.info(f"Building F-Droid repository with {len(staged)} new releases: "
+                            f"{', '.join(release.relname for release in staged)}")
+                try:
+                    with span("build"):
+                        written = index.flush()
+                        logger.debug(f"Wrote {written} metadata files and directories of the batch")
+                        update_fdroid_Linux()
+                except Exception as e:
+                    logger.exception(f"Error in updating F-Droid repository. Rolling back the {len(staged)} staged releases.")
+                    metrics.FAILED_BUILDS.inc()
+                    self.rollback(staged, retention_journal, retired_packages)
+                    self.failed_repos.update(release.repo for release in staged)
+                    return []
+                else:
+                    logger.info("F-Droid repository updated successfully.")
+                    self.deploy_pending = True
+
+                retention_journal.commit()
+                for release in staged:
+                    release.journal.commit()
+                    remember_apk_file(os.path.join(BUILD_REPO_DIR, os.path.basename(release.filename)), release.apk_sha256)
+
+                # The releases are added to the database in one transaction. If this fails, they are
+                # found again by the next poll and staged again - that is harmless, they are in place already.
+                try:
+                    with span("db_commit"):
+                        insert_records(self.db_file, [release.db_record() for release in staged])
+                        if self.leases is not None:
+                            remove_handed_over_releases(self.db_file, staged)
+                except Exception as e:
+                    logger.exception(f"Error in adding releases {', '.join(release.relname for release in staged)} to the database.")
+                    self.failed_repos.update(release.repo for release in staged)
+                    return []
+                metrics.PUBLISHED_RELEASES.inc(len(staged))
+
+            # Deploy - if this fails, it is retried with the next batch, with or without new releases
+            try:
+                with span("deploy"):
+                    backup_and_copy_build_to_run_environment()
+            except Exception as e:
+                logger.exception("Error in backing up old run environment and/or copying build to run environment.")
+            else:
+                logger.info("Old run environment backed up and build copied as a new run environment.")
+                self.deploy_pending = False
+
+            logger.info(f"Published {len(staged)} of {len(batch)} releases in {time.monotonic() - start:.2f}s")
+            return staged
@@ -0,0 +1,157 @@
+import threading
+import time
+
+from config import *
+
+# GitHub allows 5000 requests per hour for an authenticated user. This is
+# used until the first response tells the real limit.
+DEFAULT_HOURLY_LIMIT = 5000
+
+# Wait used for a secondary rate limit that does not come with any headers
+SECONDARY_LIMIT_WAIT = 60
+
+# The budget of the REST API - GitHub names the budget of a response in X-RateLimit-Resource,
+# e.g. "graphql" for the GraphQL API, which has a budget of its own (in points, not requests)
+CORE_RESOURCE = "core"
+
+
+class _Budget:
+    """The request budget of one GitHub API resource, see RateLimiter."""
+
+    def __init__(self, interval, hourly_limit):
+        self.interval = interval
+        self.limit = hourly_limit
+        self.remaining = None           # Unknown until the first response
+        self.reset_at = None            # Epoch seconds
+        self.blocked_until = 0.0        # Epoch seconds, set by Retry-After or an exhausted budget
+        self.last_refill = time.time()
+        self.tokens = self._capacity(self.last_refill)
+
+    def _rate(self, now):
+        """Tokens per second."""
+        if self.remaining is None or self.reset_at is None or now >= self.reset_at:
+            return self.limit / 3600.0
+        return max(self.remaining, 0) / max(1.0, self.reset_at - now)
+
+    def _capacity(self, now):
+        capacity = self._rate(now) * self.interval
+        if self.remaining is not None and self.reset_at is not None and now < self.reset_at:
+            capacity = min(capacity, self.remaining)
+        return max(1.0, capacity)
+
+    def take(self, now):
+        """Takes a token. Returns 0, or the time to wait before trying again."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.remaining is not None and self.remaining <= 0 and self.reset_at and now < self.reset_at:
+            return self.reset_at - now + 1
+        rate = self._rate(now)
+        self.tokens = min(self._capacity(now), self.tokens + (now - self.last_refill) * rate)
+        self.last_refill = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            if self.remaining is not None:
+                self.remaining -= 1
+            return 0
+        return (1 - self.tokens) / rate
+
+    def update(self, now, status_code, limit, remaining, reset_at, retry_after):
+        """See RateLimiter.update()."""
+        if limit is not None:
+            self.limit = limit
+        if remaining is not None:
+            if reset_at is not None and (self.reset_at is None or reset_at > self.reset_at):
+                # A new rate limit window
+                self.reset_at = reset_at
+                self.remaining = remaining
+            elif self.remaining is None:
+                self.remaining = remaining
+            else:
+                # Responses of parallel requests can arrive in any order
+                self.remaining = min(self.remaining, remaining)
+
+        if status_code not in (403, 429):
+            return False
+
+        if retry_after is not None:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+        elif remaining == 0 and reset_at is not None:
+            self.blocked_until = max(self.blocked_until, reset_at + 1)
+        elif status_code == 429:
+            self.blocked_until = max(self.blocked_until, now + SECONDARY_LIMIT_WAIT)
+        else:
+            # A 403 that is not about rate limits (e.g. no access to the repository)
+            return False
+        return True
+
+    def status(self, name):
+        if self.remaining is None:
+            return f"{name} unknown"
+        resets_in = max(0, int(self.reset_at - time.time())) if self.reset_at else 0
+        return f"{name} {max(self.remaining, 0)}/{self.limit} remaining, resets in {resets_in // 60}m {resets_in % 60}s"
+
+
+class RateLimiter:
+    """Token buckets shared by all the GitHub API calls, one per API resource.
+
+    A bucket is refilled so that the remaining request budget (X-RateLimit-Remaining)
+    is spread evenly until the budget resets (X-RateLimit-Reset), and it never holds
+    more than one polling interval worth of requests. When the budget is exhausted, or
+    GitHub answers with a rate limit error, all the callers of that resource pause until
+    the reset time (or Retry-After) instead of failing. The REST and the GraphQL API have
+    separate budgets (X-RateLimit-Resource) - the headers of one never update the other."""
+
+    def __init__(self, interval=POLL_INTERVAL, hourly_limit=DEFAULT_HOURLY_LIMIT):
+        self.interval = interval
+        self.hourly_limit = hourly_limit
+        self.budgets = {}               # X-RateLimit-Resource -> _Budget
+        self.lock = threading.Lock()
+
+    def _budget(self, resource):
+        budget = self.budgets.get(resource)
+        if budget is None:
+            budget = self.budgets[resource] = _Budget(self.interval, self.hourly_limit)
+        return budget
+
+    def acquire(self, resource=CORE_RESOURCE):
+        """Blocks until the next request to 'resource' may be sent."""
+        while True:
+            with self.lock:
+                wait = self._budget(resource).take(time.time())
+            if not wait:
+                return
+            if wait >= 1:
+                logger.info(f"GitHub API rate limit ({resource}): pausing for {wait:.0f}s")
+            time.sleep(wait)
+
+    def update(self, status_code, headers, resource=CORE_RESOURCE):
+        """Updates the budget from the headers of a response to a request to 'resource' -
+        the budget named by X-RateLimit-Resource, if the response has it.
+        Returns True if the response was a rate limit error - the request should then be
+        sent again, acquire() pauses until the limit has been reset."""
+        now = time.time()
+        limit = _int_header(headers, 'X-RateLimit-Limit')
+        remaining = _int_header(headers, 'X-RateLimit-Remaining')
+        reset_at = _int_header(headers, 'X-RateLimit-Reset')
+        retry_after = _int_header(headers, 'Retry-After')
+        resource = headers.get('X-RateLimit-Resource') or resource
+
+        with self.lock:
+            return self._budget(resource).update(now, status_code, limit, remaining, reset_at, retry_after)
+
+    def status(self):
+        """Returns the remaining budgets as a string for the cycle log."""
+        with self.lock:
+            if not self.budgets:
+                return "GitHub API budget: unknown"
+            return "GitHub API budget: " + ", ".join(budget.status(resource) for resource, budget in sorted(self.budgets.items()))
+
+
+def _int_header(headers, name):
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
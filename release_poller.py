@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import *
+from githubber import getRelease, latest_releases_graphql, releases_since
+import tracing
+
+# Log records emitted by a poller worker thread are collected here (per thread)
+# and replayed in the main thread in repository order, so that the log output
+# of a polling cycle does not depend on which request happened to finish first.
+_thread_buffer = threading.local()
+
+class _WorkerLogBuffer(logging.Filter):
+    """Logger filter that diverts records of poller worker threads into a buffer."""
+
+    def filter(self, record):
+        buffer = getattr(_thread_buffer, 'records', None)
+        if buffer is None:
+            return True
+        buffer.append(record)
+        return False
+
+_worker_log_buffer = _WorkerLogBuffer()
+
+
+class PollResult:
+    """Outcome of fetching the latest release (or the catch-up releases) of one repository."""
+
+    def __init__(self, repo, release=None, error=None, duration=0.0, log_records=None, releases=None):
+        self.repo = repo
+        self.release = release
+        self.releases = releases    # Catch-up: the releases since the newest one published, newest first
+        self.error = error
+        self.duration = duration
+        self.log_records = log_records or []
+
+    def replay_log(self):
+        """Emits the log records buffered while polling this repository."""
+        for record in self.log_records:
+            logger.handle(record)
+        self.log_records = []
+
+
+def _poll_repo(repo):
+    """Worker: fetches the latest release of a single repository."""
+    _thread_buffer.records = []
+    start = time.monotonic()
+    try:
+        with tracing.labels(repo=repo):
+            release = getRelease(repo, 'latest')
+        return PollResult(repo, release=release, duration=time.monotonic() - start, log_records=_thread_buffer.records)
+    except Exception as e:
+        # Failure of one repository must not affect the others
+        return PollResult(repo, error=e, duration=time.monotonic() - start, log_records=_thread_buffer.records)
+    finally:
+        _thread_buffer.records = None
+
+
+def _poll_batch(repos):
+    """Worker: fetches the latest releases of a batch of repositories with one GraphQL query."""
+    start = time.monotonic()
+    try:
+        releases = latest_releases_graphql(repos)
+    except Exception as e:
+        # The whole batch failed - every repository of it gets the error
+        duration = time.monotonic() - start
+        return [PollResult(repo, error=e, duration=duration) for repo in repos]
+    duration = time.monotonic() - start
+    return [PollResult(repo, release=releases[repo][0], error=releases[repo][1], duration=duration) for repo in repos]
+
+
+def _catch_up_repo(repo_since):
+    """Worker: fetches the releases of a single repository published after a given time."""
+    repo, since = repo_since
+    start = time.monotonic()
+    try:
+        with tracing.labels(repo=repo):
+            releases = releases_since(repo, since)
+        return PollResult(repo, releases=releases, duration=time.monotonic() - start)
+    except Exception as e:
+        return PollResult(repo, error=e, duration=time.monotonic() - start)
+
+
+def catch_up_releases(since_by_repo, workers=POLL_WORKERS):
+    """Fetches the releases published after the given times (dict repo -> epoch seconds) in parallel.
+    Returns dict repo -> PollResult with the releases in 'releases'."""
+
+    if not since_by_repo:
+        return {}
+
+    workers = max(1, min(workers, len(since_by_repo)))
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="catchup") as executor:
+        results = list(executor.map(_catch_up_repo, since_by_repo.items()))
+
+    found = sum(len(result.releases) for result in results if result.error is None)
+    logger.info(f"Caught up {len(results)} repositories in {time.monotonic() - start:.2f}s: {found} releases since the last published ones")
+    return {result.repo: result for result in results}
+
+
+def poll_latest_releases(repos, workers=POLL_WORKERS, backend=POLL_BACKEND, batch_size=GRAPHQL_BATCH_SIZE):
+    """Fetches the latest release of every repository in parallel - with the "rest" backend one
+    request per repository, with "graphql" one query per 'batch_size' repositories.
+    Returns a list of PollResult objects in the same order as 'repos'."""
+
+    if not repos:
+        return []
+    if backend not in ("rest", "graphql"):
+        raise ValueError(f"Invalid polling backend '{backend}'")
+
+    start = time.monotonic()
+    if backend == "graphql":
+        batches = [repos[i:i + batch_size] for i in range(0, len(repos), batch_size)]
+        workers = max(1, min(workers, len(batches)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="poller") as executor:
+            results = [result for batch in executor.map(_poll_batch, batches) for result in batch]
+        requests = len(batches)
+    else:
+        workers = max(1, min(workers, len(repos)))
+        if _worker_log_buffer not in logger.filters:
+            logger.addFilter(_worker_log_buffer)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="poller") as executor:
+            results = list(executor.map(_poll_repo, repos))
+        requests = len(repos)
+
+    elapsed = time.monotonic() - start
+    failures = sum(1 for result in results if result.error is not None)
+    slowest = max(results, key=lambda result: result.duration)
+    sequential = sum(result.duration for result in results)
+    logger.info(f"Polled {len(results)} repositories in {elapsed:.2f}s with {requests} {backend} requests "
+                f"(workers: {workers}, failures: {failures}, sequential time: {sequential:.2f}s, "
+                f"slowest: {slowest.repo} {slowest.duration:.2f}s)")
+
+    return results
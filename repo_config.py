@@ -0,0 +1,138 @@
+import os
+import re
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from config import *
+
+# The supported repositories file (data/supported_repos): one repository per line, with optional settings
+#
+#   <owner>/<repo> [min=<seconds>] [max=<seconds>] [interval=<seconds>] [assets=<regex>] [dev=<marker>,...]
+#
+#   min, max  - limits of the adaptive polling interval of the repository
+#   interval  - a fixed polling interval, the same as min and max
+#   assets    - the APK assets published: re.search() on the asset name, default ASSET_PATTERN
+#   dev       - what in the release name marks a development release, default DEV_RELEASE_MARKERS;
+#               dev=* publishes every release
+#
+# Text after '#' is a comment. The file is parsed and validated once into an immutable mapping
+# repo -> RepoSettings, and parsed again only when it has changed: the check of a cycle is a
+# single stat(). A file with errors is rejected as a whole and the previous settings are kept.
+
+REPO_NAME = re.compile(r'^[\w.-]+/[\w.-]+$')
+
+# The settings of a supported repository - None: the default
+RepoSettings = namedtuple("RepoSettings", "repo min_interval max_interval asset_pattern dev_markers")
+
+
+def default_settings(repo):
+    return RepoSettings(repo, None, None, ASSET_PATTERN, DEV_RELEASE_MARKERS)
+
+def settings_for(repos, repo):
+    """Returns the settings of 'repo' in 'repos' (see parse_repo_config()), or the default ones."""
+    settings = repos.get(repo) if repos is not None else None
+    return settings if settings is not None else default_settings(repo)
+
+def _seconds(key, value):
+    seconds = int(value)
+    if seconds <= 0:
+        raise ValueError(f"'{key}' must be a positive number of seconds")
+    return seconds
+
+def parse_repo_line(line):
+    """Parses a line of the supported repositories file.
+    Returns RepoSettings, or None for empty and comment lines. Raises ValueError if the line is invalid."""
+    line = line.split('#', 1)[0].strip()
+    if not line:
+        return None
+
+    fields = line.split()
+    repo = fields[0]
+    if not REPO_NAME.match(repo):
+        raise ValueError(f"Invalid repository '{repo}' - expected <owner>/<repo>")
+    settings = default_settings(repo)._asdict()
+    seen = set()
+    for field in fields[1:]:
+        key, sep, value = field.partition('=')
+        if not sep or not value or key in seen:
+            raise ValueError(f"Invalid or repeated option '{field}' for repository {repo}")
+        seen.add(key)
+        if key == 'min':
+            settings['min_interval'] = _seconds(key, value)
+        elif key == 'max':
+            settings['max_interval'] = _seconds(key, value)
+        elif key == 'interval':
+            settings['min_interval'] = settings['max_interval'] = _seconds(key, value)
+        elif key == 'assets':
+            try:
+                re.compile(value)
+            except re.error as e:
+                raise ValueError(f"Invalid asset pattern '{value}' for repository {repo}: {e}")
+            settings['asset_pattern'] = value
+        elif key == 'dev':
+            settings['dev_markers'] = tuple(marker for marker in value.split(',') if marker)
+            if not settings['dev_markers']:
+                raise ValueError(f"Empty 'dev' marker list for repository {repo}")
+        else:
+            raise ValueError(f"Unknown option '{field}' for repository {repo}")
+    if 'interval' in seen and seen & {'min', 'max'}:
+        raise ValueError(f"Repository {repo} has both 'interval' and 'min' or 'max'")
+    if settings['min_interval'] and settings['max_interval'] and settings['min_interval'] > settings['max_interval']:
+        raise ValueError(f"Repository {repo} has 'min' greater than 'max'")
+    return RepoSettings(**settings)
+
+def parse_repo_config(lines):
+    """Parses and validates the lines of the supported repositories file.
+    Returns a read-only mapping repo -> RepoSettings. Raises ValueError on the first invalid line."""
+    repos = {}
+    names = set()
+    for number, line in enumerate(lines, 1):
+        try:
+            settings = parse_repo_line(line)
+        except ValueError as e:
+            raise ValueError(f"line {number}: {e}")
+        if settings is None:
+            continue
+        if settings.repo.lower() in names:
+            raise ValueError(f"line {number}: repository {settings.repo} is listed twice")
+        names.add(settings.repo.lower())
+        repos[settings.repo] = settings
+    return MappingProxyType(repos)
+
+
+class RepoConfigFile:
+    """The supported repositories file, parsed again only when it has changed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stamp = None       # (mtime, size, inode) of the file last parsed
+        self.repos = None       # The last valid settings
+
+    def get(self, force=False):
+        """Returns the settings of the supported repositories, see parse_repo_config(). The file is
+        parsed again if it has changed since the last call, or with 'force'. An invalid file is
+        logged and the previous settings are returned - raised if there are none."""
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        with self.lock:
+            if stamp == self.stamp and not force:
+                return self.repos
+            self.stamp = stamp
+            try:
+                with open(self.path, 'r') as file:
+                    repos = parse_repo_config(file)
+            except (OSError, ValueError) as e:
+                if self.repos is None:
+                    raise ValueError(f"Invalid supported repositories file {self.path}: {e}")
+                logger.error(f"Invalid supported repositories file {self.path}: {e} - keeping the previous settings")
+                return self.repos
+
+            if self.repos is not None:
+                added = [repo for repo in repos if repo not in self.repos]
+                removed = [repo for repo in self.repos if repo not in repos]
+                changed = [repo for repo in repos if repo in self.repos and repos[repo] != self.repos[repo]]
+                logger.info(f"Supported repositories reloaded: {len(added)} added, {len(removed)} removed, {len(changed)} changed")
+            self.repos = repos
+            return repos
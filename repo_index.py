@@ -0,0 +1,130 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from config import *
+from apk_cache import get_apk_cache, sha256_of_file
+from apk_checker import get_apk_info_cached
+from tracing import traced
+
+# Inventory of the APKs in the F-Droid build repository (BUILD_REPO_DIR), kept up to date
+# incrementally: a scan only stats the files, and hashes and parses only the APKs that are
+# new or have changed (size or mtime) since the previous scan.
+#
+# The inventory is what retention.py selects the old versions from, without reading every
+# APK of the repository for every publish batch (see bench_repo_index.py). It does not make
+# 'fdroid update' any faster: the command has no way to take in precomputed APK entries, it
+# hashes every APK of the repository on every run to validate its own cache.
+
+REPO_INDEX_FILE_NAME = "repo_index.db"
+
+# An APK of the repository as last scanned
+ApkEntry = namedtuple("ApkEntry", "name size mtime_ns sha256 packageName versionName versionCode application")
+
+# Outcome of a scan: the entries by file name, and what was done to get them
+RepoScan = namedtuple("RepoScan", "entries new changed removed unchanged duration")
+
+
+class RepoIndex:
+    """Persistent inventory of the APKs of a repository directory."""
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS repo_apks (
+                name TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                packageName TEXT NOT NULL,
+                versionName TEXT NOT NULL,
+                versionCode TEXT NOT NULL,
+                application TEXT NOT NULL
+            );
+        ''')
+        self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def entries(self):
+        """Returns the entries of the last scan: dict file name -> ApkEntry."""
+        with self.lock:
+            return {row[0]: ApkEntry(*row) for row in self.conn.execute('SELECT * FROM repo_apks')}
+
+    @staticmethod
+    def _read_apk(path, stat):
+        """Worker: hashes and parses a new or changed APK."""
+        cache = get_apk_cache()
+        sha256 = cache.file_digest(path) if cache is not None else sha256_of_file(path)
+        packageName, versionName, versionCode, application = get_apk_info_cached(path, sha256)
+        return ApkEntry(os.path.basename(path), stat.st_size, stat.st_mtime_ns, sha256,
+                        packageName, str(versionName), str(versionCode), application or '')
+
+    @traced("repo_scan")
+    def scan(self, repo_dir=BUILD_REPO_DIR, workers=DOWNLOAD_WORKERS):
+        """Brings the inventory up to date with the APKs in 'repo_dir'. Returns a RepoScan.
+        An APK that cannot be read is left out of the inventory (and logged)."""
+        start = time.monotonic()
+        known = self.entries()
+        found = {}
+        with os.scandir(repo_dir) as directory:
+            for item in directory:
+                if item.name.endswith(".apk") and item.is_file():
+                    found[item.name] = item.stat()
+
+        entries = {}
+        to_read = []
+        for name, stat in found.items():
+            entry = known.get(name)
+            if entry is not None and entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns:
+                entries[name] = entry
+            else:
+                to_read.append((name, stat))
+        removed = [name for name in known if name not in found]
+
+        read = []
+        if to_read:
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(to_read))), thread_name_prefix="repo-scan") as executor:
+                futures = [(name, executor.submit(self._read_apk, os.path.join(repo_dir, name), stat)) for name, stat in to_read]
+                for name, future in futures:
+                    try:
+                        read.append(future.result())
+                    except Exception:
+                        logger.exception(f"Error in reading APK {name} of the repository - left out of the inventory.")
+                        removed.append(name)
+        entries.update((entry.name, entry) for entry in read)
+
+        with self.lock:
+            self.conn.executemany('DELETE FROM repo_apks WHERE name = ?', [(name,) for name in removed])
+            self.conn.executemany('INSERT OR REPLACE INTO repo_apks VALUES (?, ?, ?, ?, ?, ?, ?, ?)', read)
+            self.conn.commit()
+
+        new = sum(1 for entry in read if entry.name not in known)
+        scan = RepoScan(entries, new, len(read) - new, len([name for name in removed if name in known]),
+                        len(entries) - len(read), time.monotonic() - start)
+        logger.debug(f"Scanned {len(entries)} APKs of {repo_dir} in {scan.duration:.3f}s: "
+                     f"{scan.new} new, {scan.changed} changed, {scan.removed} removed, {scan.unchanged} unchanged")
+        return scan
+
+
+_repo_index = None
+
+def initialize_repo_index(data_dir):
+    """Opens the inventory of the build repository stored next to the installed versions database."""
+    global _repo_index
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    cache_file = os.path.join(data_dir, REPO_INDEX_FILE_NAME)
+    _repo_index = RepoIndex(cache_file)
+    return cache_file
+
+def get_repo_index():
+    return _repo_index
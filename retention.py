@@ -0,0 +1,104 @@
+import os
+import shutil
+
+from config import *
+from installed_versions_db import fetch_version_codes
+from metadata_index import get_metadata_index
+from repo_index import get_repo_index
+from tracing import traced
+
+# Retention of the build repository: of every package published by the application (in
+# the installed versions database), only the APKs of the RETENTION_KEEP_VERSIONS newest
+# version codes are kept in BUILD_REPO_DIR. The older APKs and their changelog files are
+# moved to BUILD_ARCHIVE_DIR, or deleted. Packages not in the database - added to the
+# repository by hand - are not touched.
+#
+# Retention is applied to a publish batch after staging, before 'fdroid update', with
+# the batch's staging journal: if the build fails, the retired files are put back.
+#
+#   BUILD_ARCHIVE_DIR/<package>/<apk file>
+#   BUILD_ARCHIVE_DIR/<package>/<versionCode>.txt   - changelog
+
+def _version_code(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def oldest_kept_version(package, version_codes, keep=RETENTION_KEEP_VERSIONS, overrides=RETENTION_KEEP_OVERRIDES):
+    """Returns the oldest version code of 'package' to keep, or None to keep all.
+    'version_codes' is dict package -> version codes published, see fetch_version_codes()."""
+    keep = overrides.get(package, keep)
+    published = version_codes.get(package)
+    if not keep or not published or len(published) <= keep:
+        return None
+    return sorted(published, reverse=True)[keep - 1]
+
+def select_retired(entries, version_codes, keep=RETENTION_KEEP_VERSIONS, overrides=RETENTION_KEEP_OVERRIDES):
+    """Returns the APKs (ApkEntry objects of the repository inventory) to retire: the ones
+    older than the 'keep' newest version codes published of their package."""
+    retired = []
+    for entry in entries.values():
+        oldest_kept = oldest_kept_version(entry.packageName, version_codes, keep, overrides)
+        version_code = _version_code(entry.versionCode)
+        if oldest_kept is not None and version_code is not None and version_code < oldest_kept:
+            retired.append(entry)
+    return sorted(retired, key=lambda entry: (entry.packageName, _version_code(entry.versionCode), entry.name))
+
+@traced("retention")
+def apply_retention(db_file, journal, staged=(), mode=RETENTION_MODE, keep=RETENTION_KEEP_VERSIONS, overrides=RETENTION_KEEP_OVERRIDES,
+                    repo_dir=BUILD_REPO_DIR, archive_dir=BUILD_ARCHIVE_DIR, index=None):
+    """Retires the old versions from the build repository, recording the changes to 'journal'
+    (StagingJournal). 'staged' are the (package, version code) of the batch, counted as
+    published although not in the database yet. The changelog removals are queued to the
+    metadata index, to be written by its flush(). Returns the packages whose files were retired."""
+    if mode not in ("archive", "delete"):
+        raise ValueError(f"Invalid retention mode '{mode}'")
+    if not keep and not overrides:
+        return set()
+    repo_index = get_repo_index()
+    if repo_index is None:
+        logger.warning("No build repository inventory - retention not applied.")
+        return set()
+    if index is None:
+        index = get_metadata_index()
+
+    version_codes = fetch_version_codes(db_file)
+    for package, version_code in staged:
+        if _version_code(version_code) is not None:
+            version_codes.setdefault(package, set()).add(_version_code(version_code))
+    retired = select_retired(repo_index.scan(repo_dir).entries, version_codes, keep, overrides)
+    for entry in retired:
+        path = os.path.join(repo_dir, entry.name)
+        journal.will_write(path)
+        if mode == "archive":
+            target = os.path.join(archive_dir, entry.packageName, entry.name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Left by a batch that was rolled back - possibly a hardlink of the same file,
+            # which rename() would leave in both places
+            if os.path.exists(target):
+                os.remove(target)
+            shutil.move(path, target)
+        else:
+            os.remove(path)
+        logger.debug(f"Retired {path} ({entry.packageName} version code {entry.versionCode})")
+
+    # The changelogs of the retired versions - also of the ones whose APK has been removed otherwise
+    packages = {entry.packageName for entry in retired}
+    changelogs = 0
+    for package in version_codes:
+        oldest_kept = oldest_kept_version(package, version_codes, keep, overrides)
+        entry = index.get(package)
+        if oldest_kept is None or entry is None:
+            continue
+        old = [version_code for version_code in map(_version_code, entry.changelogs)
+               if version_code is not None and version_code < oldest_kept]
+        count = index.retire_changelogs(package, old, journal, archive_dir if mode == "archive" else None)
+        if count:
+            changelogs += count
+            packages.add(package)
+
+    if packages:
+        verb = "Archived" if mode == "archive" else "Deleted"
+        logger.info(f"{verb} {len(retired)} old APKs and {changelogs} changelogs of {len(packages)} packages from the build repository")
+    return packages
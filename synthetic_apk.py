@@ -0,0 +1,93 @@
+import os
+import struct
+import zipfile
+
+# Generates minimal APK files for the benchmarks: a binary AndroidManifest.xml with
+# package name, version and application label, plus a stored (uncompressed) payload
+# entry that brings the APK up to the requested size. The APKs are not signed and
+# cannot be installed, but they are parsed like real ones by get_apk_info().
+
+ANDROID_NS = "http://schemas.android.com/apk/res/android"
+
+# Resource IDs of the android: attributes used in the manifest
+ATTR_RESOURCE_IDS = {
+    "label": 0x01010001,
+    "versionCode": 0x0101021b,
+    "versionName": 0x0101021c,
+}
+
+TYPE_STRING  = 0x03
+TYPE_INT_DEC = 0x10
+
+
+def _string_pool(strings):
+    """UTF-16 string pool chunk."""
+    offsets = b""
+    data = b""
+    for string in strings:
+        offsets += struct.pack("<I", len(data))
+        encoded = string.encode("utf-16-le")
+        data += struct.pack("<H", len(string)) + encoded + b"\x00\x00"
+    data += b"\x00" * (-len(data) % 4)
+    header_size = 28
+    strings_start = header_size + len(offsets)
+    chunk_size = strings_start + len(data)
+    header = struct.pack("<HHIIIIII", 0x0001, header_size, chunk_size, len(strings), 0, 0, strings_start, 0)
+    return header + offsets + data
+
+def _resource_map(resource_ids):
+    return struct.pack("<HHI", 0x0180, 8, 8 + 4 * len(resource_ids)) + b"".join(struct.pack("<I", rid) for rid in resource_ids)
+
+def _namespace(chunk_type, prefix, uri):
+    return struct.pack("<HHIIiii", chunk_type, 16, 24, 1, -1, prefix, uri)
+
+def _start_element(name, attributes):
+    """'attributes' is a list of (namespace, name, raw_value, data_type, data) string pool indexes/values."""
+    body = b"".join(struct.pack("<iiiHBBI", ns, attr_name, raw, 8, 0, data_type, data & 0xFFFFFFFF)
+                    for ns, attr_name, raw, data_type, data in attributes)
+    size = 36 + len(body)
+    return struct.pack("<HHIIiiiHHHHHH", 0x0102, 16, size, 1, -1, -1, name, 20, 20, len(attributes), 0, 0, 0) + body
+
+def _end_element(name):
+    return struct.pack("<HHIIiii", 0x0103, 16, 24, 1, -1, -1, name)
+
+def build_manifest(package, version_name, version_code, application):
+    """Returns a binary (AXML) AndroidManifest.xml."""
+    # Attribute names with a resource ID come first in the string pool, in the order of the resource map
+    strings = ["label", "versionCode", "versionName",
+               "android", ANDROID_NS, "package", "manifest", "application",
+               package, version_name, application]
+    index = {string: i for i, string in enumerate(strings)}
+    ns = index[ANDROID_NS]
+
+    manifest_attributes = [
+        (ns, index["versionCode"], -1, TYPE_INT_DEC, int(version_code)),
+        (ns, index["versionName"], index[version_name], TYPE_STRING, index[version_name]),
+        (-1, index["package"], index[package], TYPE_STRING, index[package]),
+    ]
+    application_attributes = [
+        (ns, index["label"], index[application], TYPE_STRING, index[application]),
+    ]
+
+    body = (_string_pool(strings)
+            + _resource_map([ATTR_RESOURCE_IDS[name] for name in strings[:3]])
+            + _namespace(0x0100, index["android"], ns)
+            + _start_element(index["manifest"], manifest_attributes)
+            + _start_element(index["application"], application_attributes)
+            + _end_element(index["application"])
+            + _end_element(index["manifest"])
+            + _namespace(0x0101, index["android"], ns))
+    return struct.pack("<HHI", 0x0003, 8, 8 + len(body)) + body
+
+def write_synthetic_apk(filename, package, version_name, version_code, application, size=1024 * 1024):
+    """Writes an APK of roughly 'size' bytes."""
+    with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as apk:
+        apk.writestr("AndroidManifest.xml", build_manifest(package, version_name, version_code, application))
+        payload_size = max(0, size - 1024)
+        # Random (incompressible) payload, like the dex files and native libraries of a real APK
+        with apk.open(zipfile.ZipInfo("assets/payload.bin"), "w") as payload:
+            while payload_size > 0:
+                chunk = os.urandom(min(payload_size, 1024 * 1024))
+                payload.write(chunk)
+                payload_size -= len(chunk)
+    return filename
@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+import argparse
 import os
 from sys import exception
 import time
@@ -15,6 +16,20 @@ from installed_versions_db import *
 from githubber import *
 from apk_checker import *
 from fdroid_builder import *
+from release_poller import *
+from etag_cache import *
+from http_client import rate_limit_status
+from poll_scheduler import *
+from repo_config import RepoConfigFile, settings_for
+from apk_cache import initialize_apk_cache
+from repo_index import initialize_repo_index
+from publish_pipeline import PendingRelease, PublishPipeline
+from metadata_index import initialize_metadata_index
+from daemon import DaemonState, install_signal_handlers, start_health_server
+from webhook import WebhookReceiver
+from work_leases import LeaseManager, worker_file_suffix
+import metrics
+import tracing
 
 def check_directories():
     # Are we running in Windows or Linux?
@@ -49,23 +64,220 @@ def check_directories():
 
     return True
 
-def read_supported_repos():
-    """Reads all lines from the specified file."""
-    if not os.path.exists(SUPPORTED_REPOS_FILE):
-        raise FileNotFoundError(f"The file '{SUPPORTED_REPOS_FILE}' does not exist.")
-    with open(SUPPORTED_REPOS_FILE, 'r') as file:
-        return file.readlines()
+def newest_release_timestamps(db_file):
+    """Returns dict repo -> epoch seconds of the newest release in the database."""
+    timestamps = {}
+    for repo, date in fetch_newest_release_dates(db_file).items():
+        try:
+            timestamps[repo] = release_timestamp(date)
+        except (ValueError, AttributeError):
+            logger.debug(f"Invalid release date '{date}' of {repo} in the database - not caught up.")
+    return timestamps
+
+def is_dev_release(relname, markers=DEV_RELEASE_MARKERS):
+    """True if the release name has one of the development release markers - any release with '*'."""
+    return any(marker == "*" or marker in relname for marker in markers)
+
+
+def webhook_poll_results(webhooks, scheduler, repo_settings=None):
+    """Returns the releases received by the webhook listener as PollResult objects. A development
+    release whose APK is not uploaded yet is left to a poll of the repository soon."""
+    results = []
+    for repo, release in webhooks.take_releases():
+        settings = settings_for(repo_settings, repo)
+        if is_dev_release(release['name'] or '', settings.dev_markers) and not get_apk_assets(release, settings.asset_pattern):
+            logger.info(f"Release {release['name']} of {repo} has no APK yet - polling it again in {WEBHOOK_ASSET_POLL_DELAY} seconds")
+            scheduler.poll_soon(repo, WEBHOOK_ASSET_POLL_DELAY)
+            continue
+        results.append(PollResult(repo, release=release))
+    return results
+
+
+def queue_new_releases(poll_results, pipeline, db_file, repo_settings=None):
+    """Parses the polled latest releases and queues the APK assets of the new development releases
+    to 'pipeline'. When the latest release of a repository has changed, also the releases published
+    since the newest one in the database are checked (catch-up). A repository may have several
+    results, e.g. a poll and webhook events. 'repo_settings' are the settings of the supported
+    repositories (asset pattern, development release markers). Returns the number of assets queued."""
+    try:
+        newest_release = newest_release_timestamps(db_file) if CATCHUP_MAX_PAGES > 0 else {}
+    except Exception as e:
+        logger.exception("Error in reading the newest releases from the database. Checking only the latest releases.")
+        newest_release = {}
+
+    # ---------------------
+    # Release checking - pick the repositories with a new latest release
+    # ---------------------
+    releases_of = {}        # repo -> releases to check, newest first
+    since_by_repo = {}      # repo -> time of the newest release in the database, for the repositories to catch up
+    for poll_result in poll_results:
+        repo = poll_result.repo
+        logger.info(f"Checking {repo}...")
+        poll_result.replay_log()
+
+        try:
+            if poll_result.error is not None:
+                raise poll_result.error
+            latestRelease = poll_result.release
+            if latestRelease == RELEASE_NOT_MODIFIED:
+                logger.debug(f"Latest release of {repo} not modified since the last check. Skip.")
+                continue
+            published = release_timestamp(latestRelease['published_at'])
+        except Exception as e:
+            error_msg = f"Error in getting latest release data from {repo}. Skipping this repository"
+            logger.exception(error_msg)
+            continue
+
+        releases_of.setdefault(repo, []).insert(0, latestRelease)
+        # Releases newer than the newest one published may have been missed - a repository without
+        # published releases is not caught up, its history is not published
+        if repo in newest_release and published > newest_release[repo]:
+            since_by_repo[repo] = newest_release[repo]
+
+    # Fetch the releases since the newest ones published in parallel
+    for repo, result in catch_up_releases(since_by_repo, POLL_WORKERS).items():
+        if result.error is not None:
+            logger.error(f"Error in catching up the releases of {repo}: {result.error}. Checking only the latest release.")
+        elif result.releases:
+            releases_of[repo] = result.releases
+
+    # ---------------------
+    # Parse the releases - every matching APK asset of a development release is a candidate, oldest release first
+    # ---------------------
+    candidates = []
+    checked_repos = []      # Repositories whose releases were all checked without errors
+    for repo, releases in releases_of.items():
+        settings = settings_for(repo_settings, repo)
+        errors = False
+        for release in reversed(releases):
+            try:
+                relname = release['name'].strip()
+                # Is this a development release?
+                if not is_dev_release(relname, settings.dev_markers):
+                    logger.debug(f"Release {relname} is not a development release. Skipping...")
+                    continue
+                else:
+                    logger.debug(f"Release {relname} is a development release. Proceeding...")
+
+                assets = get_apk_assets(release, settings.asset_pattern)
+                if not assets:
+                    raise Exception(f"No APK file matching '{settings.asset_pattern}' in release {relname}")
+                with tracing.labels(repo=repo, release=relname):
+                    for asset in assets:
+                        URL, relname, filename, version, date, relnotes, html_url = parse_release_data(release, asset)
+                        candidates.append(PendingRelease(repo, URL, relname, filename, date, relnotes, html_url,
+                                                         asset.get('size'), asset_sha256(asset)))
+            except Exception as e:
+                error_msg = f"Error in getting release data from {repo}. Skipping release {release.get('name')}"
+                logger.exception(error_msg)
+                errors = True
+            else:
+                logger.debug(f"Release data of {relname} from {repo} parsed successfully.")
+        if not errors:
+            checked_repos.append(repo)
+
+    # Check which of the assets are already in the database - one query for the whole cycle
+    try:
+        assets_in_db = existing_assets(db_file, [release.key for release in candidates])
+    except Exception as e:
+        error_msg = f"Error in checking if releases exist in the database. Skipping releases of this round."
+        logger.exception(error_msg)
+        return 0
+
+    # ---------------------
+    # Release checking main loop - queue the new assets for publishing
+    # ---------------------
+    queued = 0
+    queued_repos = set()
+    for release in candidates:
+
+        # Check if the asset of the release is already in the database
+        if release.key in assets_in_db:
+            logger.debug(f"{release.repo} release {release.relname} ({release.asset}) already exists in the database. Skip.")
+            continue
+        else:
+            logger.debug(f"Release {release.relname} ({release.asset}) not found in the database. Proceeding...")
+
+        queued_repos.add(release.repo)
+        if pipeline.enqueue(release):
+            queued += 1
+
+    # The repositories with nothing to publish are done - the others once their releases are published
+    for repo in checked_repos:
+        if repo not in queued_repos:
+            confirm_release_checked(repo)
+
+    return queued
+
+
+def publish_queued_releases(pipeline, scheduler):
+    """Publishes the releases queued to 'pipeline' as one batch and records them as checked.
+    Returns the published releases (or the ones handed over to the build leader)."""
+    published = pipeline.run_batch()
+    for release in published:
+        if release.handed_over:
+            logger.info(f"Release {release.relname} ({release.asset}) of {release.repo} handed over to the build leader")
+            # A repository with a release that failed to be prepared is checked again by the next poll
+            if release.repo not in pipeline.failed_repos:
+                confirm_release_checked(release.repo)
+            scheduler.record_release(release.repo, release.date)
+            scheduler.reschedule(release.repo)
+            continue
+        formatted_db_info = f"""
+            Added new release to the database:
+            - GitHub repo:  {release.repo}
+            - Release:      {release.relname}
+            - APK file:     {release.asset}
+            - PackageName:  {release.packageName}
+            - VersionName:  {release.versionName}
+            - VersionCode:  {release.versionCode}
+            - Release date: {release.date}"""
+        logger.info(formatted_db_info)
+        # A repository with a failed release is checked again by the next poll
+        if release.repo not in pipeline.failed_repos:
+            confirm_release_checked(release.repo)
+
+        # A fresh release tightens the polling interval of the repository
+        scheduler.record_release(release.repo, release.date)
+        scheduler.reschedule(release.repo)
+
+    return published
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Publishes development releases of GitHub repositories in a F-Droid repository.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="stop gracefully on SIGTERM, reload supported repositories on SIGHUP, serve /health and /metrics")
+    parser.add_argument("--json-log", action="store_true", help=f"write also a JSON lines log '{LOG_JSON_FILE}' in the log directory")
+    parser.add_argument("--async-log", action="store_true", help="write the logs in a background thread")
+    parser.add_argument("--log-level", action="append", default=[], metavar="MODULE=LEVEL",
+                        help="lowest level logged from a module, e.g. http_client=INFO (can be repeated)")
+    parser.add_argument("--health-port", type=int, default=HEALTH_PORT, help=f"port of the health and metrics endpoint (default {HEALTH_PORT})")
+    parser.add_argument("--worker", metavar="ID", nargs="?", const="",
+                        help="run as one of several workers sharing the data directory - the id defaults to <host>-<pid>")
+    parser.add_argument("--webhook", action="store_true",
+                        help="publish the releases of GitHub 'release' webhook events right away, poll only as a safety net")
+    parser.add_argument("--webhook-port", type=int, default=WEBHOOK_PORT, help=f"port of the webhook listener (default {WEBHOOK_PORT})")
+    args = parser.parse_args()
+    module_levels = dict(LOG_MODULE_LEVELS)
+    for option in args.log_level:
+        module, sep, level = option.partition("=")
+        try:
+            if not sep or not module:
+                raise ValueError("expected MODULE=LEVEL")
+            module_levels[module] = parse_level(level)
+        except ValueError as e:
+            parser.error(f"argument --log-level: invalid value '{option}': {e}")
+
     # Set up the logger to log to both console and file
     log_dir_path  = os.path.join(ROOT_DIR, LOG_DIR)
     log_file_path = os.path.join(log_dir_path, LOG_FILE)
+    json_log_file_path = os.path.join(log_dir_path, LOG_JSON_FILE) if args.json_log else None
     try:
         if not os.path.exists(log_dir_path):
             os.makedirs(log_dir_path)
-        setup_logging(logger, log_file_path)    
+        setup_logging(logger, log_file_path, json_log_file_path, args.async_log, module_levels, LOG_FILE_LEVEL)
     except Exception as e:
         error_msg = f"Error in setting up logging to directory {log_dir_path} - cannot proceed"
         print(f"{error_msg}: {e}")
@@ -74,6 +286,8 @@ if __name__ == "__main__":
         logger.info("")
         logger.info("************************ Starting the application ************************")
         logger.info(f"Logging set up successfully in '{log_file_path}'")
+        if json_log_file_path:
+            logger.info(f"JSON lines log in '{json_log_file_path}'")
 
     # Initial checks - stop if any of the checks fail
     # Directories
@@ -84,9 +298,10 @@ if __name__ == "__main__":
     else:
         logger.debug("Directories check OK")
 
-    # Supported repositories
+    # Supported repositories - parsed again only when the file changes
+    repo_config = RepoConfigFile(SUPPORTED_REPOS_FILE)
     try:
-        supported_repos = read_supported_repos()
+        supported_repos = repo_config.get()
     except Exception as e:
         error_msg = "Error in reading list of supported repositories - cannot proceed" 
         logger.exception(error_msg)
@@ -95,8 +310,14 @@ if __name__ == "__main__":
         logger.debug("Supported repositories read successfully.")
 
     repos_str = "\n\tSupported repositories:"
-    for repo in supported_repos:
-        repos_str += f"\n\t - {repo.strip()}"
+    for repo, settings in supported_repos.items():
+        repos_str += f"\n\t - {repo}"
+        if settings.min_interval or settings.max_interval:
+            repos_str += f" (polled every {settings.min_interval or POLL_INTERVAL_MIN}-{settings.max_interval or POLL_INTERVAL_MAX}s)"
+        if settings.asset_pattern != ASSET_PATTERN:
+            repos_str += f" assets '{settings.asset_pattern}'"
+        if settings.dev_markers != DEV_RELEASE_MARKERS:
+            repos_str += f" development releases '{','.join(settings.dev_markers)}'"
     logger.info(repos_str)
 
     # logger.debug("Supported Repositories:")
@@ -112,7 +333,61 @@ if __name__ == "__main__":
         raise
     else:
         logger.debug(f"Sqlite3 database '{DB_FILE}' initialized successfully.")
-    
+
+    # Leases of the repositories and of the build leadership, when running as one of several workers
+    leases = None
+    if args.worker is not None:
+        try:
+            leases = LeaseManager(DB_FILE, args.worker or None)
+            leases.start_heartbeat()
+        except:
+            error_msg = "Error in initializing the worker leases - cannot proceed."
+            logger.exception(error_msg)
+            raise
+        else:
+            logger.info(f"Running as worker {leases.worker_id}")
+
+    # Cache of the ETag/Last-Modified validators of the GitHub responses
+    try:
+        etag_cache_file = initialize_etag_cache(DATA_DIR, ETAG_CACHE_FILE_NAME if leases is None else
+                                                f"etag_cache.{worker_file_suffix(leases.worker_id)}.json")
+    except:
+        error_msg = "Error in initializing ETag cache - cannot proceed."
+        logger.exception(error_msg)
+        raise
+    else:
+        logger.debug(f"ETag cache '{etag_cache_file}' initialized successfully.")
+
+    # Cache of the parsed APK metadata
+    try:
+        apk_cache_file = initialize_apk_cache(DATA_DIR)
+    except:
+        error_msg = "Error in initializing APK metadata cache - cannot proceed."
+        logger.exception(error_msg)
+        raise
+    else:
+        logger.debug(f"APK metadata cache '{apk_cache_file}' initialized successfully.")
+
+    # Inventory of the APKs of the build repository - 'fdroid update' is skipped if nothing has changed
+    try:
+        repo_index_file = initialize_repo_index(DATA_DIR)
+    except:
+        error_msg = "Error in initializing the build repository inventory - cannot proceed."
+        logger.exception(error_msg)
+        raise
+    else:
+        logger.debug(f"Build repository inventory '{repo_index_file}' initialized successfully.")
+
+    # Index of the F-Droid metadata - read once, kept up to date in memory
+    try:
+        package_count = initialize_metadata_index(BUILD_METADATA_DIR)
+    except:
+        error_msg = f"Error in reading F-Droid metadata directory {BUILD_METADATA_DIR} - cannot proceed."
+        logger.exception(error_msg)
+        raise
+    else:
+        logger.debug(f"F-Droid metadata of {package_count} packages indexed.")
+
     # GitHub access
     try:
         initialize_githubber()
@@ -123,174 +398,127 @@ if __name__ == "__main__":
     else:
         logger.debug("Githubber initialized successfully.")
 
+    # Polling schedule - the polling interval of each repository adapts to its release history
+    try:
+        scheduler = PollScheduler(fetch_release_dates(DB_FILE),
+                                  floor_interval=WEBHOOK_POLL_INTERVAL_MIN if args.webhook else 0)
+    except:
+        error_msg = "Error in reading release history from the database - cannot proceed."
+        logger.exception(error_msg)
+        raise
+
+    # Daemon mode - signals and the health endpoint
+    state = DaemonState()
+    if args.daemon:
+        install_signal_handlers(state)
+        try:
+            health_server = start_health_server(state, HEALTH_HOST, args.health_port)
+        except:
+            error_msg = f"Error in starting health server on {HEALTH_HOST}:{args.health_port} - cannot proceed."
+            logger.exception(error_msg)
+            raise
+
+    # Webhook listener - the received releases wake up the main loop
+    webhooks = None
+    if args.webhook:
+        try:
+            webhooks = WebhookReceiver(os.environ.get('GITHUB_WEBHOOK_SECRET'), wakeup=state.wakeup)
+            webhooks.set_repos(supported_repos)
+            webhooks.start(WEBHOOK_HOST, args.webhook_port)
+        except:
+            error_msg = f"Error in starting the webhook listener on {WEBHOOK_HOST}:{args.webhook_port} - cannot proceed."
+            logger.exception(error_msg)
+            raise
+
+    # Releases to publish - queued by the release checking, published in batches
+    pipeline = PublishPipeline(DB_FILE, should_stop=state.should_stop, leases=leases)
+
     logger.info("Initialization and initial checking done")
 
     # ---------------------
     # Application main loop
     # ---------------------
-    while True:
+    while not state.should_stop():
+        # A burst of webhook events is published as one batch - wait until it has settled
+        if webhooks is not None and webhooks.seconds_until_ready() > 0:
+            state.wait(webhooks.seconds_until_ready())
+            continue
+
         logger.info("----------------------------------------------------------------")
         logger.info("Checking for new published GitHub releases in supported repos...")
-        changes_made_to_fdroid = False
 
         # The main loop - continue and try again if any of the checks fail
+        # The file is parsed again when it has changed, SIGHUP also when it seems unchanged
+        reload_requested = state.reload_requested.is_set()
+        state.reload_requested.clear()
         try:
-            supported_repos = read_supported_repos()
+            supported_repos = repo_config.get(force=reload_requested)
+            repo_options = dict(supported_repos)
+            if webhooks is not None:
+                webhooks.set_repos(repo_options)
+            if leases is not None:
+                # This worker polls only its share of the repositories
+                my_repos = leases.balance_repos(repo_options)
+                repo_options = {repo: options for repo, options in repo_options.items() if repo in my_repos}
+            scheduler.set_repos(repo_options)
         except:
             error_msg = "Error in reading list of supported repositories. Retry in 60 seconds..."
             logger.exception(error_msg)
-            time.sleep(60)
+            state.wait(60)
             continue
 
-        # ---------------------
-        # Release checking main loop
-        # ---------------------
-        for repo in supported_repos:
-            repo = repo.strip()
-            logger.info(f"Checking {repo}...")
-
-            # Get the latest release data from the repository and parse it
-            try:
-                latestRelease = getRelease(repo, 'latest')
-                URL, relname, filename, version, date, relnotes, html_url  = parse_release_data(latestRelease)
-            except Exception as e:
-                error_msg = f"Error in getting latest release data from {repo}. Skipping this repository"
-                logger.exception(error_msg)
-                continue
-            else:
-                logger.debug(f"Latest release data from {repo} parsed successfully.")
-
-            # Is this a development release?
-            if False == ("-dev" in relname or "_dev" in relname):
-                logger.debug(f"Release {relname} is not a development release. Skipping...")
-                continue
-            else:
-                logger.debug(f"Release {relname} is a development release. Proceeding...")
-
-            # Check if the release is already in the database
-            try:
-                if release_exist(DB_FILE, repo, relname):
-                    logger.debug(f"{repo} release {relname} already exists in the database. Skip.")
-                    continue
-            except Exception as e:
-                error_msg = f"Error in checking if release {relname} exists in the database. Skipping this release {relname}."
-                logger.exception(error_msg)
-                continue
-            else:
-                logger.debug(f"Release {relname} not found in the database. Proceeding...")
-
-            # Download the APK file of the release (the first file with .apk in its name)
-            try:
-                logger.debug(f"Start downloading APK file of release {relname}...")
-                download_apk_file(URL, filename)
-            except Exception as e:
-                error_msg = f"Error in downloading APK file {filename}. Skipping this release {relname}."
-                logger.exception(error_msg)
-                continue
-            else:
-                logger.debug(f"APK file {filename} of release {relname} downloaded successfully.")
-
-            # Double-check that the file was downloaded successfully
-            if not os.path.exists(filename):
-                logger.error(f"Problem in accessing file {filename}. Skipping this release {relname}.")
-                continue
-
-            # Get metadata from the APK file
-            try:
-                apk_packageName, apk_versionName, apk_versionCode, apk_application = get_apk_info(filename)
-            except Exception as e:
-                error_msg = f"Error in extracting APK info from {filename}. Skipping this release {relname}."
-                logger.exception(error_msg)
-                continue
-            else:
-                logger.debug(f"APK info from {filename} extracted successfully.")
-
-            orgfilename = filename
-
-            # Make sure the apk file name contain the version name in it
-            try:
-                if False == (apk_versionName in filename):
-                    # Fix the filename to contain the version name and version code
-                    new_filename = filename.replace(".apk", "")
-                    new_filename = new_filename + "-v" + apk_versionName + "." +  apk_versionCode + ".apk"
-                    os.rename(filename, new_filename)
-                    filename = new_filename
-                    logger.debug(f"Renamed {orgfilename} to {filename}")
-            except Exception as e:
-                error_msg = f"Error in renaming file {orgfilename} to {filename}. Skipping this release {relname}."
-                logger.exception(error_msg)
-                continue
-
-            """
-            filename = 'com.nordicid.yarfid-1.1.0.5.apk'
-            orgfilename = 'com.nordicid.yarfid-1.1.0.5.apk'
-            apk_versionName = '1.1.0'
-            apk_versionCode = '5'
-            apk_packageName = 'com.nordicid.yarfid'
-            apk_application = 'YARFID'
-            html_url = 'https://github.com/NordicID/YARFID/'
-            """
-
-            # Add the APK file to the F-Droid build directory and update metadata
-            try:
-                add_apk_to_fdroid(filename, apk_versionName, apk_versionCode, apk_packageName, apk_application, html_url, relnotes)
-            except Exception as e:
-                error_msg = f"Error in adding APK file {filename} to fdroid. Skipping this release {relname}."
-                logger.exception(error_msg)
-                continue
-            else:
-                logger.debug(f"APK file {filename} added to fdroid successfully.")
-
-            # All successfully done - add the release to the database
-            try:
-                insert_record(DB_FILE, repo, relname, apk_packageName, apk_versionName, apk_versionCode, date)
-            except Exception as e:
-                error_msg = f"Error in adding release {relname} to the database. Skipping this release {relname}."
-                logger.exception(error_msg)
-                continue
-            else:
-                logger.debug(f"Release {relname} added to the database successfully.")
-
-            formatted_db_info = f"""
-            Added new release to the database:
-            - GitHub repo:  {repo}
-            - Release:      {relname}
-            - PackageName:  {apk_packageName}
-            - VersionName:  {apk_versionName}
-            - VersionCode:  {apk_versionCode}
-            - Release date: {date}"""
-            logger.info(formatted_db_info)
-
-            changes_made_to_fdroid = True
-            #--------------------------------
-            # Release checking main loop - end
-            #--------------------------------
-
-        # Application main loop
-        # If changes were made to the F-Droid repository, run the fdroid update command,
-        # make a backup of the current run environment and copy the build result as a 
-        # new run environment
-        if changes_made_to_fdroid:
-            try:
-                update_fdroid_Linux()
-            except Exception as e:
-                error_msg = f"Error in updating F-Droid repository. Skipping this round."
-                logger.exception(error_msg)
-                continue
-            else:
-                logger.info("F-Droid repository updated successfully.")
-
-            try:
-                backup_and_copy_build_to_run_environment()
-            except Exception as e:
-                error_msg = f"Error in backing up old run environment and/or copying build to run environment. Skipping this round."
-                logger.exception(error_msg)
-                continue
-            else:
-                logger.info("Old run environment backed up and build copied as a new run environment.")
-
-        logger.info("Checking done. Waiting for 5 minutes before next check...")
-        time.sleep(5 * 60)
+        # Fetch the latest releases of the repositories that are due in parallel
+        cycle_start = time.monotonic()
+        reset_etag_stats()
+        tracing.reset_cycle()
+        state.set_stage("polling")
+        repos = scheduler.pop_due()
+        with tracing.span("poll"):
+            poll_results = poll_latest_releases(repos, POLL_WORKERS)
+        for repo in repos:
+            scheduler.reschedule(repo)
+        if webhooks is not None:
+            poll_results += webhook_poll_results(webhooks, scheduler, supported_repos)
+        state.set_stage("checking")
+
+        queue_new_releases(poll_results, pipeline, DB_FILE, supported_repos)
+
+        # Publish the queued releases: download, verify, stage them to the F-Droid build directory,
+        # run one fdroid update, add them to the database and deploy the build as a new run environment
+        if pipeline.has_work():
+            state.set_stage("publishing")
+            publish_queued_releases(pipeline, scheduler)
+
+        # Validators are persisted once per cycle, only for the releases handled completely
+        try:
+            save_etag_cache()
+        except Exception as e:
+            logger.exception("Error in saving ETag cache.")
+        etag_hits, etag_misses = get_etag_stats()
+        logger.info(f"Conditional requests: {etag_hits} not modified (304), {etag_misses} modified")
+        logger.info(rate_limit_status())
+        logger.info(tracing.cycle_summary())
+
+        cycle_duration = time.monotonic() - cycle_start
+        metrics.CYCLE_DURATION.observe(cycle_duration)
+        state.cycle_done()
+        if state.should_stop():
+            break
+
+        wait = scheduler.seconds_until_next()
+        if leases is not None:
+            wait = min(wait, LEASE_REBALANCE_INTERVAL)
+        logger.info(f"Checking done in {cycle_duration:.2f}s. Waiting for {wait:.0f} seconds before next check...")
+        state.wait(wait)
+
+    if leases is not None:
+        leases.release_all()
+    if webhooks is not None:
+        webhooks.stop()
+    if args.daemon:
+        health_server.shutdown()
+    logger.info("************************ Application stopped ************************")
+    shutdown_logging()
         
 
 
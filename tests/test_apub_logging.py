@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+import apub_logging
+from apub_logging import logging
+
+
+class ModuleLevelTest(unittest.TestCase):
+
+    def test_level_names(self):
+        self.assertEqual(apub_logging.parse_level("info"), logging.INFO)
+        self.assertEqual(apub_logging.parse_level(logging.WARNING), logging.WARNING)
+        self.assertEqual(apub_logging.ModuleLevelFilter({"http_client": "debug"}).module_levels, {"http_client": logging.DEBUG})
+
+    def test_unknown_level_is_rejected(self):
+        with self.assertRaises(ValueError):
+            apub_logging.ModuleLevelFilter({"http_client": "verbose"})
+
+
+class QueueLoggingTest(unittest.TestCase):
+    """With the queue, the records are formatted by the listener - with their exceptions."""
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp(prefix="test_apub_logging_")
+        self.logger = logging.getLogger("apub.test_queue")
+        self.logger.propagate = False
+
+    def tearDown(self):
+        apub_logging.shutdown_logging()
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+        shutil.rmtree(self.log_dir, ignore_errors=True)
+
+    def test_json_log_has_the_exception(self):
+        json_log = os.path.join(self.log_dir, "log.jsonl")
+        apub_logging.setup_logging(self.logger, os.path.join(self.log_dir, "log.txt"), json_log, use_queue=True)
+        try:
+            raise RuntimeError("boom")
+        except RuntimeError:
+            self.logger.debug("Failed with %s", "arguments", exc_info=True)
+        apub_logging.shutdown_logging()
+
+        with open(json_log) as f:
+            entry = json.loads(f.readline())
+        self.assertEqual(entry["message"], "Failed with arguments")
+        self.assertIn("RuntimeError: boom", entry["exception"])
+
+
+if __name__ == "__main__":
+    unittest.main()
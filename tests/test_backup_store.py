@@ -0,0 +1,91 @@
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+
+def snapshot_name(*time):
+    from backup_store import SNAPSHOT_NAME_FORMAT
+    return datetime.datetime(*time).strftime(SNAPSHOT_NAME_FORMAT)
+
+
+class SelectRetainedTest(unittest.TestCase):
+
+    def setUp(self):
+        # Imported here - config reads the GitHub URL when first imported, see test_publish_pipeline.py
+        from backup_store import select_retained
+        self.select = select_retained
+        # 2024-03-10 is a Sunday: the 9th and the 10th are in the same ISO week
+        self.names = [snapshot_name(2024, 2, 20, 10), snapshot_name(2024, 3, 1, 10), snapshot_name(2024, 3, 9, 10),
+                      snapshot_name(2024, 3, 9, 20), snapshot_name(2024, 3, 10, 8), snapshot_name(2024, 3, 10, 12)]
+
+    def test_newest_of_the_latest_days_and_weeks(self):
+        keep = self.select(self.names, keep_last=1, keep_daily=2, keep_weekly=2)
+        self.assertEqual(keep, {snapshot_name(2024, 3, 10, 12), snapshot_name(2024, 3, 9, 20), snapshot_name(2024, 3, 1, 10)})
+
+    def test_keep_last(self):
+        self.assertEqual(self.select(self.names, keep_last=3, keep_daily=0, keep_weekly=0), set(sorted(self.names)[-3:]))
+
+    def test_nothing_to_keep(self):
+        self.assertEqual(self.select(self.names, keep_last=0, keep_daily=0, keep_weekly=0), set())
+        self.assertEqual(self.select([], keep_last=2, keep_daily=2, keep_weekly=2), set())
+
+    def test_names_not_in_the_default_format_are_kept_only_as_the_newest(self):
+        names = self.names + ["before_upgrade"]
+        self.assertEqual(self.select(names, keep_last=0, keep_daily=1, keep_weekly=0), {snapshot_name(2024, 3, 10, 12)})
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        import backup_store
+        self.store = backup_store
+        self.root = tempfile.mkdtemp(prefix="test_backup_store_")
+        self.source = os.path.join(self.root, "run")
+        self.store_dir = os.path.join(self.root, "backups")
+        os.makedirs(os.path.join(self.source, "repo"))
+        self.write("repo/a.apk", b"a" * 1000)
+        self.write("repo/index-v1.json", b"{}")
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, relpath, data):
+        with open(os.path.join(self.source, relpath), 'wb') as f:
+            f.write(data)
+
+    def test_unchanged_tree_adds_no_objects(self):
+        self.assertEqual(self.store.create_snapshot(self.source, self.store_dir, name="1")[1], 2)
+        self.assertEqual(self.store.create_snapshot(self.source, self.store_dir, name="2")[1], 0)
+        self.write("repo/index-v1.json", b'{"apps": []}')
+        self.assertEqual(self.store.create_snapshot(self.source, self.store_dir, name="3")[1], 1)
+
+    def test_restore(self):
+        self.store.create_snapshot(self.source, self.store_dir, name="1")
+        target = os.path.join(self.root, "restored")
+        self.assertEqual(self.store.restore_snapshot("1", target, self.store_dir), 2)
+        with open(os.path.join(target, "repo", "a.apk"), 'rb') as f:
+            self.assertEqual(f.read(), b"a" * 1000)
+        with self.assertRaises(Exception):
+            self.store.restore_snapshot("1", target, self.store_dir)
+
+    def test_retention_collects_the_unreferenced_objects(self):
+        self.store.create_snapshot(self.source, self.store_dir, name="1")
+        self.write("repo/index-v1.json", b'{"apps": []}')
+        self.store.create_snapshot(self.source, self.store_dir, name="2")
+
+        removed, objects = self.store.apply_retention(self.store_dir, keep_last=1, keep_daily=0, keep_weekly=0)
+
+        self.assertEqual((removed, objects), (["1"], 1))
+        self.assertEqual(self.store.list_snapshots(self.store_dir), ["2"])
+        target = os.path.join(self.root, "restored")
+        self.assertEqual(self.store.restore_snapshot("2", target, self.store_dir), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
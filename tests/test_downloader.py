@@ -0,0 +1,126 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+from fake_github import FakeGitHub
+
+
+class ResumeSourceTest(unittest.TestCase):
+    """A partial download is resumed only from the file it was started from."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="test_downloader_")
+        self.github = FakeGitHub(self.root)
+        self.github.start()
+        self.v1 = self.github.add_release("o/app", "v1", "com.o.app", "1", 1, apk_size=256 * 1024, asset_name="app.apk")["assets"][0]
+        self.v2 = self.github.add_release("o/app", "v2", "com.o.app", "2", 2, apk_size=256 * 1024, asset_name="app.apk")["assets"][0]
+        self.target = os.path.join(self.root, "app.apk")
+
+    def tearDown(self):
+        self.github.stop()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write_part(self, asset, source=None):
+        """Writes the first half of 'asset' as the partial download, with 'source' as its source file."""
+        path, _ = self.github.assets[asset["id"]]
+        with open(path, 'rb') as f:
+            data = f.read(asset["size"] // 2)
+        with open(self.target + ".part", 'wb') as f:
+            f.write(data)
+        if source is not None:
+            with open(self.target + ".part.source", 'w') as f:
+                json.dump(source, f)
+
+    def download(self, asset):
+        # Imported here - config reads the GitHub URL when first imported, see test_publish_pipeline.py
+        import downloader
+        return downloader.download_file(asset["browser_download_url"], self.target, expected_size=asset["size"], segments=1)
+
+    def test_partial_file_without_source_is_not_resumed(self):
+        self.write_part(self.v1)
+        self.assertEqual(self.download(self.v2), self.v2["digest"][len("sha256:"):])
+        self.assertFalse(os.path.exists(self.target + ".part.source"))
+
+    def test_partial_file_of_another_url_is_not_resumed(self):
+        self.write_part(self.v1, {"url": self.v1["browser_download_url"], "etag": None})
+        self.assertEqual(self.download(self.v2), self.v2["digest"][len("sha256:"):])
+
+    def test_changed_file_is_downloaded_whole(self):
+        self.write_part(self.v2, {"url": self.v1["browser_download_url"], "etag": '"changed"'})
+        self.assertEqual(self.download(self.v1), self.v1["digest"][len("sha256:"):])
+
+    def test_partial_file_of_the_same_source_is_resumed(self):
+        self.write_part(self.v1)
+        with open(self.target + ".part.source", 'w') as f:
+            json.dump({"url": self.v1["browser_download_url"], "etag": None}, f)
+        self.assertEqual(self.download(self.v1), self.v1["digest"][len("sha256:"):])
+        self.assertEqual(self.github.request_counts.get("download"), 1)
+
+
+class ExistingFileTest(unittest.TestCase):
+    """A file already in place is kept only if it matches the digest of the asset."""
+
+    setUp = ResumeSourceTest.setUp
+    tearDown = ResumeSourceTest.tearDown
+
+    def download(self, asset):
+        import downloader
+        return downloader.download_file(asset["browser_download_url"], self.target, expected_size=asset["size"],
+                                        expected_sha256=asset["digest"][len("sha256:"):], segments=1)
+
+    def put_in_place(self, asset):
+        shutil.copyfile(self.github.assets[asset["id"]][0], self.target)
+
+    def test_matching_file_is_not_downloaded_again(self):
+        self.put_in_place(self.v1)
+        self.assertEqual(self.download(self.v1), self.v1["digest"][len("sha256:"):])
+        self.assertEqual(self.github.request_counts.get("download", 0), 0)
+
+    def test_other_file_is_replaced(self):
+        self.put_in_place(self.v2)
+        self.assertEqual(self.download(self.v1), self.v1["digest"][len("sha256:"):])
+        self.assertEqual(self.github.request_counts.get("download", 0), 1)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """Parallel segmented downloads fit in the connection pool of the shared session."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="test_downloader_")
+        # All the segments of all the downloads are in flight at the same time
+        self.github = FakeGitHub(self.root, download_latency=0.3)
+        self.github.start()
+        import http_client
+        self.http_client = http_client
+        self.saved_client = (http_client._session, http_client._rate_limiter)
+        http_client._session = None     # A session of the default size, created by the first request
+
+    def tearDown(self):
+        self.http_client._session, self.http_client._rate_limiter = self.saved_client
+        self.github.stop()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_no_connection_is_discarded(self):
+        import downloader
+        from concurrent.futures import ThreadPoolExecutor
+        from config import DOWNLOAD_SEGMENTS, DOWNLOAD_WORKERS
+        assets = [self.github.add_release(f"o/app{number}", "v1", f"com.o.app{number}", "1", 1, apk_size=512 * 1024)["assets"][0]
+                  for number in range(DOWNLOAD_WORKERS)]
+
+        def download(asset):
+            return downloader.download_file(asset["browser_download_url"], os.path.join(self.root, asset["name"]),
+                                            expected_size=asset["size"], segments=DOWNLOAD_SEGMENTS, segment_min_size=1)
+        with self.assertNoLogs("urllib3.connectionpool", "WARNING"):
+            with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+                digests = list(executor.map(download, assets))
+        self.assertEqual(digests, [asset["digest"][len("sha256:"):] for asset in assets])
+
+
+if __name__ == "__main__":
+    unittest.main()
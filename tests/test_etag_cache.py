@@ -0,0 +1,53 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+URL = "https://api.github.com/repos/o/app/releases/latest"
+
+
+class EtagCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # Imported here - config reads the GitHub URL when first imported, see test_publish_pipeline.py
+        import etag_cache
+        self.cache = etag_cache
+        self.saved = (etag_cache._cache, etag_cache._cache_file, etag_cache._cache_dirty)
+        self.data_dir = tempfile.mkdtemp(prefix="test_etag_cache_")
+        self.cache_file = etag_cache.initialize_etag_cache(self.data_dir)
+
+    def tearDown(self):
+        self.cache._cache, self.cache._cache_file, self.cache._cache_dirty = self.saved
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def test_conditional_headers_of_stored_validators(self):
+        self.assertEqual(self.cache.conditional_headers(URL), {})
+        self.cache.store_validators(URL, '"abc"', "Mon, 01 Jan 2024 00:00:00 GMT")
+        self.assertEqual(self.cache.conditional_headers(URL), {"If-None-Match": '"abc"', "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT"})
+
+    def test_response_without_validators_is_not_stored(self):
+        self.cache.store_validators(URL, None, None)
+        self.assertEqual(self.cache.conditional_headers(URL), {})
+        self.cache.save_etag_cache()
+        self.assertFalse(os.path.exists(self.cache_file))
+
+    def test_saved_cache_is_loaded(self):
+        self.cache.store_validators(URL, '"abc"', None)
+        self.cache.save_etag_cache()
+        self.cache.initialize_etag_cache(self.data_dir)
+        self.assertEqual(self.cache.conditional_headers(URL), {"If-None-Match": '"abc"'})
+
+    def test_broken_cache_file_starts_empty(self):
+        with open(self.cache_file, 'w') as f:
+            f.write("{broken")
+        with self.assertLogs("apub", "WARNING"):
+            self.cache.initialize_etag_cache(self.data_dir)
+        self.assertEqual(self.cache.conditional_headers(URL), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def same_inode(path_a, path_b):
+    return os.stat(path_a).st_ino == os.stat(path_b).st_ino
+
+
+class BuildRunTreeTest(unittest.TestCase):
+    """The deployed tree links what it can to the build tree and to the previous deployed tree."""
+
+    def setUp(self):
+        # Imported here - config reads the GitHub URL when first imported, see test_publish_pipeline.py
+        import fdroid_builder
+        self.builder = fdroid_builder
+        self.root = tempfile.mkdtemp(prefix="test_fdroid_builder_")
+        self.build = os.path.join(self.root, "build")
+        write(os.path.join(self.build, "com.o.app-1.apk"), b"apk" * 100)
+        write(os.path.join(self.build, "index-v1.json"), b'{"apps": 1}')
+        write(os.path.join(self.build, "com.o.app", "en-US", "icon.png"), b"icon")
+        patcher = mock.patch("fdroid_builder.sample_screenshot_digests", return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def deploy(self, name, current=None):
+        new_dir = os.path.join(self.root, name)
+        return new_dir, self.builder.build_run_tree(self.build, current, new_dir)
+
+    def test_first_deploy_links_the_apks_and_copies_the_rest(self):
+        first, counts = self.deploy("first")
+        self.assertEqual(counts, (1, 2))
+        self.assertTrue(same_inode(os.path.join(self.build, "com.o.app-1.apk"), os.path.join(first, "com.o.app-1.apk")))
+        self.assertFalse(same_inode(os.path.join(self.build, "index-v1.json"), os.path.join(first, "index-v1.json")))
+        self.assertEqual(read(os.path.join(first, "com.o.app", "en-US", "icon.png")), b"icon")
+
+    def test_unchanged_files_are_linked_to_the_current_tree(self):
+        first, _ = self.deploy("first")
+        write(os.path.join(self.build, "index-v1.json"), b'{"apps": 2}')
+
+        second, counts = self.deploy("second", first)
+
+        self.assertEqual(counts, (2, 1))
+        self.assertTrue(same_inode(os.path.join(first, "com.o.app", "en-US", "icon.png"),
+                                   os.path.join(second, "com.o.app", "en-US", "icon.png")))
+        self.assertEqual(read(os.path.join(second, "index-v1.json")), b'{"apps": 2}')
+        self.assertEqual(read(os.path.join(first, "index-v1.json")), b'{"apps": 1}')
+
+    def test_files_linked_to_each_other_stay_linked(self):
+        os.link(os.path.join(self.build, "com.o.app", "en-US", "icon.png"), os.path.join(self.build, "com.o.app", "icon.png"))
+
+        first, _ = self.deploy("first")
+
+        self.assertTrue(same_inode(os.path.join(first, "com.o.app", "en-US", "icon.png"), os.path.join(first, "com.o.app", "icon.png")))
+
+
+class SampleScreenshotTest(unittest.TestCase):
+    """The copies of a sample screenshot written by 'fdroid update' are deployed as one file."""
+
+    def setUp(self):
+        import fdroid_builder
+        self.builder = fdroid_builder
+        self.root = tempfile.mkdtemp(prefix="test_fdroid_builder_")
+        self.build = os.path.join(self.root, "build")
+        self.sample = b"\x89PNG sample"
+        for package in ("com.o.one", "com.o.two", "com.o.three"):
+            write(os.path.join(self.build, package, "en-US", "phoneScreenshots", "1.png"), self.sample)
+        # The same size, another content - not a sample
+        write(os.path.join(self.build, "com.o.four", "en-US", "phoneScreenshots", "1.png"), b"\x89PNG ownshot")
+        from apk_cache import sha256_of_file
+        digest = sha256_of_file(os.path.join(self.build, "com.o.one", "en-US", "phoneScreenshots", "1.png"))
+        patcher = mock.patch("fdroid_builder.sample_screenshot_digests", return_value={len(self.sample): {digest}})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_copies_of_a_sample_are_linked(self):
+        new_dir = os.path.join(self.root, "new")
+        linked, copied = self.builder.build_run_tree(self.build, None, new_dir)
+
+        screenshot = lambda package: os.path.join(new_dir, package, "en-US", "phoneScreenshots", "1.png")
+        self.assertEqual((linked, copied), (2, 2))
+        self.assertTrue(same_inode(screenshot("com.o.one"), screenshot("com.o.two")))
+        self.assertTrue(same_inode(screenshot("com.o.one"), screenshot("com.o.three")))
+        self.assertFalse(same_inode(screenshot("com.o.one"), screenshot("com.o.four")))
+        self.assertEqual(read(screenshot("com.o.four")), b"\x89PNG ownshot")
+
+
+class DeployTest(unittest.TestCase):
+    """RUN_REPO_DIR is switched to each new tree as a whole."""
+
+    def setUp(self):
+        import fdroid_builder
+        self.builder = fdroid_builder
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp(prefix="test_fdroid_builder_")
+        os.chdir(self.root)     # The paths of config are relative to ROOT_DIR
+        write(os.path.join(fdroid_builder.BUILD_REPO_DIR, "index-v1.json"), b'{"apps": 1}')
+        patcher = mock.patch("fdroid_builder.sample_screenshot_digests", return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_switch_to_the_new_tree(self):
+        builder = self.builder
+        builder.deploy_build_to_run_environment()
+        first = os.path.realpath(builder.RUN_REPO_DIR)
+        write(os.path.join(builder.BUILD_REPO_DIR, "index-v1.json"), b'{"apps": 2}')
+
+        builder.deploy_build_to_run_environment()
+
+        self.assertTrue(os.path.islink(builder.RUN_REPO_DIR))
+        self.assertNotEqual(os.path.realpath(builder.RUN_REPO_DIR), first)
+        self.assertEqual(read(os.path.join(builder.RUN_REPO_DIR, "index-v1.json")), b'{"apps": 2}')
+        self.assertEqual(read(os.path.join(first, "index-v1.json")), b'{"apps": 1}')
+        self.assertFalse(os.path.lexists(builder.RUN_REPO_DIR + ".new"))
+
+    def test_incomplete_trees_are_removed_and_not_counted(self):
+        builder = self.builder
+        kept = []
+        for _ in range(builder.RUN_RELEASES_KEEP):
+            builder.deploy_build_to_run_environment()
+            kept.append(os.path.basename(os.path.realpath(builder.RUN_REPO_DIR)))
+        for leftover in ("repo_20990101_000000_000000.tmp", "repo_20990102_000000_000000.tmp"):
+            write(os.path.join(builder.RUN_RELEASES_DIR, leftover, "index-v1.json"), b'{}')
+
+        builder.deploy_build_to_run_environment()
+
+        current = os.path.basename(os.path.realpath(builder.RUN_REPO_DIR))
+        self.assertEqual(sorted(os.listdir(builder.RUN_RELEASES_DIR)), kept[1:] + [current])
+
+    def test_existing_run_directory_becomes_the_first_tree(self):
+        builder = self.builder
+        write(os.path.join(builder.RUN_REPO_DIR, "index-v1.json"), b'{"apps": 0}')
+
+        builder.deploy_build_to_run_environment()
+
+        trees = sorted(os.listdir(builder.RUN_RELEASES_DIR))
+        self.assertEqual(len(trees), 2)
+        self.assertEqual(read(os.path.join(builder.RUN_RELEASES_DIR, trees[0], "index-v1.json")), b'{"apps": 0}')
+        self.assertEqual(os.path.realpath(builder.RUN_REPO_DIR), os.path.realpath(os.path.join(builder.RUN_RELEASES_DIR, trees[1])))
+
+    def test_old_trees_are_pruned(self):
+        builder = self.builder
+        for _ in range(builder.RUN_RELEASES_KEEP + 2):
+            builder.deploy_build_to_run_environment()
+        trees = sorted(os.listdir(builder.RUN_RELEASES_DIR))
+        self.assertEqual(len(trees), builder.RUN_RELEASES_KEEP)
+        self.assertEqual(os.path.realpath(builder.RUN_REPO_DIR), os.path.realpath(os.path.join(builder.RUN_RELEASES_DIR, trees[-1])))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        # Imported here - config reads the GitHub URL when first imported, see test_publish_pipeline.py
+        import installed_versions_db
+        self.db_module = installed_versions_db
+        self.dir = tempfile.mkdtemp(prefix="test_installed_versions_db_")
+        self.db_file = os.path.join(self.dir, "installed_versions.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def create_version_1(self, rows):
+        conn = sqlite3.connect(self.db_file)
+        conn.executescript(self.db_module.SCHEMA_MIGRATIONS[0])
+        conn.executemany('INSERT INTO installed_versions (repo, release, packageName, version, versionCode, date) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        conn.execute('PRAGMA user_version = 1')
+        conn.commit()
+        conn.close()
+
+    def test_new_database_gets_the_latest_schema(self):
+        db = self.db_module.InstalledVersionsDB(self.db_file)
+        self.assertEqual(db.schema_version(), len(self.db_module.SCHEMA_MIGRATIONS))
+        db.insert_records([("o/app", "v1", "com.o.app", "1.0", 1, None, "app.apk")])
+        self.assertTrue(db.release_exist("o/app", "v1"))
+        db.close()
+
+    def test_duplicates_are_moved_aside_and_logged(self):
+        self.create_version_1([("o/app", "v1", "com.o.app", "1.0", 1, "2024-01-01"),
+                               ("o/app", "v1", "com.o.app", "1.0", 1, "2024-01-02"),
+                               ("o/app", "v2", "com.o.app", "2.0", 2, "2024-02-01")])
+        with self.assertLogs("apub", "WARNING") as logs:
+            db = self.db_module.InstalledVersionsDB(self.db_file)
+        self.assertIn("1 duplicate release records", logs.output[0])
+        rows = db.conn.execute('SELECT release, date FROM installed_versions ORDER BY id').fetchall()
+        self.assertEqual(rows, [("v1", "2024-01-01"), ("v2", "2024-02-01")])
+        moved = db.conn.execute(f'SELECT release, date FROM {self.db_module.DUPLICATES_TABLE}').fetchall()
+        self.assertEqual(moved, [("v1", "2024-01-02")])
+        db.close()
+
+    def test_failed_migration_is_rolled_back(self):
+        db = self.db_module.InstalledVersionsDB(self.db_file)
+        version = db.schema_version()
+        failing = "CREATE TABLE half_done (x INTEGER); INSERT INTO no_such_table VALUES (1);"
+        with mock.patch.object(self.db_module, "SCHEMA_MIGRATIONS", self.db_module.SCHEMA_MIGRATIONS + [failing]):
+            with self.assertRaises(sqlite3.OperationalError):
+                db.migrate()
+
+        self.assertFalse(db.conn.in_transaction)
+        self.assertEqual(db.schema_version(), version)
+        self.assertIsNone(db.conn.execute("SELECT name FROM sqlite_master WHERE name = 'half_done'").fetchone())
+        db.insert_records([("o/app", "v1", "com.o.app", "1.0", 1, None, "app.apk")])
+        db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
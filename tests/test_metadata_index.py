@@ -0,0 +1,91 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+EXISTING_YML = "Categories:\n- TestAppCenter\nCurrentVersionCode: 1\nName: Existing\n"
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class MetadataIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        # Imported here - config reads the GitHub URL when first imported, see test_publish_pipeline.py
+        from metadata_index import MetadataIndex
+        self.root = tempfile.mkdtemp(prefix="test_metadata_index_")
+        self.metadata_dir = os.path.join(self.root, "metadata")
+        write(os.path.join(self.metadata_dir, "com.o.existing.yml"), EXISTING_YML)
+        write(os.path.join(self.metadata_dir, "com.o.existing", "en-US", "changelog", "1.txt"), "- First\n")
+        self.sample = os.path.join(self.root, "sample.png")
+        write(self.sample, "png")
+        self.index = MetadataIndex(self.metadata_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_load(self):
+        entry = self.index.get("com.o.existing")
+        self.assertEqual(entry.fields["CurrentVersionCode"], "1")
+        self.assertEqual(entry.changelogs, {"1"})
+        self.assertFalse(entry.has_screenshots)
+
+    def test_new_package_is_written_on_flush(self):
+        self.index.add_release("com.o.new", 5, "New", "https://github.com/o/new/", "- Notes", sample_screenshots=[self.sample])
+        yml_file = self.index.yml_file("com.o.new")
+        self.assertFalse(os.path.exists(yml_file))
+
+        self.assertEqual(self.index.flush(), 4)
+
+        self.assertIn("CurrentVersionCode: 5\n", read(yml_file))
+        self.assertEqual(read(os.path.join(self.index.changelog_dir("com.o.new"), "5.txt")), "- Notes\n")
+        self.assertEqual(read(os.path.join(self.index.screenshots_dir("com.o.new"), "sample.png")), "png")
+        self.assertEqual(self.index.check_for_external_changes(), [])
+
+    def test_existing_yml_gets_only_the_new_version_code(self):
+        self.index.add_release("com.o.existing", 2, "Existing", "https://github.com/o/existing/", "- Second")
+        self.index.flush()
+        self.assertEqual(read(self.index.yml_file("com.o.existing")), EXISTING_YML.replace("CurrentVersionCode: 1", "CurrentVersionCode: 2"))
+
+    def test_release_already_in_the_metadata_writes_nothing(self):
+        self.index.add_release("com.o.existing", 1, "Existing", "https://github.com/o/existing/", "- First")
+        # Only the screenshots directory the package does not have yet
+        self.assertEqual(self.index.pending_count(), 1)
+
+    def test_external_changes_are_read_again(self):
+        write(self.index.yml_file("com.o.existing"), EXISTING_YML + "Summary: edited by hand\n")
+        write(self.index.yml_file("com.o.added"), "Name: Added\n")
+
+        self.assertEqual(sorted(self.index.check_for_external_changes()), ["com.o.added", "com.o.existing"])
+        self.assertEqual(self.index.get("com.o.existing").fields["Summary"], "edited by hand")
+        self.assertEqual(self.index.get("com.o.added").fields["Name"], "Added")
+
+    def test_retired_changelogs_are_archived(self):
+        archive_dir = os.path.join(self.root, "archive")
+        self.assertEqual(self.index.retire_changelogs("com.o.existing", [1, 7], archive_dir=archive_dir), 1)
+        self.index.flush()
+        self.assertFalse(os.path.exists(os.path.join(self.index.changelog_dir("com.o.existing"), "1.txt")))
+        self.assertEqual(read(os.path.join(archive_dir, "com.o.existing", "1.txt")), "- First\n")
+        self.assertEqual(self.index.get("com.o.existing").changelogs, set())
+
+    def test_reload_drops_the_queued_changes(self):
+        self.index.add_release("com.o.existing", 2, "Existing", "https://github.com/o/existing/", "- Second")
+        self.index.reload_packages({"com.o.existing"})
+        self.assertEqual(self.index.pending_count(), 0)
+        self.assertEqual(self.index.get("com.o.existing").fields["CurrentVersionCode"], "1")
+
+
+if __name__ == "__main__":
+    unittest.main()
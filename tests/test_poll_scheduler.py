@@ -0,0 +1,47 @@
+import os
+import sys
+import unittest
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+
+class FloorIntervalTest(unittest.TestCase):
+    """The webhook polling floor also applies to the repositories with their own min/interval."""
+
+    def setUp(self):
+        # Imported here - config reads the GitHub URL when first imported, see test_publish_pipeline.py
+        from poll_scheduler import PollScheduler
+        from repo_config import parse_repo_line
+        self.scheduler = PollScheduler({}, floor_interval=1800)
+        repos = [parse_repo_line(line) for line in ("o/fixed interval=60", "o/fast min=10", "o/default")]
+        self.scheduler.set_repos({settings.repo: settings for settings in repos})
+
+    def test_repository_settings_do_not_go_below_the_floor(self):
+        for repo in ("o/fixed", "o/fast", "o/default"):
+            self.assertGreaterEqual(self.scheduler.interval(repo), 1800, repo)
+
+    def test_without_floor_the_repository_settings_apply(self):
+        self.scheduler.floor_interval = 0
+        self.assertEqual(self.scheduler.interval("o/fixed"), 60)
+
+
+class RepositoryLimitsTest(unittest.TestCase):
+
+    def setUp(self):
+        from poll_scheduler import PollScheduler
+        from repo_config import parse_repo_line
+        self.scheduler = PollScheduler({}, default_interval=300, min_interval=60, max_interval=3600)
+        repos = [parse_repo_line(line) for line in ("o/quick max=30", "o/slow min=600", "o/default")]
+        self.scheduler.set_repos({settings.repo: settings for settings in repos})
+
+    def test_repository_max_below_the_default_min_is_honoured(self):
+        self.assertEqual(self.scheduler.interval("o/quick"), 30)
+
+    def test_repository_min_and_default_limits(self):
+        self.assertEqual(self.scheduler.interval("o/slow"), 600)
+        self.assertEqual(self.scheduler.interval("o/default"), 300)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+from bench_pipeline import make_tree
+from fake_github import FakeGitHub
+
+# Check and publish cycles against a local fake GitHub (fake_github.py) and the stub 'fdroid'
+# of bench_pipeline.py. The application modules read the GitHub URL and the token when config
+# is first imported - the fake GitHub is started when the test modules are collected, before
+# any test runs.
+
+_root = tempfile.mkdtemp(prefix="test_publish_pipeline_")
+make_tree(_root)
+_github = FakeGitHub(os.path.join(_root, "assets"))
+os.environ["APUB_GITHUB_API_URL"] = _github.start()
+os.environ["GITHUB_TOKEN"] = "test"
+os.environ["PATH"] = os.path.join(_root, "bin") + os.pathsep + os.environ["PATH"]
+
+_cwd = None
+_db_file = None
+app = None
+
+
+def setUpModule():
+    global _cwd, _db_file, app
+    _cwd = os.getcwd()
+    os.chdir(_root)
+
+    import testappc_autopublish
+    app = testappc_autopublish
+    _db_file = app.initialize_db("data")
+    app.initialize_etag_cache("data")
+    app.initialize_apk_cache("data")
+    app.initialize_repo_index("data")
+    app.initialize_metadata_index(app.BUILD_METADATA_DIR)
+    app.initialize_githubber()
+
+def tearDownModule():
+    _github.stop()
+    os.chdir(_cwd)
+    shutil.rmtree(_root, ignore_errors=True)
+
+
+def publish_cycle(pipeline, scheduler, repos):
+    """One check and publish cycle of the main loop. Returns the published releases."""
+    app.queue_new_releases(app.poll_latest_releases(repos), pipeline, _db_file)
+    return app.publish_queued_releases(pipeline, scheduler)
+
+
+class SameNamedAssetsTest(unittest.TestCase):
+
+    def test_same_named_assets_of_different_repos_are_all_published(self):
+        repos = ["same/one", "same/two"]
+        for number, repo in enumerate(repos, 1):
+            _github.add_release(repo, f"v{number}.0-dev", f"com.same.app{number}", f"{number}.0-dev", number,
+                                apk_size=64 * 1024, asset_name="app-release.apk")
+        scheduler = app.PollScheduler({})
+        pipeline = app.PublishPipeline(_db_file)
+
+        published = publish_cycle(pipeline, scheduler, repos)
+
+        self.assertEqual(sorted(release.repo for release in published), repos)
+        self.assertEqual({release.packageName for release in published}, {"com.same.app1", "com.same.app2"})
+        self.assertEqual(pipeline.failed_repos, set())
+        in_repo = [name for name in os.listdir(app.BUILD_REPO_DIR) if name.startswith("app-release")]
+        self.assertEqual(len(in_repo), 2)
+        self.assertFalse(os.path.exists("app-release.apk.part"))
+
+
+class HandoffTest(unittest.TestCase):
+
+    def test_handed_over_release_survives_a_failed_build(self):
+        from work_leases import LeaseManager, handed_over_count
+        leader = LeaseManager(_db_file, "leader")
+        self.assertTrue(leader.try_lead())
+        worker_pipeline = app.PublishPipeline(_db_file, leases=LeaseManager(_db_file, "worker"))
+        leader_pipeline = app.PublishPipeline(_db_file, leases=leader)
+        scheduler = app.PollScheduler({})
+        _github.add_release("handoff/app", "v1.0-dev", "com.handoff.app", "1.0-dev", 1, apk_size=64 * 1024)
+
+        handed_over = publish_cycle(worker_pipeline, scheduler, ["handoff/app"])
+        self.assertEqual([release.handed_over for release in handed_over], [True])
+        apk_file = handed_over[0].filename
+
+        with mock.patch("publish_pipeline.update_fdroid_Linux", side_effect=Exception("fdroid update failed")):
+            self.assertEqual(leader_pipeline.run_batch(), [])
+        self.assertEqual(handed_over_count(_db_file), 1)
+        self.assertTrue(os.path.exists(apk_file))
+
+        published = leader_pipeline.run_batch()
+        self.assertEqual([release.repo for release in published], ["handoff/app"])
+        self.assertEqual(handed_over_count(_db_file), 0)
+        self.assertFalse(os.path.exists(apk_file))
+        leader.release_all()
+
+
+class FailedBuildTest(unittest.TestCase):
+
+    def test_own_release_is_not_downloaded_again_after_a_failed_build(self):
+        pipeline = app.PublishPipeline(_db_file)
+        scheduler = app.PollScheduler({})
+        _github.add_release("failed/app", "v1.0-dev", "com.failed.app", "1.0-dev", 1, apk_size=64 * 1024)
+
+        with mock.patch("publish_pipeline.update_fdroid_Linux", side_effect=Exception("fdroid update failed")):
+            self.assertEqual(publish_cycle(pipeline, scheduler, ["failed/app"]), [])
+        self.assertEqual(pipeline.failed_repos, {"failed/app"})
+        self.assertFalse([name for name in os.listdir(app.BUILD_REPO_DIR) if name.startswith("com.failed.app")])
+        downloads = _github.request_counts.get("download", 0)
+
+        published = publish_cycle(pipeline, scheduler, ["failed/app"])
+
+        self.assertEqual([release.repo for release in published], ["failed/app"])
+        self.assertEqual(_github.request_counts.get("download", 0), downloads)
+        self.assertTrue(os.path.exists(os.path.join(app.BUILD_REPO_DIR, os.path.basename(published[0].filename))))
+
+
+class ConditionalRequestTest(unittest.TestCase):
+
+    def test_release_is_not_modified_only_once_confirmed(self):
+        _github.add_release("etag/app", "v1.0-dev", "com.etag.app", "1.0-dev", 1, apk_size=16 * 1024)
+
+        self.assertEqual(app.getRelease("etag/app", "latest")["tag_name"], "v1.0-dev")
+        # Not handled yet - requested again in full
+        self.assertEqual(app.getRelease("etag/app", "latest")["tag_name"], "v1.0-dev")
+        app.confirm_release_checked("etag/app")
+        self.assertEqual(app.getRelease("etag/app", "latest"), app.RELEASE_NOT_MODIFIED)
+
+        _github.add_release("etag/app", "v2.0-dev", "com.etag.app", "2.0-dev", 2, apk_size=16 * 1024)
+        self.assertEqual(app.getRelease("etag/app", "latest")["tag_name"], "v2.0-dev")
+
+
+class CatchUpTest(unittest.TestCase):
+
+    def test_prereleases_are_not_caught_up(self):
+        _github.add_release("catchup/app", "v1.0-dev", "com.catchup.app", "1.0-dev", 1, apk_size=16 * 1024)
+        _github.add_release("catchup/app", "v2.0-dev", "com.catchup.app", "2.0-dev", 2, apk_size=16 * 1024, prerelease=True)
+        _github.add_release("catchup/app", "v3.0-dev", "com.catchup.app", "3.0-dev", 3, apk_size=16 * 1024)
+
+        releases = app.releases_since("catchup/app", 0)
+
+        self.assertEqual([release["tag_name"] for release in releases], ["v3.0-dev", "v1.0-dev"])
+
+
+class GraphQLPollTest(unittest.TestCase):
+
+    def test_release_without_notes_is_parsed(self):
+        import http_client
+        _github.add_release("graphql/app", "v1.0-dev", "com.graphql.app", "1.0-dev", 1, apk_size=64 * 1024, body=None)
+
+        (release, error), = app.latest_releases_graphql(["graphql/app"]).values()
+
+        self.assertIsNone(error)
+        self.assertEqual(app.parse_release_data(release)[5], "")
+        self.assertIn("graphql", http_client._rate_limiter.budgets)
+
+    def test_changed_release_has_the_api_urls_and_digests_of_its_assets(self):
+        added = _github.add_release("graphql/private", "v1.0-dev", "com.graphql.private", "1.0-dev", 1, apk_size=64 * 1024)
+
+        (release, error), = app.latest_releases_graphql(["graphql/private"]).values()
+
+        self.assertIsNone(error)
+        asset = app.get_apk_asset(release)
+        self.assertEqual(asset["url"], added["assets"][0]["url"])
+        self.assertEqual(app.asset_sha256(asset), added["assets"][0]["digest"][len("sha256:"):])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+import unittest
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+
+def rate_limit_headers(resource, limit, remaining, reset_in=3600):
+    return {"X-RateLimit-Resource": resource, "X-RateLimit-Limit": str(limit),
+            "X-RateLimit-Remaining": str(remaining), "X-RateLimit-Reset": str(int(time.time()) + reset_in)}
+
+
+class ResourceBudgetTest(unittest.TestCase):
+    """The REST and the GraphQL API budgets are tracked separately."""
+
+    def setUp(self):
+        # Imported here - config reads the GitHub URL when first imported, see test_publish_pipeline.py
+        from rate_limiter import RateLimiter
+        self.limiter = RateLimiter(interval=60)
+
+    def test_graphql_response_does_not_update_the_rest_budget(self):
+        self.limiter.update(200, rate_limit_headers("core", 5000, 4000))
+        self.limiter.update(200, rate_limit_headers("graphql", 5000, 12), resource="graphql")
+        self.assertEqual(self.limiter.budgets["core"].remaining, 4000)
+        self.assertEqual(self.limiter.budgets["graphql"].remaining, 12)
+
+    def test_exhausted_graphql_budget_does_not_block_rest_requests(self):
+        self.assertTrue(self.limiter.update(403, rate_limit_headers("graphql", 5000, 0), resource="graphql"))
+        start = time.monotonic()
+        self.limiter.acquire()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertGreater(self.limiter.budgets["graphql"].blocked_until, time.time())
+
+    def test_resource_header_names_the_budget(self):
+        self.limiter.update(200, rate_limit_headers("search", 30, 29))
+        self.assertEqual(self.limiter.budgets["search"].limit, 30)
+        self.assertNotIn("core", self.limiter.budgets)
+
+
+class TokenBucketTest(unittest.TestCase):
+    """The budget of one resource, at given times."""
+
+    def setUp(self):
+        from rate_limiter import RateLimiter, SECONDARY_LIMIT_WAIT
+        self.limiter = RateLimiter(interval=10, hourly_limit=3600)
+        self.budget = self.limiter._budget("core")
+        self.secondary_wait = SECONDARY_LIMIT_WAIT
+        self.now = self.budget.last_refill
+
+    def test_burst_of_one_interval_then_the_rate(self):
+        waits = [self.budget.take(self.now) for _ in range(11)]
+        self.assertEqual(waits[:10], [0] * 10)
+        self.assertAlmostEqual(waits[10], 1.0)
+        self.assertEqual(self.budget.take(self.now + 1), 0)
+
+    def test_remaining_budget_is_spread_until_the_reset(self):
+        # 100 requests left for 1000 seconds: one request per 10 seconds, a burst of one
+        self.budget.update(self.now, 200, 5000, 100, self.now + 1000, None)
+        self.assertEqual(self.budget.take(self.now), 0)
+        self.assertAlmostEqual(self.budget.take(self.now), 1000 / 99, places=3)
+        self.assertEqual(self.budget.remaining, 99)
+
+    def test_exhausted_budget_waits_for_the_reset(self):
+        reset_at = int(self.now) + 600
+        self.assertTrue(self.budget.update(self.now, 403, 5000, 0, reset_at, None))
+        self.assertAlmostEqual(self.budget.take(self.now), reset_at + 1 - self.now)
+
+    def test_retry_after(self):
+        self.assertTrue(self.budget.update(self.now, 429, None, None, None, 30))
+        self.assertAlmostEqual(self.budget.take(self.now), 30)
+
+    def test_secondary_limit_without_headers(self):
+        self.assertTrue(self.budget.update(self.now, 429, None, None, None, None))
+        self.assertAlmostEqual(self.budget.take(self.now), self.secondary_wait)
+
+    def test_forbidden_is_not_a_rate_limit(self):
+        self.assertFalse(self.budget.update(self.now, 403, 5000, 4000, int(self.now) + 600, None))
+        self.assertEqual(self.budget.take(self.now), 0)
+
+    def test_responses_arriving_out_of_order(self):
+        reset_at = int(self.now) + 600
+        self.budget.update(self.now, 200, 5000, 4000, reset_at, None)
+        self.budget.update(self.now, 200, 5000, 4002, reset_at, None)
+        self.assertEqual(self.budget.remaining, 4000)
+        self.budget.update(self.now, 200, 5000, 4999, reset_at + 3600, None)
+        self.assertEqual(self.budget.remaining, 4999)
+
+    def test_status(self):
+        self.assertEqual(self.limiter.status(), "GitHub API budget: core unknown")
+        self.limiter.update(200, rate_limit_headers("core", 5000, 4000))
+        self.assertRegex(self.limiter.status(), r"^GitHub API budget: core 4000/5000 remaining, resets in \d+m \d+s$")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,26 @@
+import os
+import sys
+import unittest
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+
+class ParseRepoLineTest(unittest.TestCase):
+
+    def setUp(self):
+        # Imported here - config reads the GitHub URL when first imported, see test_publish_pipeline.py
+        from repo_config import parse_repo_line
+        self.parse = parse_repo_line
+
+    def test_dev_markers(self):
+        self.assertEqual(self.parse("o/app dev=-dev,beta,").dev_markers, ("-dev", "beta"))
+
+    def test_empty_dev_marker_list_is_rejected(self):
+        for line in ("o/app dev=,", "o/app dev=,,,"):
+            with self.assertRaises(ValueError):
+                self.parse(line)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+
+def entry(package, version_code, name=None):
+    from repo_index import ApkEntry
+    name = name or f"{package}-{version_code}.apk"
+    return name, ApkEntry(name, 100, 0, "0" * 64, package, f"1.{version_code}", str(version_code), package)
+
+
+class SelectRetiredTest(unittest.TestCase):
+
+    def setUp(self):
+        # Imported here - config reads the GitHub URL when first imported, see test_publish_pipeline.py
+        import retention
+        self.retention = retention
+        self.entries = dict([entry("com.o.app", 1), entry("com.o.app", 2), entry("com.o.app", 3), entry("com.o.app", 4),
+                             entry("com.o.other", 7), entry("com.o.other", 8), entry("org.manual", 1)])
+        self.version_codes = {"com.o.app": {1, 2, 3, 4}, "com.o.other": {7, 8}}
+
+    def retired(self, keep, overrides=None):
+        return [(e.packageName, e.versionCode)
+                for e in self.retention.select_retired(self.entries, self.version_codes, keep, overrides or {})]
+
+    def test_older_than_the_kept_versions_are_retired(self):
+        self.assertEqual(self.retired(2), [("com.o.app", "1"), ("com.o.app", "2")])
+
+    def test_package_not_in_the_database_is_not_touched(self):
+        self.assertNotIn("org.manual", [package for package, version_code in self.retired(1)])
+
+    def test_keep_per_package(self):
+        self.assertEqual(self.retired(2, {"com.o.app": 3, "com.o.other": 1}), [("com.o.app", "1"), ("com.o.other", "7")])
+        self.assertEqual(self.retired(0), [])
+        self.assertEqual(self.retired(2, {"com.o.app": 0}), [])
+
+    def test_kept_versions_are_counted_from_the_published_ones(self):
+        # Version 4 published but no longer in the repository: the 2 newest published are 3 and 4
+        del self.entries["com.o.app-4.apk"]
+        self.assertEqual(self.retired(2), [("com.o.app", "1"), ("com.o.app", "2")])
+
+    def test_unparsable_version_code_is_kept(self):
+        self.entries.update([entry("com.o.app", "beta", "com.o.app-beta.apk")])
+        self.assertNotIn(("com.o.app", "beta"), self.retired(1))
+
+    def test_oldest_kept_version(self):
+        self.assertEqual(self.retention.oldest_kept_version("com.o.app", self.version_codes, 3, {}), 2)
+        self.assertIsNone(self.retention.oldest_kept_version("com.o.other", self.version_codes, 3, {}))
+        self.assertIsNone(self.retention.oldest_kept_version("org.manual", self.version_codes, 1, {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import hashlib
+import hmac
+import json
+import os
+import sys
+import unittest
+import urllib.error
+import urllib.request
+
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOURCE_DIR)
+
+SECRET = "webhook secret"
+
+
+def sign(body, secret=SECRET):
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+def release_event(repo="o/app", tag="v1.0-dev", action="published", **release):
+    return json.dumps({
+        "action": action,
+        "repository": {"full_name": repo},
+        "release": dict({"name": tag, "tag_name": tag, "draft": False, "prerelease": False}, **release),
+    }).encode("utf-8")
+
+
+class SignatureTest(unittest.TestCase):
+    """X-Hub-Signature-256 is the HMAC-SHA256 of the raw body with the webhook secret."""
+
+    def setUp(self):
+        # Imported here - config reads the GitHub URL when first imported, see test_publish_pipeline.py
+        from webhook import WebhookReceiver
+        self.receiver = WebhookReceiver(SECRET)
+        self.receiver.set_repos(["o/app"])
+        self.body = release_event()
+
+    def test_valid_signature_is_accepted(self):
+        self.assertEqual(self.receiver.receive("release", self.body, sign(self.body))[0], 202)
+        self.assertEqual([repo for repo, release in self.receiver.take_releases()], ["o/app"])
+
+    def test_missing_signature_is_rejected(self):
+        self.assertEqual(self.receiver.receive("release", self.body, None)[0], 401)
+        self.assertEqual(self.receiver.receive("release", self.body, "")[0], 401)
+
+    def test_malformed_signature_is_rejected(self):
+        digest = sign(self.body)[len("sha256="):]
+        for signature in (digest, "sha1=" + digest, "sha256=", "sha256=not hex", "sha256=" + digest[:-2],
+                          "sha256=" + digest[:-1] + "\u00e9"):
+            self.assertEqual(self.receiver.receive("release", self.body, signature)[0], 401, signature)
+
+    def test_signature_with_another_secret_is_rejected(self):
+        self.assertEqual(self.receiver.receive("release", self.body, sign(self.body, "another secret"))[0], 401)
+
+    def test_signature_of_another_body_is_rejected(self):
+        self.assertEqual(self.receiver.receive("release", self.body, sign(release_event(tag="v2.0-dev")))[0], 401)
+
+    def test_ping_needs_a_valid_signature(self):
+        self.assertEqual(self.receiver.receive("ping", b"{}", sign(b"{}", "another secret"))[0], 401)
+        self.assertEqual(self.receiver.receive("ping", b"{}", sign(b"{}"))[0], 200)
+
+    def test_empty_secret_is_refused(self):
+        from webhook import WebhookReceiver
+        with self.assertRaises(ValueError):
+            WebhookReceiver("")
+
+    def test_nothing_is_queued_for_a_rejected_delivery(self):
+        self.receiver.receive("release", self.body, sign(self.body, "another secret"))
+        self.assertEqual(self.receiver.take_releases(), [])
+
+
+class ReleaseFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        from webhook import WebhookReceiver
+        self.receiver = WebhookReceiver(SECRET)
+        self.receiver.set_repos(["o/app"])
+
+    def deliver(self, body):
+        return self.receiver.receive("release", body, sign(body))[0]
+
+    def test_drafts_and_prereleases_are_ignored(self):
+        self.assertEqual(self.deliver(release_event(draft=True)), 200)
+        self.assertEqual(self.deliver(release_event(prerelease=True)), 200)
+        self.assertEqual(self.receiver.take_releases(), [])
+
+    def test_other_actions_and_repositories_are_ignored(self):
+        self.assertEqual(self.deliver(release_event(action="deleted")), 200)
+        self.assertEqual(self.deliver(release_event(repo="other/app")), 200)
+        self.assertEqual(self.receiver.take_releases(), [])
+
+    def test_repository_name_is_case_insensitive(self):
+        self.assertEqual(self.deliver(release_event(repo="O/App")), 202)
+        self.assertEqual([repo for repo, release in self.receiver.take_releases()], ["o/app"])
+
+    def test_invalid_payload_is_rejected(self):
+        self.assertEqual(self.deliver(b"not json"), 400)
+        self.assertEqual(self.deliver(json.dumps({"action": "published"}).encode("utf-8")), 400)
+
+
+class ServerTest(unittest.TestCase):
+    """The signature header of an HTTP delivery reaches the check."""
+
+    def setUp(self):
+        from webhook import WebhookReceiver
+        self.receiver = WebhookReceiver(SECRET)
+        self.receiver.set_repos(["o/app"])
+        server = self.receiver.start(port=0)
+        self.url = f"http://127.0.0.1:{server.server_address[1]}/webhook"
+
+    def tearDown(self):
+        self.receiver.stop()
+
+    def post(self, body, signature):
+        headers = {"X-GitHub-Event": "release", "Content-Type": "application/json"}
+        if signature is not None:
+            headers["X-Hub-Signature-256"] = signature
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.url, data=body, headers=headers)) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_deliveries(self):
+        body = release_event()
+        self.assertEqual(self.post(body, None), 401)
+        self.assertEqual(self.post(body, sign(body, "another secret")), 401)
+        self.assertEqual(self.post(body, sign(body)), 202)
+        self.assertEqual(len(self.receiver.take_releases()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from config import *
+import metrics
+
+# Timing spans of the processing stages.
+#
+#   with span("download", repo=repo, release=relname):
+#       ...
+#
+#   @traced("get_release")
+#   def getRelease(repo, version): ...
+#
+# A span inherits the labels of the enclosing spans (and label scopes) of the same
+# thread, so a traced function called while publishing a release is labelled with the
+# repository and the release. Every finished span is logged (at DEBUG, with the span
+# fields as 'extra' for the JSON log), observed in the stage duration metric and
+# collected for the end-of-cycle summary of the slowest stages.
+
+_context = threading.local()
+
+_finished_lock = threading.Lock()
+_finished = []      # (name, duration, labels, failed) of the spans finished in this cycle
+
+
+def _stack():
+    stack = getattr(_context, 'stack', None)
+    if stack is None:
+        stack = _context.stack = []
+    return stack
+
+def current_labels():
+    """Returns the labels of the innermost span or label scope of this thread."""
+    stack = _stack()
+    return dict(stack[-1]) if stack else {}
+
+@contextmanager
+def labels(**new_labels):
+    """Label scope: spans started inside the 'with' block get these labels (no timing)."""
+    stack = _stack()
+    stack.append({**current_labels(), **new_labels})
+    try:
+        yield
+    finally:
+        stack.pop()
+
+@contextmanager
+def span(name, **new_labels):
+    """Times the 'with' block as the stage 'name'."""
+    stack = _stack()
+    span_labels = {**current_labels(), **new_labels}
+    stack.append(span_labels)
+    failed = False
+    start = time.monotonic()
+    try:
+        yield span_labels
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        duration = time.monotonic() - start
+        stack.pop()
+        metrics.STAGE_DURATION.observe(duration, stage=name)
+        with _finished_lock:
+            _finished.append((name, duration, span_labels, failed))
+        if logger.isEnabledFor(logging.DEBUG):
+            label_str = " ".join(f"{key}={value}" for key, value in span_labels.items())
+            logger.debug(f"Span {name} {'failed' if failed else 'done'} in {duration:.3f}s {label_str}".rstrip(),
+                         extra={"span": name, "duration": round(duration, 6), "labels": span_labels, "failed": failed})
+
+def traced(name=None):
+    """Decorator: times every call of the function as a span (named after the function by default)."""
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def finished_spans():
+    """Returns (name, duration, labels, failed) of the spans finished in this cycle."""
+    with _finished_lock:
+        return list(_finished)
+
+def reset_cycle():
+    """Forgets the spans of the previous cycle."""
+    with _finished_lock:
+        _finished.clear()
+
+def cycle_summary(top=10):
+    """Returns a table of the stages of this cycle, slowest (by total time) first."""
+    with _finished_lock:
+        finished = list(_finished)
+    if not finished:
+        return "No stages timed in this cycle"
+
+    stages = {}
+    for name, duration, span_labels, failed in finished:
+        stage = stages.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0, "failed": 0, "slowest": ""})
+        stage["count"] += 1
+        stage["total"] += duration
+        stage["failed"] += failed
+        if duration >= stage["max"]:
+            stage["max"] = duration
+            stage["slowest"] = " ".join(f"{key}={value}" for key, value in span_labels.items())
+
+    rows = sorted(stages.items(), key=lambda item: item[1]["total"], reverse=True)[:top]
+    lines = [f"Slowest stages of the cycle:",
+             f"  {'stage':<26} {'count':>5} {'total s':>9} {'max s':>8} {'failed':>6}  slowest"]
+    for name, stage in rows:
+        lines.append(f"  {name:<26} {stage['count']:>5} {stage['total']:>9.3f} {stage['max']:>8.3f} {stage['failed']:>6}  {stage['slowest']}")
+    return "\n".join(lines)
@@ -0,0 +1,167 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from config import *
+import metrics
+
+# Webhook mode (--webhook): GitHub sends a 'release' event to http://WEBHOOK_HOST:WEBHOOK_PORT/WEBHOOK_PATH
+# when a release is published, and the release is published without waiting for the next poll.
+#
+#   - a delivery is accepted only with a valid X-Hub-Signature-256 (HMAC-SHA256 of the payload
+#     with the webhook secret), and only for the supported repositories
+#   - the release of the payload is in the same format as from the REST API, and is handled by
+#     the main loop as if it had been polled: catch-up, the database check and the publish batch
+#   - the releases are handled once no new event has arrived for WEBHOOK_SETTLE_DELAY seconds,
+#     so that a burst of events is published as one batch - one 'fdroid update'
+#   - polling goes on as a safety net for missed deliveries, at least WEBHOOK_POLL_INTERVAL_MIN apart
+#
+# The webhook of a repository (or of the organization): content type application/json, the
+# secret, and the "Releases" events.
+
+# Actions of the 'release' event that may make a release publishable
+RELEASE_ACTIONS = ("published", "released", "edited")
+
+
+def signature_valid(secret, body, signature):
+    """Checks the X-Hub-Signature-256 header ('sha256=<hex digest>') of a delivery."""
+    if not signature or not signature.startswith("sha256="):
+        return False
+    expected = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    # Compared as bytes - compare_digest() raises on a str with non-ASCII characters
+    return hmac.compare_digest(expected.encode("ascii"), signature[len("sha256="):].encode("utf-8"))
+
+
+class WebhookReceiver:
+    """The releases received from GitHub, waiting for the main loop."""
+
+    def __init__(self, secret, wakeup=None, settle_delay=WEBHOOK_SETTLE_DELAY, max_delay=WEBHOOK_MAX_DELAY):
+        if not secret:
+            raise ValueError("The webhook secret is empty")
+        self.secret = secret
+        self.wakeup = wakeup            # threading.Event set when a release is received, e.g. DaemonState.wakeup
+        self.settle_delay = settle_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.repos = {}                 # repo in lower case -> repo as in the supported repositories file
+        self.releases = {}              # (repo, tag) -> the release of the latest event
+        self.first_event = None         # time.monotonic() of the first and the latest event waiting
+        self.last_event = None
+        self.server = None
+
+    def set_repos(self, repos):
+        """Sets the repositories whose releases are accepted."""
+        with self.lock:
+            self.repos = {repo.lower(): repo for repo in repos}
+
+    def receive(self, event, body, signature):
+        """Handles a delivery: the X-GitHub-Event and X-Hub-Signature-256 headers and the raw body.
+        Returns (HTTP status, message)."""
+        if not signature_valid(self.secret, body, signature):
+            metrics.WEBHOOK_EVENTS.inc(result="bad_signature")
+            logger.warning("Webhook delivery with an invalid signature rejected")
+            return 401, "Invalid signature"
+        if event == "ping":
+            return 200, "pong"
+        if event != "release":
+            metrics.WEBHOOK_EVENTS.inc(result="ignored")
+            return 200, f"Event '{event}' ignored"
+        try:
+            payload = json.loads(body)
+            action = payload["action"]
+            full_name = payload["repository"]["full_name"]
+            release = payload["release"]
+            relname = release["name"]
+        except (ValueError, KeyError, TypeError):
+            metrics.WEBHOOK_EVENTS.inc(result="invalid")
+            return 400, "Invalid release event"
+
+        if action not in RELEASE_ACTIONS or release.get("draft") or release.get("prerelease"):
+            metrics.WEBHOOK_EVENTS.inc(result="ignored")
+            return 200, f"Release {action} ignored"
+        with self.lock:
+            repo = self.repos.get(full_name.lower())
+            if repo is not None:
+                now = time.monotonic()
+                self.releases[(repo, release.get("tag_name"))] = release
+                if self.first_event is None:
+                    self.first_event = now
+                self.last_event = now
+        if repo is None:
+            metrics.WEBHOOK_EVENTS.inc(result="unsupported")
+            logger.warning(f"Webhook: release {relname} of {full_name} ignored - not a supported repository")
+            return 200, "Repository not supported"
+
+        metrics.WEBHOOK_EVENTS.inc(result="queued")
+        logger.info(f"Webhook: release {relname} of {repo} {action}")
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return 202, "Queued"
+
+    def seconds_until_ready(self):
+        """Returns the time until the received releases are to be handled - 0 if there are none."""
+        with self.lock:
+            if self.first_event is None:
+                return 0.0
+            now = time.monotonic()
+            ready = min(self.last_event + self.settle_delay, self.first_event + self.max_delay)
+            return max(0.0, ready - now)
+
+    def take_releases(self):
+        """Removes and returns the received releases: list of (repo, release), oldest event first."""
+        with self.lock:
+            releases = list(self.releases.items())
+            self.releases = {}
+            self.first_event = None
+            self.last_event = None
+        return [(repo, release) for (repo, tag), release in releases]
+
+    def start(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH):
+        """Listens to the deliveries in a background thread. Returns the server."""
+        handler = type("WebhookHandler", (_WebhookHandler,), {"receiver": self, "path_served": path})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, name="webhook-server", daemon=True)
+        thread.start()
+        logger.info(f"Webhook deliveries received at http://{host}:{self.server.server_address[1]}{path}")
+        return self.server
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    receiver = None
+    path_served = WEBHOOK_PATH
+
+    def do_POST(self):
+        if urlsplit(self.path).path != self.path_served:
+            return self._send(404, "Not found")
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            return self._send(411, "Content-Length required")
+        if length < 0 or length > WEBHOOK_MAX_BODY:
+            return self._send(413, "Payload too large")
+        body = self.rfile.read(length)
+        status, message = self.receiver.receive(self.headers.get("X-GitHub-Event"), body,
+                                                self.headers.get("X-Hub-Signature-256"))
+        self._send(status, message)
+
+    def _send(self, code, message):
+        data = (message + "\n").encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Webhook {self.address_string()}: {format % args}")
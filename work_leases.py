@@ -0,0 +1,167 @@
+import math
+import os
+import re
+import socket
+import threading
+import time
+
+from config import *
+from installed_versions_db import get_db
+
+# Several workers (e.g. one per build host, or a few on one host) can share the data
+# directory and the build and run environments. They coordinate with leases in the
+# installed versions database:
+#
+#   worker:<id>  - a worker is alive: the supported repositories are shared evenly among
+#                  the live workers
+#   repo:<repo>  - the worker polls and downloads the repository
+#   build        - the build leader: the only worker that stages releases, runs
+#                  'fdroid update', adds the releases to the database and deploys
+#
+# The other workers hand their downloaded and verified releases over to the build leader
+# in the 'handoff' table - the APK files stay where they were downloaded, in ROOT_DIR.
+# A lease expires LEASE_TTL seconds after it was last renewed: the repositories and the
+# leadership of a worker that has stopped or died are taken over by the others.
+#
+# The database must be on a filesystem where SQLite locking works - not e.g. a network
+# share with broken locks.
+
+BUILD_LEASE = "build"
+WORKER_LEASE_PREFIX = "worker:"
+REPO_LEASE_PREFIX = "repo:"
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def worker_file_suffix(worker_id):
+    """The worker id made safe for a file name."""
+    return re.sub(r'[^\w.-]', '_', worker_id)
+
+
+class LeaseManager:
+    """The leases of this worker in the database."""
+
+    def __init__(self, db_file, worker_id=None, ttl=LEASE_TTL):
+        self.db = get_db(db_file)
+        self.worker_id = worker_id or default_worker_id()
+        self.ttl = ttl
+        self.stop_heartbeat = threading.Event()
+        self.heartbeat_thread = None
+
+    def _claim(self, conn, name, now):
+        """Takes the lease if it is free, expired or ours already. Returns True if this worker holds it."""
+        conn.execute('''
+            INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+            WHERE leases.owner = excluded.owner OR leases.expires < ?
+        ''', (name, self.worker_id, now + self.ttl, now))
+        return conn.execute('SELECT owner FROM leases WHERE name = ?', (name,)).fetchone()[0] == self.worker_id
+
+    def balance_repos(self, repos):
+        """Claims this worker's share of the repositories and gives up the leases beyond it.
+        Returns the set of the repositories this worker polls."""
+        repos = set(repos)
+        now = time.time()
+        with self.db.lock:
+            with self.db.transaction() as conn:
+                self._claim(conn, WORKER_LEASE_PREFIX + self.worker_id, now)
+                conn.execute('DELETE FROM leases WHERE expires < ?', (now,))
+                workers = conn.execute('SELECT COUNT(*) FROM leases WHERE name LIKE ?', (WORKER_LEASE_PREFIX + '%',)).fetchone()[0]
+                share = math.ceil(len(repos) / max(1, workers))
+
+                held = sorted(name[len(REPO_LEASE_PREFIX):] for (name,) in conn.execute(
+                    'SELECT name FROM leases WHERE owner = ? AND name LIKE ?', (self.worker_id, REPO_LEASE_PREFIX + '%')))
+                # Repositories no longer supported, and the ones beyond the share, are given up
+                keep = [repo for repo in held if repo in repos][:share]
+                give_up = [repo for repo in held if repo not in keep]
+                conn.executemany('DELETE FROM leases WHERE name = ? AND owner = ?',
+                                 [(REPO_LEASE_PREFIX + repo, self.worker_id) for repo in give_up])
+
+                # ..and free repositories are claimed up to the share
+                taken = {name[len(REPO_LEASE_PREFIX):] for (name,) in conn.execute(
+                    'SELECT name FROM leases WHERE name LIKE ?', (REPO_LEASE_PREFIX + '%',))}
+                for repo in sorted(repos - taken):
+                    if len(keep) >= share:
+                        break
+                    if self._claim(conn, REPO_LEASE_PREFIX + repo, now):
+                        keep.append(repo)
+                conn.execute('UPDATE leases SET expires = ? WHERE owner = ?', (now + self.ttl, self.worker_id))
+
+        if give_up:
+            logger.info(f"Worker {self.worker_id} gave up {len(give_up)} repositories to the other workers: {', '.join(give_up)}")
+        logger.debug(f"Worker {self.worker_id} of {workers} polls {len(keep)} of {len(repos)} repositories")
+        return set(keep)
+
+    def try_lead(self):
+        """Claims or renews the build leadership. Returns True if this worker is the build leader."""
+        with self.db.lock:
+            with self.db.transaction() as conn:
+                return self._claim(conn, BUILD_LEASE, time.time())
+
+    def heartbeat(self):
+        """Renews all the leases of this worker. Returns the number of leases renewed."""
+        with self.db.lock:
+            cursor = self.db.conn.execute('UPDATE leases SET expires = ? WHERE owner = ?', (time.time() + self.ttl, self.worker_id))
+            return cursor.rowcount
+
+    def start_heartbeat(self, interval=None):
+        """Renews the leases in a background thread, so that they are kept also during a long build or wait."""
+        interval = interval or self.ttl / 3
+
+        def run():
+            while not self.stop_heartbeat.wait(interval):
+                try:
+                    self.heartbeat()
+                except Exception:
+                    logger.exception(f"Error in renewing the leases of worker {self.worker_id}.")
+
+        self.heartbeat_thread = threading.Thread(target=run, name="lease-heartbeat", daemon=True)
+        self.heartbeat_thread.start()
+
+    def release_all(self):
+        """Stops the heartbeat and gives up all the leases, so that the other workers take over right away."""
+        self.stop_heartbeat.set()
+        with self.db.lock:
+            self.db.conn.execute('DELETE FROM leases WHERE owner = ?', (self.worker_id,))
+
+
+# The handoff of downloaded releases to the build leader
+
+def hand_over(db_file, worker_id, releases):
+    """Queues prepared releases (PendingRelease objects) for the build leader."""
+    db = get_db(db_file)
+    now = time.time()
+    with db.lock:
+        with db.transaction() as conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO handoff (repo, release, asset, filename, date, relnotes, html_url, sha256,
+                                                packageName, version, versionCode, application, worker, queued)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [(release.repo, release.relname, release.asset, os.path.abspath(release.filename), release.date,
+                   release.relnotes, release.html_url, release.apk_sha256, release.packageName, release.versionName,
+                   str(release.versionCode), release.application, worker_id, now) for release in releases])
+
+def handed_over_count(db_file):
+    db = get_db(db_file)
+    with db.lock:
+        return db.conn.execute('SELECT COUNT(*) FROM handoff').fetchone()[0]
+
+def fetch_handed_over(db_file):
+    """Returns the releases handed over to the build leader, oldest first, as dicts."""
+    db = get_db(db_file)
+    with db.lock:
+        cursor = db.conn.execute('''
+            SELECT repo, release, asset, filename, date, relnotes, html_url, sha256,
+                   packageName, version, versionCode, application, worker
+            FROM handoff ORDER BY queued
+        ''')
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def remove_handed_over(db_file, keys):
+    """Removes the (repo, release, asset) of the releases that the build leader has published."""
+    db = get_db(db_file)
+    with db.lock:
+        with db.transaction() as conn:
+            conn.executemany('DELETE FROM handoff WHERE repo = ? AND release = ? AND asset = ?', list(keys))